@@ -15,9 +15,13 @@ from datetime import datetime
 
 from database import SessionLocal
 from models import User, UserProfile, Category, Forum, Thread, Post, Role, Product
-from auth import get_current_active_user, SECRET_KEY, ALGORITHM, admin_required
-from jose import JWTError, jwt
-from utils import render_markdown
+from auth import get_current_active_user, admin_required, resolve_principal, get_password_hash
+from passwords import PasswordHashingBusy
+from forum_stats import refresh_forum_stats, forget_author
+from author_cards import invalidate_author_card
+from principals import invalidate_principal, revoke_claims
+from login_throttle import throttle_stats
+import queries
 
 # Database dependency
 def get_db():
@@ -34,7 +38,7 @@ def admin_required(user_tier_minimum: int = 4):
     Dependency to check if current user has admin privileges
     Requires minimum tier level (default 4 - Admin)
     """
-    def dependency(request: Request, db: Session = Depends(get_db)):
+    def dependency(request: Request):
         # Check for access token cookie
         token = request.cookies.get("access_token")
         if not token:
@@ -45,43 +49,28 @@ def admin_required(user_tier_minimum: int = 4):
                 headers={"WWW-Authenticate": "Bearer"}
             )
         
-        # Try to decode the token
-        try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            username = payload.get("sub")
-            if username is None:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="Invalid authentication credentials"
-                )
-            
-            # Get user from database
-            user = db.query(User).filter(User.username == username).first()
-            if not user:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="User not found"
-                )
-            
-            # Check user tier
-            if not user.profile or user.profile.account_tier < user_tier_minimum:
-                raise HTTPException(
-                    status_code=status.HTTP_403_FORBIDDEN,
-                    detail="Insufficient permissions"
-                )
-            
-            return user
-        except JWTError:
+        # Resolve the user through the principal cache shared with get_optional_user
+        user = resolve_principal(request, token)
+        if not user:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid token",
+                detail="Invalid authentication credentials",
                 headers={"WWW-Authenticate": "Bearer"}
             )
+        
+        # Check user tier
+        if not user.profile or user.profile.account_tier < user_tier_minimum:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Insufficient permissions"
+            )
+        
+        return user
     
     return dependency
 
 # Admin dashboard
-async def admin_dashboard(request: Request, db: Session, current_user: User):
+def admin_dashboard(request: Request, db: Session, current_user: User):
     """Admin dashboard with site statistics"""
     # Get statistics
     user_count = db.query(User).count()
@@ -109,11 +98,12 @@ async def admin_dashboard(request: Request, db: Session, current_user: User):
         "thread_count": thread_count,
         "post_count": post_count,
         "product_count": product_count,
-        "recent_activities": recent_activities
+        "recent_activities": recent_activities,
+        "throttle_stats": throttle_stats()
     }
 
 # Product management functions
-async def product_list(request: Request, db: Session, current_user: User, page: int = 1, per_page: int = 10):
+def product_list(request: Request, db: Session, current_user: User, page: int = 1, per_page: int = 10):
     """List all products with pagination for admin management"""
     # Count total products
     total = db.query(Product).count()
@@ -130,7 +120,7 @@ async def product_list(request: Request, db: Session, current_user: User, page:
         "total_pages": total_pages
     }
 
-async def product_form(request: Request, db: Session, current_user: User, product_id: Optional[int] = None):
+def product_form(request: Request, db: Session, current_user: User, product_id: Optional[int] = None):
     """Product create/edit form"""
     product = None
     if product_id:
@@ -144,10 +134,9 @@ async def product_form(request: Request, db: Session, current_user: User, produc
         "product": product
     }
 
-async def product_save(request: Request, db: Session, current_user: User):
-    """Save product data"""
-    form = await request.form()
-    
+def product_save(form, db: Session, current_user: User):
+    """Save product data from the submitted form"""
+
     # Get form data
     product_id = form.get("id")
     name = form.get("name")
@@ -173,7 +162,7 @@ async def product_save(request: Request, db: Session, current_user: User):
         
         # Save file
         file_path = f"{upload_dir}/{filename}"
-        contents = await image.read()
+        contents = image.file.read()
         with open(file_path, "wb") as f:
             f.write(contents)
         
@@ -212,11 +201,12 @@ async def product_save(request: Request, db: Session, current_user: User):
         )
         db.add(product)
     
+    product.render_html()
     db.commit()
     
     return RedirectResponse(url="/admin/products?success=Product+saved+successfully", status_code=303)
 
-async def product_delete(db: Session, current_user: User, product_id: int):
+def product_delete(db: Session, current_user: User, product_id: int):
     """Delete a product"""
     product = db.query(Product).filter(Product.id == product_id).first()
     if not product:
@@ -227,7 +217,7 @@ async def product_delete(db: Session, current_user: User, product_id: int):
     
     return RedirectResponse(url="/admin/products?success=Product+deleted+successfully", status_code=303)
 
-async def product_toggle_featured(db: Session, current_user: User, product_id: int):
+def product_toggle_featured(db: Session, current_user: User, product_id: int):
     """Toggle product featured status"""
     product = db.query(Product).filter(Product.id == product_id).first()
     if not product:
@@ -240,12 +230,12 @@ async def product_toggle_featured(db: Session, current_user: User, product_id: i
     return RedirectResponse(url="/admin/products?success=Product+status+updated", status_code=303)
 
 # User management
-async def user_list(request: Request, db: Session, current_user: User, page: int = 1, per_page: int = 10):
+def user_list(request: Request, db: Session, current_user: User, page: int = 1, per_page: int = 10):
     """List all users with pagination"""
     total = db.query(User).count()
     total_pages = (total + per_page - 1) // per_page
     
-    users = db.query(User).order_by(User.id.desc()).offset((page - 1) * per_page).limit(per_page).all()
+    users = queries.admin_users_page(db, page, per_page)
     
     return {
         "request": request,
@@ -255,11 +245,11 @@ async def user_list(request: Request, db: Session, current_user: User, page: int
         "total_pages": total_pages
     }
 
-async def user_form(request: Request, db: Session, current_user: User, user_id: Optional[int] = None):
+def user_form(request: Request, db: Session, current_user: User, user_id: Optional[int] = None):
     """User create/edit form"""
     user = None
     if user_id:
-        user = db.query(User).filter(User.id == user_id).first()
+        user = queries.admin_user(db, user_id)
         if not user:
             return RedirectResponse("/admin/users", status_code=302)
     
@@ -273,7 +263,7 @@ async def user_form(request: Request, db: Session, current_user: User, user_id:
         "roles": roles
     }
 
-async def user_toggle(db: Session, current_user: User, user_id: int):
+def user_toggle(db: Session, current_user: User, user_id: int):
     """Toggle user active status"""
     user = db.query(User).filter(User.id == user_id).first()
     
@@ -285,11 +275,13 @@ async def user_toggle(db: Session, current_user: User, user_id: int):
         return RedirectResponse(url="/admin/users?error=Cannot+deactivate+yourself", status_code=303)
     
     user.is_active = not user.is_active
+    revoke_claims(user)
     db.commit()
+    invalidate_principal(user.id)
     
     return RedirectResponse(url=f"/admin/users?success=User+status+updated", status_code=303)
 
-async def user_save(db: Session, current_user: User, form_data: dict, avatar_file=None):
+def user_save(db: Session, current_user: User, form_data: dict, avatar_file=None):
     """Save user data with enhanced validation"""
     # Import validation functions
     from utils import validate_discord_username, filter_offensive_content, validate_display_name
@@ -358,7 +350,13 @@ async def user_save(db: Session, current_user: User, form_data: dict, avatar_fil
         
         # Set password
         if form_data.get('password'):
-            user.hashed_password = get_password_hash(form_data.get('password'))
+            try:
+                user.hashed_password = get_password_hash(form_data.get('password'))
+            except PasswordHashingBusy:
+                return RedirectResponse(
+                    url="/admin/users?error=Server+busy,+please+try+again",
+                    status_code=303
+                )
         
         db.add(user)
         db.flush()  # Get the user ID
@@ -398,6 +396,7 @@ async def user_save(db: Session, current_user: User, form_data: dict, avatar_fil
             signature=signature,
             display_name=display_name
         )
+        profile.render_html()
         db.add(profile)
         
     else:
@@ -428,7 +427,13 @@ async def user_save(db: Session, current_user: User, form_data: dict, avatar_fil
         
         # Update password if provided
         if form_data.get('password'):
-            user.hashed_password = get_password_hash(form_data.get('password'))
+            try:
+                user.hashed_password = get_password_hash(form_data.get('password'))
+            except PasswordHashingBusy:
+                return RedirectResponse(
+                    url=f"/admin/users/{user.id}/edit?error=Server+busy,+please+try+again",
+                    status_code=303
+                )
         
         # Validate bio and signature content for existing user
         bio = form_data.get('bio', '').strip()
@@ -463,6 +468,7 @@ async def user_save(db: Session, current_user: User, form_data: dict, avatar_fil
             user.profile.discord = discord_username
             user.profile.signature = signature
             user.profile.display_name = display_name
+            user.profile.render_html()
         else:
             # Create profile if it doesn't exist
             profile = UserProfile(
@@ -473,6 +479,7 @@ async def user_save(db: Session, current_user: User, form_data: dict, avatar_fil
                 discord=discord_username,
                 signature=signature
             )
+            profile.render_html()
             db.add(profile)
     
     # Handle avatar upload
@@ -505,11 +512,17 @@ async def user_save(db: Session, current_user: User, form_data: dict, avatar_fil
             if role:
                 user.roles.append(role)
     
+    # The tier, name or status in the user's tokens may have changed
+    if not is_new:
+        revoke_claims(user)
+    
     db.commit()
+    invalidate_author_card(user.id)
+    invalidate_principal(user.id)
     
     return RedirectResponse(url="/admin/users?success=User+saved+successfully", status_code=303)
 
-async def user_delete(db: Session, current_user: User, user_id: int):
+def user_delete(db: Session, current_user: User, user_id: int):
     """Delete a user"""
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
@@ -519,13 +532,16 @@ async def user_delete(db: Session, current_user: User, user_id: int):
     if user.id == current_user.id:
         raise HTTPException(status_code=400, detail="Cannot delete your own account")
     
+    forget_author(db, user.id)
     db.delete(user)
     db.commit()
+    invalidate_author_card(user_id)
+    invalidate_principal(user_id)
     
     return RedirectResponse("/admin/users", status_code=302)
 
 # Forum management
-async def forum_management(request: Request, db: Session, current_user: User, tab: str = "categories", page: int = 1):
+def forum_management(request: Request, db: Session, current_user: User, tab: str = "categories", page: int = 1):
     """Admin forum management page"""
     per_page = 20
     
@@ -533,15 +549,15 @@ async def forum_management(request: Request, db: Session, current_user: User, ta
     categories = db.query(Category).order_by(Category.order).all()
     
     # Get forums
-    forums = db.query(Forum).order_by(Forum.category_id, Forum.order).all()
+    forums = queries.admin_forums(db)
     
     # Get threads with pagination if tab is threads
     threads = []
+    reply_counts = {}
     total_threads = 0
     if tab == "threads":
-        threads_query = db.query(Thread).order_by(Thread.created_at.desc())
-        total_threads = threads_query.count()
-        threads = threads_query.offset((page - 1) * per_page).limit(per_page).all()
+        total_threads = db.query(Thread).count()
+        threads, reply_counts = queries.admin_threads_page(db, page, per_page)
     
     # Calculate pagination
     total_pages = math.ceil(total_threads / per_page) if total_threads > 0 else 1
@@ -553,12 +569,13 @@ async def forum_management(request: Request, db: Session, current_user: User, ta
         "categories": categories,
         "forums": forums,
         "threads": threads,
+        "reply_counts": reply_counts,
         "page": page,
         "total_pages": total_pages,
         "total_threads": total_threads
     }
 
-async def category_save(db: Session, current_user: User, form_data: dict):
+def category_save(db: Session, current_user: User, form_data: dict):
     """Save category data"""
     category_id = form_data.get('category_id')
     is_new = category_id is None or category_id == ''
@@ -591,7 +608,7 @@ async def category_save(db: Session, current_user: User, form_data: dict):
     
     return RedirectResponse(url="/admin/forums?success=Category+saved+successfully", status_code=303)
 
-async def forum_save(db: Session, current_user: User, form_data: dict):
+def forum_save(db: Session, current_user: User, form_data: dict):
     """Save forum data"""
     forum_id = form_data.get('forum_id')
     is_new = forum_id is None or forum_id == ''
@@ -633,49 +650,57 @@ async def forum_save(db: Session, current_user: User, form_data: dict):
     return RedirectResponse(url="/admin/forums?success=Forum+saved+successfully", status_code=303)
 
 # Site settings
-async def site_settings(request: Request, db: Session, current_user: User):
+# In a real implementation, we would load settings from a database
+# For now, these defaults are the effective settings of the site
+SITE_SETTINGS = {
+    "general": {
+        "site_name": "CottageWare",
+        "site_description": "CottageWare Forums and Community",
+        "contact_email": "admin@cottageware.com",
+        "items_per_page": 20,
+        "timezone": "UTC",
+        "enable_registration": True
+    },
+    "appearance": {
+        "theme": "dark",
+        "primary_color": "#00a8ff",
+        "secondary_color": "#0097e6",
+        "show_breadcrumbs": True
+    },
+    "forum": {
+        "posts_per_page": 10,
+        "threads_per_page": 20,
+        "allow_guest_view": True,
+        "allow_file_uploads": True,
+        "max_upload_size": 2,  # MB
+        "allowed_file_types": "jpg,jpeg,png,gif,pdf,zip",
+        "enable_signatures": True,
+        "signature_max_length": 200,
+        "enable_avatars": True,
+        "avatar_max_size": 1  # MB
+    },
+    "security": {
+        "login_attempts": 5,
+        "lockout_time": 15,  # minutes
+        "session_timeout": 60,  # minutes
+        "enable_2fa": False,
+        "password_min_length": 8,
+        "require_special_chars": True,
+        "enable_captcha": True,
+        "enable_api": False,
+        "maintenance_mode": False,
+        "maintenance_message": "Site is under maintenance. Please check back later."
+    }
+}
+
+def get_site_setting(section: str, key: str):
+    """Get a single site setting, e.g. get_site_setting("forum", "threads_per_page")"""
+    return SITE_SETTINGS[section][key]
+
+def site_settings(request: Request, db: Session, current_user: User):
     """Admin site settings page"""
-    # In a real implementation, we would load settings from a database
-    # For now, we'll just simulate with some default values
     settings = {
-        "general": {
-            "site_name": "CottageWare",
-            "site_description": "CottageWare Forums and Community",
-            "contact_email": "admin@cottageware.com",
-            "items_per_page": 20,
-            "timezone": "UTC",
-            "enable_registration": True
-        },
-        "appearance": {
-            "theme": "dark",
-            "primary_color": "#00a8ff",
-            "secondary_color": "#0097e6",
-            "show_breadcrumbs": True
-        },
-        "forum": {
-            "posts_per_page": 10,
-            "threads_per_page": 20,
-            "allow_guest_view": True,
-            "allow_file_uploads": True,
-            "max_upload_size": 2,  # MB
-            "allowed_file_types": "jpg,jpeg,png,gif,pdf,zip",
-            "enable_signatures": True,
-            "signature_max_length": 200,
-            "enable_avatars": True,
-            "avatar_max_size": 1  # MB
-        },
-        "security": {
-            "login_attempts": 5,
-            "lockout_time": 15,  # minutes
-            "session_timeout": 60,  # minutes
-            "enable_2fa": False,
-            "password_min_length": 8,
-            "require_special_chars": True,
-            "enable_captcha": True,
-            "enable_api": False,
-            "maintenance_mode": False,
-            "maintenance_message": "Site is under maintenance. Please check back later."
-        },
+        **SITE_SETTINGS,
         "ecommerce": {
             "ecommerce_provider": os.getenv("ECOMMERCE_PROVIDER", "sellapp"),
             "shoppy_store_id": os.getenv("SHOPPY_STORE_ID", ""),
@@ -696,7 +721,7 @@ async def site_settings(request: Request, db: Session, current_user: User):
         "settings": settings
     }
 
-async def settings_save(db: Session, current_user: User, form_data: dict):
+def settings_save(db: Session, current_user: User, form_data: dict):
     """Save site settings"""
     # Get the settings section
     section = form_data.get('section', 'general')
@@ -765,6 +790,12 @@ async def settings_save(db: Session, current_user: User, form_data: dict):
         
         os.environ["SHOW_PRODUCTS_NAVBAR"] = "true" if form_data.get("show_products_navbar") else "false"
     
+    # Login throttling limits, the fields sit in the security panel (see login_throttle.py)
+    if form_data.get("login_attempts"):
+        SITE_SETTINGS["security"]["login_attempts"] = min(max(int(form_data["login_attempts"]), 3), 10)
+    if form_data.get("lockout_time"):
+        SITE_SETTINGS["security"]["lockout_time"] = min(max(int(form_data["lockout_time"]), 5), 60)
+    
     # Perform actions based on settings
     if section == 'advanced':
         # Handle cache clearing
@@ -789,7 +820,7 @@ async def settings_save(db: Session, current_user: User, form_data: dict):
         status_code=303
     )
 
-async def category_form(request: Request, db: Session, current_user: User, category_id: Optional[int] = None):
+def category_form(request: Request, db: Session, current_user: User, category_id: Optional[int] = None):
     """Category form for create/edit"""
     category = None
     if category_id:
@@ -803,7 +834,7 @@ async def category_form(request: Request, db: Session, current_user: User, categ
         "category": category
     }
 
-async def forum_form(request: Request, db: Session, current_user: User, forum_id: Optional[int] = None):
+def forum_form(request: Request, db: Session, current_user: User, forum_id: Optional[int] = None):
     """Forum form for create/edit"""
     forum = None
     if forum_id:
@@ -822,39 +853,44 @@ async def forum_form(request: Request, db: Session, current_user: User, forum_id
     }
 
 # Thread management
-async def thread_list(request: Request, db: Session, current_user: User, page: int = 1, per_page: int = 10):
+def thread_list(request: Request, db: Session, current_user: User, page: int = 1, per_page: int = 10):
     """List all threads with pagination"""
     # Count total threads
     total = db.query(Thread).count()
     total_pages = (total + per_page - 1) // per_page
     
     # Get threads with pagination
-    threads = db.query(Thread).order_by(Thread.created_at.desc()).offset((page - 1) * per_page).limit(per_page).all()
+    threads, reply_counts = queries.admin_threads_page(db, page, per_page)
     
     return {
         "request": request,
         "current_user": current_user,
         "threads": threads,
+        "reply_counts": reply_counts,
         "page": page,
         "total_pages": total_pages
     }
 
-async def thread_delete(db: Session, current_user: User, thread_id: int):
+def thread_delete(db: Session, current_user: User, thread_id: int):
     """Delete a thread and all its posts"""
     thread = db.query(Thread).filter(Thread.id == thread_id).first()
     if not thread:
         raise HTTPException(status_code=404, detail="Thread not found")
     
+    forum_id = thread.forum_id
+    
     # Delete all posts in the thread
     db.query(Post).filter(Post.thread_id == thread_id).delete()
     
     # Delete thread
     db.delete(thread)
+    db.flush()
+    refresh_forum_stats(db, forum_id)
     db.commit()
     
     return {"success": True}
 
-async def thread_toggle_sticky(db: Session, current_user: User, thread_id: int):
+def thread_toggle_sticky(db: Session, current_user: User, thread_id: int):
     """Toggle thread sticky status"""
     thread = db.query(Thread).filter(Thread.id == thread_id).first()
     if not thread:
@@ -6,7 +6,6 @@ Handles user authentication, JWT tokens, and Google OAuth
 from fastapi import Depends, HTTPException, status, Request
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
 from typing import Optional
@@ -15,6 +14,8 @@ from dotenv import load_dotenv
 from fastapi_sso.sso.google import GoogleSSO
 from models import User
 from database import SessionLocal
+from principals import Principal, get_principal, principal_claims, principal_from_claims
+import passwords
 
 # Load environment variables
 load_dotenv()
@@ -24,9 +25,6 @@ SECRET_KEY = os.getenv("SECRET_KEY", "default_secret_key_replace_in_production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # 24 hours
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -46,13 +44,14 @@ def get_db():
     finally:
         db.close()
 
-# Password verification
+# Password verification, bcrypt runs in the process pool of passwords.py
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    valid, _ = passwords.verify_password(plain_password, hashed_password)
+    return valid
 
 # Password hashing
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return passwords.hash_password(password)
 
 # Get user by username
 def get_user_by_username(db: Session, username: str):
@@ -74,8 +73,14 @@ def authenticate_user(db: Session, username: str, password: str):
     user = get_user_by_username(db, username)
     if not user or not user.hashed_password:
         return False
-    if not verify_password(password, user.hashed_password):
+    valid, new_hash = passwords.verify_password(password, user.hashed_password)
+    if not valid:
         return False
+    
+    # Upgrade hashes made with outdated settings while the password is at hand
+    if new_hash:
+        user.hashed_password = new_hash
+        db.commit()
     return user
 
 # Create access token
@@ -89,28 +94,59 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+# Create an access token for a user, carrying the claims of principals.principal_claims
+def create_user_token(user: User, expires_delta: Optional[timedelta] = None):
+    return create_access_token({"sub": user.username, **principal_claims(user)}, expires_delta)
+
+# Dependencies that may query the database are plain functions, so FastAPI runs them in the threadpool.
+# They return a cached Principal (see principals.py) rather than a User bound to a session.
+
+# Get the principal named by an access token
+def get_token_principal(token: str) -> Optional[Principal]:
+    """Returns the principal of a token's subject, or None if the token is invalid or its user is gone"""
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    
+    username = payload.get("sub")
+    if username is None:
+        return None
+    
+    # Tokens with current claims need no lookup, older ones resolve through the principal cache
+    return principal_from_claims(payload) or get_principal(username)
+
+# Resolve the principal of a token once per request
+def resolve_principal(request: Request, token: Optional[str]) -> Optional[Principal]:
+    """
+    Returns the principal of a token, resolving each token at most once per request.
+    Dependencies share the result through request.state, and a cache miss is loaded
+    with a session of its own rather than the route's get_db session.
+    """
+    if not token:
+        return None
+    
+    resolved = getattr(request.state, "principals", None)
+    if resolved is None:
+        resolved = request.state.principals = {}
+    if token not in resolved:
+        resolved[token] = get_token_principal(token)
+    return resolved[token]
+
 # Get current user from token
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def get_current_user(request: Request, token: str = Depends(oauth2_scheme)) -> Principal:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    
-    user = get_user_by_username(db, username)
+    user = resolve_principal(request, token)
     if user is None:
         raise credentials_exception
     return user
 
 # Get current active user
-async def get_current_active_user(current_user: User = Depends(get_current_user)):
+def get_current_active_user(current_user: Principal = Depends(get_current_user)) -> Principal:
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
@@ -169,30 +205,14 @@ def get_or_create_oauth_user(db: Session, oauth_provider: str, oauth_id: str,
     )
 
 # Optional current user (for templates)
-async def get_optional_user(request: Request, db: Session = Depends(get_db)):
+def get_optional_user(request: Request) -> Optional[Principal]:
     """Get the current user if logged in, otherwise return None"""
-    token = request.cookies.get("access_token")
-    if not token:
-        return None
-    
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username = payload.get("sub")
-        if username is None:
-            return None
-        
-        user = get_user_by_username(db, username)
-        if user is None:
-            return None
-        
-        return user
-    except JWTError:
-        return None
+    return resolve_principal(request, request.cookies.get("access_token"))
 
 # Admin required dependency
 def admin_required():
     """Dependency to check if user is an admin (tier 4 or higher)"""
-    async def _admin_required(current_user: User = Depends(get_current_active_user)):
+    def _admin_required(current_user: Principal = Depends(get_current_active_user)):
         # Check if user has admin privileges (tier 4 or higher)
         if not current_user or not current_user.profile or current_user.profile.account_tier < 4:
             raise HTTPException(
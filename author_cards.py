@@ -0,0 +1,114 @@
+# author_cards.py - Cross-request cache of the author details shown next to posts
+
+"""
+Author cards for CottageWare
+
+Thread pages show the same sidebar (name, avatar, roles, join date) and
+signature for every post of an author. Cards are built once per author from
+a single query and kept in a process-wide LRU cache keyed by user id, so a
+thread page costs one lookup per distinct author instead of one per post.
+
+Code that changes anything on a card (profile, avatar, tier, roles) must call
+invalidate_author_card() after committing. Cards also expire after
+AUTHOR_CARD_TTL_SECONDS so changes made by other processes, such as
+make_admin.py, show up eventually.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+from sqlalchemy.orm import Session, joinedload, selectinload
+from models import User
+from utils import render_markdown, RENDERER_VERSION
+
+# Maximum number of cached cards and how long a card stays valid
+AUTHOR_CARD_CACHE_SIZE = 2048
+AUTHOR_CARD_TTL_SECONDS = 300
+
+_cards = OrderedDict()  # user_id -> (expires_at, card)
+_cards_lock = threading.Lock()
+_invalidations = 0  # Bumped on every invalidation, see get_author_cards
+
+def build_author_card(user: User) -> dict:
+    """Builds the card of a user with its profile and roles loaded"""
+    profile = user.profile
+    signature_html = ''
+    if profile and profile.signature:
+        # Rows not yet re-rendered by rendered_content.py are rendered here, once per card
+        if profile.signature_html is not None and profile.render_version == RENDERER_VERSION:
+            signature_html = profile.signature_html
+        else:
+            signature_html = render_markdown(profile.signature)
+
+    return {
+        "id": user.id,
+        "username": user.username,
+        "display_name": (profile.display_name if profile else None) or user.username,
+        "avatar_url": user.avatar_url,
+        "tier_name": profile.tier_name if profile else "Unregistered",
+        "roles": [role.name for role in user.roles],
+        "joined": user.created_at,
+        "signature_html": signature_html
+    }
+
+def get_author_cards(db: Session, user_ids: Iterable[Optional[int]]) -> Dict[int, dict]:
+    """
+    Returns the cards of the given users, keyed by user id.
+    Cached cards are reused; the missing ones are loaded with a single query.
+    Deleted users are left out of the result.
+    """
+    wanted = {user_id for user_id in user_ids if user_id is not None}
+    cards = {}
+    now = time.monotonic()
+
+    with _cards_lock:
+        generation = _invalidations
+        for user_id in wanted:
+            entry = _cards.get(user_id)
+            if entry is None:
+                continue
+            if entry[0] <= now:
+                del _cards[user_id]
+                continue
+            _cards.move_to_end(user_id)
+            cards[user_id] = entry[1]
+
+    missing = wanted - cards.keys()
+    if not missing:
+        return cards
+
+    users = db.query(User).options(
+        joinedload(User.profile),
+        selectinload(User.roles)
+    ).filter(User.id.in_(missing)).all()
+
+    loaded = {user.id: build_author_card(user) for user in users}
+    cards.update(loaded)
+
+    expires_at = now + AUTHOR_CARD_TTL_SECONDS
+    with _cards_lock:
+        # Cards loaded while an invalidation happened may be stale, so they are not cached
+        if generation != _invalidations:
+            return cards
+        for user_id, card in loaded.items():
+            _cards[user_id] = (expires_at, card)
+            _cards.move_to_end(user_id)
+        while len(_cards) > AUTHOR_CARD_CACHE_SIZE:
+            _cards.popitem(last=False)
+
+    return cards
+
+def invalidate_author_card(user_id: int):
+    """Drops the cached card of a user, call after committing a change to it"""
+    global _invalidations
+    with _cards_lock:
+        _invalidations += 1
+        _cards.pop(user_id, None)
+
+def clear_author_cards():
+    """Drops every cached card"""
+    global _invalidations
+    with _cards_lock:
+        _invalidations += 1
+        _cards.clear()
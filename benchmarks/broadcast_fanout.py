@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# broadcast_fanout.py - Micro-benchmark for broadcasting to many WebSocket connections
+
+"""
+Measures how long ConnectionManager takes to deliver one broadcast to every
+connection, from the broadcast call until each writer task has handed the
+message to its socket, as the number of connections grows. The sockets are
+stand-ins that accept every message at once, so only the server's own work
+is timed.
+
+"encode per socket" JSON-encodes the message for every recipient, as
+send_json() did before broadcasts were encoded once. "encode once" is the
+current broadcast(), with the json module and, if it is installed, orjson.
+
+Run from the project root:
+    python -m benchmarks.broadcast_fanout
+"""
+
+import argparse
+import asyncio
+import time
+import connection_manager
+
+# A shoutbox message and an online users update, as broadcast by main.py
+SHOUTBOX_MESSAGE = {
+    "type": "shoutbox_message",
+    "data": {
+        "id": 48213,
+        "user_id": 1207,
+        "username": "potter_mary",
+        "display_name": "Mary Potter",
+        "avatar_url": "/static/images/default-avatar.png",
+        "message": "Has anyone tried the new glaze recipe from the workshop thread? Mine came out " * 2,
+        "created_at": "2024-05-18T14:03:27.512394",
+        "account_tier": 2,
+        "tier_name": "Member",
+        "shoutbox_type": "public"
+    }
+}
+ONLINE_USERS_MESSAGE = {
+    "type": "online_users",
+    "data": {
+        "users": [
+            {"id": i, "username": f"user{i}", "display_name": f"User {i}", "account_tier": 1, "tier_name": "Registered"}
+            for i in range(50)
+        ],
+        "guest_count": 120,
+        "total_count": 170
+    }
+}
+
+class NullSocket:
+    """Accepts every message at once and counts them"""
+
+    def __init__(self, delivered: "Delivered"):
+        self.delivered = delivered
+
+    async def send_text(self, payload: str):
+        self.delivered.add()
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        pass
+
+class Delivered:
+    """Counts deliveries and wakes the benchmark when all expected ones are in"""
+
+    def __init__(self):
+        self.count = 0
+        self.expected = 0
+        self.done = asyncio.Event()
+
+    def expect(self, count: int):
+        self.count = 0
+        self.expected = count
+        self.done.clear()
+
+    def add(self):
+        self.count += 1
+        if self.count >= self.expected:
+            self.done.set()
+
+def broadcast_encoding_per_socket(manager, message):
+    """Queues the message for every connection, encoding it for each one"""
+    for connection in manager.connections():
+        manager.send(connection, message)
+
+def broadcast_encoding_once(manager, message):
+    manager.broadcast(message)
+
+async def time_broadcasts(manager, delivered, broadcast, message, connections: int, repeat: int) -> float:
+    """Best time in ms from the broadcast call until every connection got the message"""
+    best = None
+    for _ in range(repeat):
+        delivered.expect(connections)
+        started = time.perf_counter()
+        broadcast(manager, message)
+        await delivered.done.wait()
+        elapsed = (time.perf_counter() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+async def run(connection_counts, repeat: int):
+    orjson = connection_manager.orjson
+    variants = [
+        ("encode per socket", broadcast_encoding_per_socket, None),
+        ("encode once (json)", broadcast_encoding_once, None),
+    ]
+    if orjson is not None:
+        variants.append(("encode once (orjson)", broadcast_encoding_once, orjson))
+    else:
+        print("orjson is not installed, skipping it")
+
+    for label, message in [("shoutbox message", SHOUTBOX_MESSAGE), ("online users", ONLINE_USERS_MESSAGE)]:
+        size = len(connection_manager.encode_message(message))
+        print(f"\n{label} ({size} bytes)")
+        print(f"{'connections':>11}  " + "  ".join(f"{name:>22}" for name, _, _ in variants))
+        for connections in connection_counts:
+            manager = connection_manager.ConnectionManager()
+            delivered = Delivered()
+            for _ in range(connections):
+                manager.add(NullSocket(delivered))
+
+            timings = []
+            for _, broadcast, encoder in variants:
+                connection_manager.orjson = encoder
+                timings.append(await time_broadcasts(manager, delivered, broadcast, message, connections, repeat))
+            connection_manager.orjson = orjson
+
+            print(f"{connections:>11}  " + "  ".join(f"{timing:>19.2f} ms" for timing in timings))
+
+            writers = []
+            for connection in manager.connections():
+                manager.remove(connection)
+                writers.append(connection.writer)
+            await asyncio.gather(*writers, return_exceptions=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark broadcasting to many WebSocket connections")
+    parser.add_argument("-c", "--connections", type=int, nargs="+", default=[100, 500, 2000, 5000],
+                        help="Connection counts to measure")
+    parser.add_argument("-r", "--repeat", type=int, default=20, help="Broadcasts per variant (best is reported)")
+
+    args = parser.parse_args()
+    asyncio.run(run(args.connections, args.repeat))
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# markdown_render.py - Micro-benchmark for the Markdown renderer in utils.py
+
+"""
+Compares building a Markdown pipeline and bleach cleaner for every call (how
+render_markdown used to work) against the reused per-thread renderer and the
+render_markdown_many batch API.
+
+Run from the project root:
+    python -m benchmarks.markdown_render
+"""
+
+import argparse
+import timeit
+from utils import MarkdownRenderer, render_markdown, render_markdown_many
+
+# Typical forum fragments: a short reply, a signature and a longer post
+SAMPLE_TEXTS = [
+    "Thanks, that fixed it! ~~Still broken~~ working now.",
+    "*CottageWare enthusiast* | [my site](https://example.com)",
+    "## Setup\n\n1. Install the package\n2. Run `make_admin.py`\n\n"
+    "```python\nprint('hello')\n```\n\n| Tier | Name |\n|---|---|\n| 1 | Registered |\n\n"
+    "See the docs[^1].\n\n[^1]: The README.",
+]
+
+def render_with_new_pipeline(texts):
+    """Builds a fresh renderer for every fragment"""
+    return [MarkdownRenderer().render(text) for text in texts]
+
+def render_one_by_one(texts):
+    """Renders every fragment through render_markdown"""
+    return [render_markdown(text) for text in texts]
+
+def run(fragments: int, repeat: int):
+    texts = (SAMPLE_TEXTS * (fragments // len(SAMPLE_TEXTS) + 1))[:fragments]
+
+    # Reusing the renderer must not change the output
+    assert render_with_new_pipeline(texts) == render_one_by_one(texts) == render_markdown_many(texts)
+
+    results = {}
+    for name, func in [
+        ("new pipeline per call", render_with_new_pipeline),
+        ("render_markdown", render_one_by_one),
+        ("render_markdown_many", render_markdown_many),
+    ]:
+        best = min(timeit.repeat(lambda: func(texts), number=1, repeat=repeat))
+        results[name] = best
+        print(f"{name:24} {best * 1000:8.2f} ms  ({best / fragments * 1e6:7.1f} us/fragment)")
+
+    baseline = results["new pipeline per call"]
+    print(f"Speedup of render_markdown_many: {baseline / results['render_markdown_many']:.1f}x")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Markdown renderer")
+    parser.add_argument("-n", "--fragments", type=int, default=60, help="Fragments rendered per run")
+    parser.add_argument("-r", "--repeat", type=int, default=20, help="Runs per variant (best is reported)")
+
+    args = parser.parse_args()
+    run(args.fragments, args.repeat)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# shoutbox_latency.py - Load test for shoutbox delivery while slow page requests are served
+
+"""
+Starts the app with uvicorn on a scratch SQLite database and makes every query
+on the threads table slow. It then measures how long shoutbox messages take to
+reach another WebSocket client, first on an idle server and then while thread
+pages are requested concurrently.
+
+If a route queries the database on the event loop, each slow query stalls
+shoutbox delivery to every connected client. With database work in the
+threadpool, delivery latency under load stays close to the idle latency.
+
+Run from the project root:
+    python -m benchmarks.shoutbox_latency
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+SCRATCH_DIR = tempfile.mkdtemp(prefix="cottageware-bench-")
+os.environ["DB_EXTERNAL_URL"] = f"sqlite:///{os.path.join(SCRATCH_DIR, 'bench.db')}"
+
+import httpx
+import uvicorn
+import websockets
+from sqlalchemy import event
+import main
+from auth import create_access_token
+from database import SessionLocal, engine
+from models import User, UserProfile, Category, Forum, Thread
+
+def seed_database():
+    """Create a user, a forum and a thread to request. Returns (username, thread_id)."""
+    db = SessionLocal()
+    try:
+        user = User(username="bench", email="bench@example.com")
+        db.add(user)
+        db.flush()
+        db.add(UserProfile(user_id=user.id, account_tier=UserProfile.TIER_REGISTERED))
+        category = Category(name="Bench", description="Benchmark", is_public=True)
+        db.add(category)
+        db.flush()
+        forum = Forum(category_id=category.id, name="Bench", description="Benchmark", is_public=True)
+        db.add(forum)
+        db.flush()
+        thread = Thread(forum_id=forum.id, author_id=user.id, title="Bench", content="Benchmark thread")
+        thread.render_html()
+        db.add(thread)
+        db.commit()
+        return user.username, thread.id
+    finally:
+        db.close()
+
+def slow_down_thread_queries(seconds: float):
+    """Make every query that reads the threads table take at least `seconds`"""
+    @event.listens_for(engine, "before_cursor_execute")
+    def _slow_query(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT") and "FROM threads" in statement:
+            time.sleep(seconds)
+
+def start_server():
+    """Run the app with uvicorn in a background thread, returns its base URL"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"127.0.0.1:{port}"
+
+async def connect(url: str):
+    """Open a WebSocket and wait for the connection confirmation"""
+    websocket = await websockets.connect(url)
+    while json.loads(await websocket.recv()).get("type") != "connection_established":
+        pass
+    return websocket
+
+async def measure_delivery(address: str, username: str, user_id: int, duration: float, interval: float):
+    """Send shoutbox messages for `duration` seconds, returns their delivery latencies in ms"""
+    token = create_access_token({"sub": username})
+    sender = await connect(f"ws://{address}/ws?token={token}")
+    listener = await connect(f"ws://{address}/ws")
+    latencies = []
+
+    async def receive():
+        async for raw in listener:
+            message = json.loads(raw)
+            if message.get("type") == "shoutbox_message":
+                sent_at = float(message["data"]["message"])
+                latencies.append((time.perf_counter() - sent_at) * 1000)
+
+    receiver = asyncio.create_task(receive())
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        await sender.send(json.dumps({
+            "type": "shoutbox_message",
+            "content": repr(time.perf_counter()),
+            "user_id": user_id,
+            "username": username,
+            "shoutbox_type": "public"
+        }))
+        await asyncio.sleep(interval)
+
+    # Give the last messages time to arrive
+    await asyncio.sleep(1)
+    receiver.cancel()
+    await sender.close()
+    await listener.close()
+    return latencies
+
+async def request_pages(address: str, thread_id: int, concurrency: int, stop: asyncio.Event):
+    """Request the thread page from `concurrency` clients until stop is set, returns the request count"""
+    count = 0
+
+    async def client():
+        nonlocal count
+        async with httpx.AsyncClient(base_url=f"http://{address}", timeout=60) as http:
+            while not stop.is_set():
+                await http.get(f"/thread/{thread_id}")
+                count += 1
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return count
+
+def summarize(name: str, latencies):
+    if not latencies:
+        return f"{name:10} no messages delivered"
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if len(latencies) > 1 else latencies[0]
+    return (f"{name:10} {len(latencies):4} messages  p50 {statistics.median(latencies):8.1f} ms  "
+            f"p95 {p95:8.1f} ms  max {latencies[-1]:8.1f} ms")
+
+async def run(args):
+    username, thread_id = seed_database()
+    db = SessionLocal()
+    user_id = db.query(User.id).filter(User.username == username).scalar()
+    db.close()
+
+    slow_down_thread_queries(args.slow_query_ms / 1000)
+    address = start_server()
+
+    idle = await measure_delivery(address, username, user_id, args.duration, args.interval)
+
+    stop = asyncio.Event()
+    load = asyncio.create_task(request_pages(address, thread_id, args.concurrency, stop))
+    loaded = await measure_delivery(address, username, user_id, args.duration, args.interval)
+    stop.set()
+    page_requests = await load
+
+    return [
+        f"Slow query: {args.slow_query_ms} ms, {args.concurrency} concurrent page clients, {page_requests} pages served",
+        summarize("idle", idle),
+        summarize("loaded", loaded)
+    ]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure shoutbox delivery latency while slow pages are served")
+    parser.add_argument("-s", "--slow-query-ms", type=int, default=200, help="Added latency of queries on the threads table")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="Concurrent clients requesting the thread page")
+    parser.add_argument("-d", "--duration", type=float, default=5, help="Seconds of messages per phase")
+    parser.add_argument("-i", "--interval", type=float, default=0.1, help="Seconds between shoutbox messages")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show the app's debug output")
+
+    args = parser.parse_args()
+
+    # The app prints debug output for every WebSocket message
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+    results = asyncio.run(run(args))
+    sys.stdout = sys.__stdout__
+    print("\n".join(results))
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# websocket_load.py - Load test for the /ws endpoint with many simulated clients
+
+"""
+Starts the app with uvicorn on a scratch SQLite database and opens N WebSocket
+clients at once from a separate process, a mix of signed-in users and guests.
+It reports:
+
+- connect: time from opening the socket to receiving connection_established,
+  for the initial burst of connections and again for a reconnect storm in
+  which every client drops and reconnects at the same moment
+- shoutbox: end-to-end latency from sending a shoutbox message to each client
+  receiving it, and how many deliveries were missed
+- server CPU time per shoutbox message, measured in the server process only
+  since the clients run in their own process
+- shoutbox throughput: messages per second stored and delivered to every
+  client when a burst of messages is sent back to back, in windows that fit
+  the clients' send queues, and how the shoutbox writer batched them
+- the fan-out and delivery timings and evictions kept by ConnectionManager
+- pooled database connections by subsystem: how many are held while the
+  clients sit connected, and the most checked out at once during the run
+
+Use it to compare changes to the /ws path on the same machine.
+
+Run from the project root:
+    python -m benchmarks.websocket_load
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+from typing import Optional
+import websockets
+
+# How long a client waits for connection_established before counting the connection as failed
+CONNECT_TIMEOUT_SECONDS = 30
+
+def percentile(values, fraction: float):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(len(ordered) * fraction)) - 1))]
+
+def summarize(name: str, values, unit: str = "ms"):
+    """Percentiles of the samples, connections that failed are given as None and counted"""
+    failed = sum(1 for value in values if value is None)
+    values = [value for value in values if value is not None]
+    if not values:
+        return f"{name:18} no samples, {failed} failed"
+    return (f"{name:18} {len(values):7} samples{f' ({failed} failed)' if failed else ''}  p50 {percentile(values, 0.5):8.1f} {unit}  "
+            f"p99 {percentile(values, 0.99):8.1f} {unit}  max {max(values):8.1f} {unit}")
+
+# Client side, runs in its own process
+
+class Client:
+    """One simulated browser: connects, then reads every message until closed"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.websocket = None
+        self.reader = None
+        self.latencies = []  # Shoutbox delivery latencies in ms
+        self.burst_received = 0
+
+    async def connect(self) -> Optional[float]:
+        """
+        Connects and waits for connection_established.
+        Returns the time it took in ms, or None if the connection failed or took over CONNECT_TIMEOUT_SECONDS.
+        """
+        started = time.perf_counter()
+        try:
+            async with asyncio.timeout(CONNECT_TIMEOUT_SECONDS):
+                self.websocket = await websockets.connect(self.url, max_queue=None)
+                while json.loads(await self.websocket.recv()).get("type") != "connection_established":
+                    pass
+        except (OSError, TimeoutError, websockets.WebSocketException):
+            self.websocket = None
+            return None
+        elapsed = (time.perf_counter() - started) * 1000
+        self.reader = asyncio.create_task(self.read())
+        return elapsed
+
+    async def read(self):
+        try:
+            async for raw in self.websocket:
+                message = json.loads(raw)
+                if message.get("type") == "shoutbox_message" and message["data"]["message"].startswith("bench "):
+                    sent_at = float(message["data"]["message"].split()[1])
+                    self.latencies.append((time.perf_counter() - sent_at) * 1000)
+                elif message.get("type") == "shoutbox_message" and message["data"]["message"].startswith("burst "):
+                    self.burst_received += 1
+        except websockets.ConnectionClosed:
+            pass
+
+    async def close(self):
+        if self.websocket is not None:
+            await self.websocket.close()
+            await self.reader
+
+async def run_clients(address: str, tokens, sender: dict, args, pipe):
+    """Runs the phases, sending results to the server process and waiting for it in between"""
+    clients = [Client(f"ws://{address}/ws?token={token}" if token else f"ws://{address}/ws") for token in tokens]
+
+    # The sender connects before the burst so it is set up however the others fare
+    sending = Client(f"ws://{address}/ws?token={sender['token']}")
+    await sending.connect()
+
+    connect_ms = await asyncio.gather(*(client.connect() for client in clients))
+    pipe.send(("connected", connect_ms))
+
+    # The server starts measuring its CPU time before telling the clients to go on
+    await asyncio.to_thread(pipe.recv)
+    for _ in range(args.messages):
+        await sending.websocket.send(json.dumps({
+            "type": "shoutbox_message",
+            "content": f"bench {time.perf_counter()!r}",
+            "user_id": sender["user_id"],
+            "username": sender["username"],
+            "shoutbox_type": "public"
+        }))
+        await asyncio.sleep(args.interval)
+    # Give the last messages time to arrive
+    expected = args.messages * sum(1 for client in clients if client.websocket is not None)
+    deadline = time.perf_counter() + args.drain
+    while sum(len(client.latencies) for client in clients) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    pipe.send(("shoutbox", [latency for client in clients for latency in client.latencies], expected))
+
+    await asyncio.to_thread(pipe.recv)
+    connected = [client for client in clients if client.websocket is not None]
+    started = time.perf_counter()
+    sent = 0
+    burst_seconds = None
+    while sent < args.burst:
+        # Send a window of messages back to back, then wait until every client has them
+        for _ in range(min(args.window, args.burst - sent)):
+            await sending.websocket.send(json.dumps({
+                "type": "shoutbox_message",
+                "content": f"burst {sent}",
+                "user_id": sender["user_id"],
+                "username": sender["username"],
+                "shoutbox_type": "public"
+            }))
+            sent += 1
+        deadline = time.perf_counter() + args.drain
+        while any(client.burst_received < sent for client in connected) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.001)
+        if any(client.burst_received < sent for client in connected):
+            break
+    else:
+        burst_seconds = time.perf_counter() - started
+    await sending.close()
+    pipe.send(("burst", burst_seconds, sum(client.burst_received for client in connected), args.burst * len(connected)))
+
+    await asyncio.to_thread(pipe.recv)
+    await asyncio.gather(*(client.close() for client in clients))
+    reconnect_ms = await asyncio.gather(*(client.connect() for client in clients))
+    pipe.send(("reconnected", reconnect_ms))
+
+    await asyncio.gather(*(client.close() for client in clients))
+
+def client_process(address: str, tokens, sender: dict, args, pipe):
+    asyncio.run(run_clients(address, tokens, sender, args, pipe))
+
+# Server side
+
+def seed_users(count: int):
+    """Create `count` users to sign in as, returns [(id, username)]"""
+    from database import SessionLocal
+    from models import User, UserProfile
+
+    db = SessionLocal()
+    try:
+        users = [User(username=f"loaduser{i}", email=f"loaduser{i}@example.com") for i in range(count)]
+        db.add_all(users)
+        db.flush()
+        db.add_all(UserProfile(user_id=user.id, account_tier=UserProfile.TIER_REGISTERED) for user in users)
+        db.commit()
+        return [(user.id, user.username) for user in users]
+    finally:
+        db.close()
+
+def run(args):
+    # Importing shoutbox_latency also points the app at a scratch database, so it comes first
+    from benchmarks.shoutbox_latency import start_server
+    import main
+    from database import pool_checkouts
+    from auth import create_access_token
+
+    signed_in = round(args.clients * args.authenticated)
+    users = seed_users(max(1, signed_in))
+    tokens = [create_access_token({"sub": users[i % len(users)][1]}) for i in range(signed_in)]
+    tokens += [None] * (args.clients - signed_in)
+    sender_id, sender_name = users[0]
+    sender = {"token": create_access_token({"sub": sender_name}), "user_id": sender_id, "username": sender_name}
+
+    address = start_server()
+    pipe, child_pipe = multiprocessing.Pipe()
+    clients = multiprocessing.get_context("spawn").Process(
+        target=client_process, args=(address, tokens, sender, args, child_pipe), daemon=True
+    )
+    clients.start()
+    # Only the client process holds its end, so recv() fails rather than hangs if it dies
+    child_pipe.close()
+
+    _, connect_ms = pipe.recv()
+    # Let the presence update for the burst go out before measuring
+    time.sleep(2)
+    held = {subsystem: gauge["checked_out"] for subsystem, gauge in pool_checkouts.snapshot().items()}
+    cpu_started = time.process_time()
+    pipe.send("go")
+    _, shoutbox_ms, expected = pipe.recv()
+    cpu_seconds = time.process_time() - cpu_started
+    metrics = main.connection_manager.metrics.snapshot()
+
+    writes_before = main.shoutbox_writer.metrics.snapshot()
+    pipe.send("go")
+    _, burst_seconds, burst_received, burst_expected = pipe.recv()
+    writes = main.shoutbox_writer.metrics.snapshot()
+    burst_batches = writes["batches"] - writes_before["batches"]
+
+    pipe.send("go")
+    _, reconnect_ms = pipe.recv()
+    clients.join(timeout=30)
+    peaks = {subsystem: gauge["peak"] for subsystem, gauge in pool_checkouts.snapshot().items()}
+
+    return [
+        f"{args.clients} clients ({signed_in} signed in, {args.clients - signed_in} guests), "
+        f"{args.messages} shoutbox messages every {args.interval * 1000:.0f} ms",
+        summarize("connect", connect_ms),
+        summarize("reconnect storm", reconnect_ms),
+        summarize("shoutbox delivery", shoutbox_ms),
+        f"{'missed deliveries':18} {expected - len(shoutbox_ms):7} of {expected} to connected clients",
+        f"{'server CPU':18} {cpu_seconds * 1000 / args.messages:7.2f} ms per message "
+        f"({cpu_seconds * 1e6 / max(1, len(shoutbox_ms)):.1f} us per delivery)",
+        f"{'fan-out':18} p50 {metrics['fanout_ms']['p50']} ms  p95 {metrics['fanout_ms']['p95']} ms  "
+        f"max {metrics['fanout_ms']['max']} ms",
+        f"{'evictions':18} {metrics['queue_overflows']} overflows, {metrics['send_timeouts']} timeouts, "
+        f"{metrics['send_errors']} errors",
+        f"{'burst throughput':18} " + (
+            f"{args.burst / burst_seconds:7.0f} messages/s stored and delivered to every client ({args.burst} in {burst_seconds * 1000:.0f} ms)"
+            if burst_seconds else f"incomplete, {burst_received} of {burst_expected} deliveries within {args.drain:.0f} s"
+        ),
+        f"{'burst writes':18} {burst_batches} transactions, "
+        f"{(writes['messages'] - writes_before['messages']) / max(1, burst_batches):.1f} messages per transaction",
+        f"{'pool held idle':18} " + ", ".join(f"{subsystem} {count}" for subsystem, count in held.items()),
+        f"{'pool peak':18} " + ", ".join(f"{subsystem} {count}" for subsystem, count in peaks.items())
+    ]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the /ws endpoint with many simulated clients")
+    parser.add_argument("-n", "--clients", type=int, default=200, help="Simulated clients")
+    parser.add_argument("-a", "--authenticated", type=float, default=0.5, help="Fraction of clients that sign in")
+    parser.add_argument("-m", "--messages", type=int, default=50, help="Shoutbox messages to send")
+    parser.add_argument("-i", "--interval", type=float, default=0.05, help="Seconds between shoutbox messages")
+    parser.add_argument("-b", "--burst", type=int, default=500, help="Shoutbox messages to send back to back for throughput")
+    parser.add_argument("-w", "--window", type=int, default=50, help="Burst messages in flight at once")
+    parser.add_argument("--drain", type=float, default=10, help="Seconds to wait for the last deliveries")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show the app's debug output")
+
+    args = parser.parse_args()
+
+    # The app prints debug output for every WebSocket message
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+    results = run(args)
+    sys.stdout = sys.__stdout__
+    print("\n".join(results))
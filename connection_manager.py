@@ -0,0 +1,268 @@
+# connection_manager.py - Registry of the open WebSocket connections
+
+"""
+WebSocket connections for CottageWare
+
+The open sockets used to live in a plain list of dicts, so removing one,
+checking it was still open during a broadcast or finding a user's other
+sockets all scanned every connection. ConnectionManager keeps them indexed
+by connection id, by user and by channel, and counts guests as they come and
+go, so connecting, disconnecting and the online counts shown on /forum cost
+the same at thousands of sockets as at ten.
+
+Messages are not written to sockets by the code that sends them. Each
+connection has a bounded outbound queue drained by its own writer task, so a
+broadcast only enqueues and one client on a bad link can't hold up the
+others. A connection whose queue overflows (SEND_QUEUE_SIZE) or whose socket
+takes longer than SEND_TIMEOUT_SECONDS to accept a message is evicted and
+closed. BroadcastMetrics keeps fan-out and delivery times and eviction counts.
+
+Queued messages are already JSON text: a broadcast is encoded once for all of
+its recipients rather than by send_json() for each socket, using orjson when
+it is installed.
+
+The manager is only used from the event loop, so it needs no locking.
+"""
+
+import asyncio
+import json
+import statistics
+import time
+from collections import deque
+from typing import Dict, Iterable, List, Optional
+from fastapi import WebSocket
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The channel a connection is subscribed to when it is added without naming one
+DEFAULT_CHANNEL = "public"
+
+# Messages waiting for a connection before it is evicted, and how long one send may take
+SEND_QUEUE_SIZE = 100
+SEND_TIMEOUT_SECONDS = 10
+
+# Close code sent to evicted connections (1013: try again later)
+EVICTED_CLOSE_CODE = 1013
+
+def encode_message(message) -> str:
+    """The JSON text of a message, as send_json() would have sent it"""
+    if orjson is not None:
+        return orjson.dumps(message).decode()
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+class BroadcastMetrics:
+    """Counters and recent timings of broadcasts and deliveries"""
+
+    SAMPLE_SIZE = 1000
+
+    def __init__(self):
+        self.broadcasts = 0
+        self.messages_queued = 0
+        self.messages_sent = 0
+        self.queue_overflows = 0
+        self.send_timeouts = 0
+        self.send_errors = 0
+        self._fanout_ms = deque(maxlen=self.SAMPLE_SIZE)  # Time to enqueue one broadcast for every recipient
+        self._delivery_ms = deque(maxlen=self.SAMPLE_SIZE)  # Time from enqueue until the socket took the message
+
+    def record_broadcast(self, recipients: int, fanout_seconds: float):
+        self.broadcasts += 1
+        self.messages_queued += recipients
+        self._fanout_ms.append(fanout_seconds * 1000)
+
+    def record_delivery(self, delivery_seconds: float):
+        self.messages_sent += 1
+        self._delivery_ms.append(delivery_seconds * 1000)
+
+    @staticmethod
+    def _summary(samples) -> dict:
+        if not samples:
+            return {"p50": None, "p95": None, "max": None}
+        ordered = sorted(samples)
+        return {
+            "p50": round(statistics.median(ordered), 3),
+            "p95": round(ordered[max(0, int(len(ordered) * 0.95) - 1)], 3),
+            "max": round(ordered[-1], 3)
+        }
+
+    def snapshot(self) -> dict:
+        """The counters since startup and timings (ms) of the latest SAMPLE_SIZE events"""
+        return {
+            "broadcasts": self.broadcasts,
+            "messages_queued": self.messages_queued,
+            "messages_sent": self.messages_sent,
+            "queue_overflows": self.queue_overflows,
+            "send_timeouts": self.send_timeouts,
+            "send_errors": self.send_errors,
+            "fanout_ms": self._summary(self._fanout_ms),
+            "delivery_ms": self._summary(self._delivery_ms)
+        }
+
+class Connection:
+    """An open WebSocket and who it belongs to (user is None for guests)"""
+    __slots__ = ("id", "websocket", "user", "channels", "queue", "writer")
+
+    def __init__(self, websocket: WebSocket, user=None):
+        self.id = id(websocket)
+        self.websocket = websocket
+        self.user = user
+        self.channels = set()
+        self.queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)  # (queued_at, JSON text)
+        self.writer: Optional[asyncio.Task] = None
+
+class ConnectionManager:
+    """Open WebSocket connections, indexed by id, user and channel"""
+
+    def __init__(self):
+        self._connections: Dict[int, Connection] = {}
+        self._by_user: Dict[int, Dict[int, Connection]] = {}
+        self._by_channel: Dict[str, Dict[int, Connection]] = {}
+        self.guest_count = 0
+        self.metrics = BroadcastMetrics()
+        self._closing = set()  # Close tasks of evicted connections, kept until they finish
+
+    def __len__(self):
+        return len(self._connections)
+
+    def __contains__(self, connection: Connection):
+        return self._connections.get(connection.id) is connection
+
+    @property
+    def user_count(self) -> int:
+        """Number of distinct signed-in users with at least one connection"""
+        return len(self._by_user)
+
+    def add(self, websocket: WebSocket, user=None, channels: Iterable[str] = (DEFAULT_CHANNEL,)) -> Connection:
+        """Registers a newly accepted WebSocket and returns its connection"""
+        connection = Connection(websocket, user)
+        self._connections[connection.id] = connection
+        if user is None:
+            self.guest_count += 1
+        else:
+            self._by_user.setdefault(user.id, {})[connection.id] = connection
+        for channel in channels:
+            self.subscribe(connection, channel)
+        connection.writer = asyncio.create_task(self._write(connection))
+        return connection
+
+    def remove(self, connection: Connection) -> bool:
+        """Unregisters a connection, returns False if it was already gone"""
+        if connection not in self:
+            return False
+
+        del self._connections[connection.id]
+        if connection.user is None:
+            self.guest_count -= 1
+        else:
+            user_connections = self._by_user[connection.user.id]
+            del user_connections[connection.id]
+            if not user_connections:
+                del self._by_user[connection.user.id]
+        for channel in list(connection.channels):
+            self.unsubscribe(connection, channel)
+        if connection.writer is not None and connection.writer is not asyncio.current_task():
+            connection.writer.cancel()
+            # wait_for() can swallow the cancellation if a send completes at the same moment,
+            # so the writer also stops at the next message it takes from the queue
+            try:
+                connection.queue.put_nowait(None)
+            except asyncio.QueueFull:
+                pass
+        return True
+
+    def send(self, connection: Connection, message) -> bool:
+        """
+        Queues a message (a dict, or JSON text from encode_message) for a connection
+        without waiting for it to be written.
+        A connection whose queue is full is evicted; returns False if the message was not queued.
+        """
+        if connection not in self:
+            return False
+        payload = message if isinstance(message, str) else encode_message(message)
+        try:
+            connection.queue.put_nowait((time.perf_counter(), payload))
+            return True
+        except asyncio.QueueFull:
+            self.metrics.queue_overflows += 1
+            self.evict(connection, "Too many undelivered messages")
+            return False
+
+    def broadcast(self, message: dict, channel: Optional[str] = None) -> int:
+        """Queues a message for every connection, or the subscribers of a channel, returns how many took it"""
+        started = time.perf_counter()
+        payload = encode_message(message)
+        recipients = 0
+        for connection in self.connections() if channel is None else self.channel_connections(channel):
+            if self.send(connection, payload):
+                recipients += 1
+        self.metrics.record_broadcast(recipients, time.perf_counter() - started)
+        return recipients
+
+    def evict(self, connection: Connection, reason: str):
+        """Unregisters a connection that can't keep up and closes its socket in the background"""
+        if self.remove(connection):
+            print(f"[DEBUG] Evicting connection {connection.id}: {reason}")
+            # The event loop only holds tasks weakly
+            task = asyncio.create_task(self._close(connection, reason))
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+
+    async def _close(self, connection: Connection, reason: str):
+        try:
+            await asyncio.wait_for(connection.websocket.close(code=EVICTED_CLOSE_CODE, reason=reason), SEND_TIMEOUT_SECONDS)
+        except Exception:
+            pass
+
+    async def _write(self, connection: Connection):
+        """Writer task of a connection: sends its queued messages in order until it is removed"""
+        while True:
+            item = await connection.queue.get()
+            if item is None or connection not in self:
+                return
+            queued_at, payload = item
+            try:
+                await asyncio.wait_for(connection.websocket.send_text(payload), SEND_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                self.metrics.send_timeouts += 1
+                self.evict(connection, "Send timed out")
+                return
+            except Exception:
+                # The socket is closing, the endpoint removes it when its receive loop ends
+                self.metrics.send_errors += 1
+                self.evict(connection, "Send failed")
+                return
+            self.metrics.record_delivery(time.perf_counter() - queued_at)
+
+    def subscribe(self, connection: Connection, channel: str):
+        connection.channels.add(channel)
+        self._by_channel.setdefault(channel, {})[connection.id] = connection
+
+    def unsubscribe(self, connection: Connection, channel: str):
+        connection.channels.discard(channel)
+        channel_connections = self._by_channel.get(channel)
+        if channel_connections is not None:
+            channel_connections.pop(connection.id, None)
+            if not channel_connections:
+                del self._by_channel[channel]
+
+    def get(self, connection_id: int) -> Optional[Connection]:
+        return self._connections.get(connection_id)
+
+    def connections(self) -> List[Connection]:
+        """A snapshot of every connection, safe to iterate across awaits"""
+        return list(self._connections.values())
+
+    def user_connections(self, user_id: int) -> List[Connection]:
+        """A snapshot of the connections of a user"""
+        return list(self._by_user.get(user_id, {}).values())
+
+    def channel_connections(self, channel: str) -> List[Connection]:
+        """A snapshot of the connections subscribed to a channel"""
+        return list(self._by_channel.get(channel, {}).values())
+
+    def user_ids(self) -> List[int]:
+        """The ids of the signed-in users with at least one connection"""
+        return list(self._by_user)
@@ -1,8 +1,12 @@
 # database.py - This file contains database utilities.
 
 import os
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
 from dotenv import load_dotenv
-from sqlalchemy import create_engine  # Importing SQLAlchemy's engine creation library.
+from sqlalchemy import create_engine, event, inspect, text  # Importing SQLAlchemy's engine creation library.
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base  # For creating base classes for models.
 from sqlalchemy.orm import sessionmaker  # For creating database sessions.
 
@@ -26,11 +30,162 @@ if DB_EXTERNAL_URL:
 else:
     SQLALCHEMY_DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
+# Connection pool settings, the defaults suit a single web worker with the default threadpool
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))  # Seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # Reconnect before the provider drops idle connections
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+
+# PostgreSQL: abort statements running longer than this many milliseconds (0 disables it)
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "30000"))
+
+# SQLite, for single-node installs and local benchmarks (DB_EXTERNAL_URL=sqlite:///cottageware.db)
+DB_SQLITE_JOURNAL_MODE = os.getenv("DB_SQLITE_JOURNAL_MODE", "WAL")
+DB_SQLITE_SYNCHRONOUS = os.getenv("DB_SQLITE_SYNCHRONOUS", "NORMAL")
+DB_SQLITE_MMAP_SIZE = int(os.getenv("DB_SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("DB_SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+def engine_options(url):
+    """
+    Keyword arguments for create_engine() for the given database URL.
+    In-memory SQLite databases keep SQLAlchemy's single-connection pool, so the
+    pool sizing settings only apply to databases with a real connection pool.
+    """
+    url = make_url(url)
+    options = {"pool_pre_ping": DB_POOL_PRE_PING}
+    
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return options
+    
+    options.update(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE
+    )
+    return options
+
+def configure_connection(dbapi_connection, connection_record):
+    """Apply the per-connection settings of the database profile to a new connection"""
+    backend = engine.dialect.name
+    cursor = dbapi_connection.cursor()
+    try:
+        if backend == "sqlite":
+            cursor.execute(f"PRAGMA busy_timeout = {DB_SQLITE_BUSY_TIMEOUT_MS}")
+            cursor.execute(f"PRAGMA journal_mode = {DB_SQLITE_JOURNAL_MODE}")
+            cursor.execute(f"PRAGMA synchronous = {DB_SQLITE_SYNCHRONOUS}")
+            cursor.execute(f"PRAGMA mmap_size = {DB_SQLITE_MMAP_SIZE}")
+        elif backend == "postgresql" and DB_STATEMENT_TIMEOUT_MS > 0:
+            cursor.execute(f"SET statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
+            # Keep the setting out of the first transaction the pool hands out
+            dbapi_connection.commit()
+    finally:
+        cursor.close()
+
+# Subsystem that pooled connections checked out in the current context are counted under,
+# set with counted_as(); main.py sets "http" and "websocket" for each request and socket
+db_subsystem = ContextVar("db_subsystem", default="background")
+
+class PoolCheckouts:
+    """Gauge of the pooled connections checked out by each subsystem, with the peak of each"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checked_out = {}  # subsystem -> connections checked out now
+        self._peak = {}  # subsystem -> most connections checked out at once
+        self._total = {}  # subsystem -> checkouts since startup
+
+    def checkout(self, connection_record):
+        subsystem = db_subsystem.get()
+        connection_record.info["subsystem"] = subsystem
+        with self._lock:
+            checked_out = self._checked_out.get(subsystem, 0) + 1
+            self._checked_out[subsystem] = checked_out
+            self._peak[subsystem] = max(self._peak.get(subsystem, 0), checked_out)
+            self._total[subsystem] = self._total.get(subsystem, 0) + 1
+
+    def checkin(self, connection_record):
+        subsystem = connection_record.info.pop("subsystem", None)
+        if subsystem is None:
+            return
+        with self._lock:
+            self._checked_out[subsystem] -= 1
+
+    def reset_peaks(self):
+        """Starts measuring the peaks again from the current checkouts"""
+        with self._lock:
+            self._peak = dict(self._checked_out)
+
+    def snapshot(self) -> dict:
+        """{subsystem: {"checked_out", "peak", "total"}}"""
+        with self._lock:
+            return {
+                subsystem: {
+                    "checked_out": self._checked_out.get(subsystem, 0),
+                    "peak": self._peak.get(subsystem, 0),
+                    "total": total
+                }
+                for subsystem, total in sorted(self._total.items())
+            }
+
+pool_checkouts = PoolCheckouts()
+
+@contextmanager
+def counted_as(subsystem: str):
+    """Counts the connections checked out within the block (and tasks and threads it starts) under subsystem"""
+    token = db_subsystem.set(subsystem)
+    try:
+        yield
+    finally:
+        db_subsystem.reset(token)
+
 # Creating an engine instance for connecting to the database.
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **engine_options(SQLALCHEMY_DATABASE_URL))
+event.listen(engine, "connect", configure_connection)
+event.listen(engine, "checkout", lambda dbapi_connection, connection_record, connection_proxy: pool_checkouts.checkout(connection_record))
+event.listen(engine, "checkin", lambda dbapi_connection, connection_record: pool_checkouts.checkin(connection_record))
 
 # Creating a session maker instance for managing database sessions.
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # Creating a base class for declarative models (using Alembic).
 Base = declarative_base()
+
+def ensure_columns(table):
+    """
+    Add columns declared on a model that are missing from an existing table.
+    create_all() only creates missing tables, so columns added to existing models
+    are brought in here. Returns the names of the columns that were added.
+    """
+    inspector = inspect(engine)
+    if not inspector.has_table(table.name):
+        return []
+    
+    existing = {column["name"] for column in inspector.get_columns(table.name)}
+    preparer = engine.dialect.identifier_preparer
+    added = []
+    
+    with engine.begin() as connection:
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            
+            ddl = (
+                f"ALTER TABLE {preparer.format_table(table)} "
+                f"ADD COLUMN {preparer.format_column(column)} {column.type.compile(dialect=engine.dialect)}"
+            )
+            if column.server_default is not None:
+                ddl += f" DEFAULT {column.server_default.arg}"
+            connection.execute(text(ddl))
+            added.append(column.name)
+    
+    return added
+
+def ensure_indexes(table):
+    """
+    Create indexes declared on a model that are missing from an existing table.
+    Like ensure_columns, this covers what create_all() skips for existing tables.
+    """
+    for index in table.indexes:
+        index.create(bind=engine, checkfirst=True)
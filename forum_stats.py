@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# forum_stats.py - Maintains the denormalized statistics stored on the forums table
+
+"""
+Forum statistics for CottageWare
+
+Each forum row carries thread_count, post_count, last_post_at and the latest
+thread/author so the forum index never has to walk threads and posts. The
+record_* helpers are called by the write paths inside their own transactions,
+and rebuild_forum_stats() recomputes every forum in bulk.
+"""
+
+import argparse
+from typing import Optional
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from database import SessionLocal
+from models import Forum, Thread, Post
+
+def record_thread_created(db: Session, thread: Thread):
+    """Count a new thread (and its opening post) against its forum"""
+    db.query(Forum).filter(Forum.id == thread.forum_id).update({
+        Forum.thread_count: Forum.thread_count + 1,
+        Forum.post_count: Forum.post_count + 1,
+        Forum.last_post_at: thread.created_at,
+        Forum.latest_thread_id: thread.id,
+        Forum.latest_thread_author_id: thread.author_id
+    }, synchronize_session=False)
+
+def record_post_created(db: Session, thread: Thread, post: Post):
+    """Count a new reply against the forum of its thread"""
+    db.query(Forum).filter(Forum.id == thread.forum_id).update({
+        Forum.post_count: Forum.post_count + 1,
+        Forum.last_post_at: post.created_at
+    }, synchronize_session=False)
+
+def forget_author(db: Session, user_id: int):
+    """Drop a deleted user from the latest thread author of every forum"""
+    db.query(Forum).filter(Forum.latest_thread_author_id == user_id).update({
+        Forum.latest_thread_author_id: None
+    }, synchronize_session=False)
+
+def refresh_forum_stats(db: Session, forum_id: int):
+    """
+    Recompute the statistics of a single forum.
+    Used after deletions, where a simple decrement could leave a stale latest thread.
+    """
+    rebuild_forum_stats(db, forum_id)
+
+def rebuild_forum_stats(db: Session, forum_id: Optional[int] = None):
+    """
+    Recompute the statistics of every forum (or just forum_id) with grouped queries.
+    Runs a fixed number of queries regardless of how many threads and posts exist.
+
+    Returns:
+        int: The number of forums updated
+    """
+    forum_query = db.query(Forum.id)
+    thread_query = db.query(
+        Thread.forum_id,
+        func.count(Thread.id),
+        func.max(Thread.created_at)
+    )
+    post_query = db.query(
+        Thread.forum_id,
+        func.count(Post.id),
+        func.max(Post.created_at)
+    ).join(Post, Post.thread_id == Thread.id)
+
+    # Newest thread in each forum, ties broken by id
+    latest_rank = func.row_number().over(
+        partition_by=Thread.forum_id,
+        order_by=(Thread.created_at.desc(), Thread.id.desc())
+    ).label("rank")
+    latest_subquery = db.query(
+        Thread.forum_id,
+        Thread.id,
+        Thread.author_id,
+        latest_rank
+    )
+
+    if forum_id is not None:
+        forum_query = forum_query.filter(Forum.id == forum_id)
+        thread_query = thread_query.filter(Thread.forum_id == forum_id)
+        post_query = post_query.filter(Thread.forum_id == forum_id)
+        latest_subquery = latest_subquery.filter(Thread.forum_id == forum_id)
+
+    latest_subquery = latest_subquery.subquery()
+
+    thread_stats = {
+        row[0]: (row[1], row[2])
+        for row in thread_query.group_by(Thread.forum_id).all()
+    }
+    post_stats = {
+        row[0]: (row[1], row[2])
+        for row in post_query.group_by(Thread.forum_id).all()
+    }
+    latest_threads = {
+        row[0]: (row[1], row[2])
+        for row in db.query(
+            latest_subquery.c.forum_id,
+            latest_subquery.c.id,
+            latest_subquery.c.author_id
+        ).filter(latest_subquery.c.rank == 1).all()
+    }
+
+    mappings = []
+    for (current_forum_id,) in forum_query.all():
+        thread_count, last_thread_at = thread_stats.get(current_forum_id, (0, None))
+        reply_count, last_reply_at = post_stats.get(current_forum_id, (0, None))
+        latest_thread_id, latest_author_id = latest_threads.get(current_forum_id, (None, None))
+
+        timestamps = [ts for ts in (last_thread_at, last_reply_at) if ts is not None]
+        mappings.append({
+            "id": current_forum_id,
+            "thread_count": thread_count,
+            "post_count": thread_count + reply_count,
+            "last_post_at": max(timestamps) if timestamps else None,
+            "latest_thread_id": latest_thread_id,
+            "latest_thread_author_id": latest_author_id
+        })
+
+    if mappings:
+        db.bulk_update_mappings(Forum, mappings)
+
+    return len(mappings)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the denormalized forum statistics")
+    parser.add_argument("-f", "--forum", type=int, help="ID of a single forum to rebuild (default: all forums)")
+
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        updated = rebuild_forum_stats(db, args.forum)
+        db.commit()
+        print(f"Success: Rebuilt statistics for {updated} forum(s)")
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        db.rollback()
+    finally:
+        db.close()
@@ -0,0 +1,199 @@
+# login_throttle.py - Sliding-window limits on login and registration attempts
+
+"""
+Login throttling for CottageWare
+
+Every login, /token request and registration costs a bcrypt call (see
+passwords.py). The security settings login_attempts and lockout_time now cap
+them: within any lockout_time window,
+
+- a username may fail login_attempts logins,
+- an address may fail login_attempts * LOGIN_THROTTLE_IP_MULTIPLIER logins
+  (addresses are often shared), and
+- an address may register login_attempts accounts.
+
+Requests over a limit are rejected before any password is hashed, with the
+number of seconds until the oldest attempt leaves the window. A successful
+login clears the failures of its username.
+
+Attempts are kept in this process by default. With LOGIN_THROTTLE_BACKEND set
+to "database" they go in the throttle_hits table instead, so every worker
+shares the same counts. throttle_stats() reports how many checks were made
+and how many were shed.
+"""
+
+import os
+import threading
+import time
+from collections import Counter, deque
+from typing import Iterable, Optional
+from sqlalchemy import func
+from database import SessionLocal
+from models import ThrottleHit
+
+LOGIN_THROTTLE_BACKEND = os.getenv("LOGIN_THROTTLE_BACKEND", "memory")
+LOGIN_THROTTLE_IP_MULTIPLIER = int(os.getenv("LOGIN_THROTTLE_IP_MULTIPLIER", "4"))
+
+# Keys kept by the in-memory store before expired ones are swept out
+MEMORY_STORE_SWEEP_SIZE = 10000
+
+# How often the database store deletes the expired attempts of every key, when it records one
+DATABASE_STORE_SWEEP_SECONDS = 60
+
+class MemoryHitStore:
+    """Attempt times per key, kept in this process"""
+
+    def __init__(self):
+        self._hits = {}  # key -> deque of attempt times, oldest first
+        self._lock = threading.Lock()
+
+    def _prune(self, key: str, since: float):
+        hits = self._hits.get(key)
+        while hits and hits[0] <= since:
+            hits.popleft()
+        if hits is not None and not hits:
+            del self._hits[key]
+        return hits
+
+    def window(self, key: str, since: float):
+        """Returns (count, oldest) of the attempts after `since`"""
+        with self._lock:
+            hits = self._prune(key, since)
+            if not hits:
+                return 0, None
+            return len(hits), hits[0]
+
+    def add(self, key: str, now: float, since: float):
+        """Records an attempt, forgetting the ones at or before `since`"""
+        with self._lock:
+            self._prune(key, since)
+            self._hits.setdefault(key, deque()).append(now)
+            if len(self._hits) > MEMORY_STORE_SWEEP_SIZE:
+                for stale_key in list(self._hits):
+                    self._prune(stale_key, since)
+
+    def clear(self, key: str):
+        with self._lock:
+            self._hits.pop(key, None)
+
+class DatabaseHitStore:
+    """Attempt times per key in the throttle_hits table, shared by every worker"""
+
+    def __init__(self):
+        self._swept_at = 0.0
+        self._sweep_lock = threading.Lock()
+
+    def _sweep_due(self, now: float) -> bool:
+        """Whether this worker should sweep out the expired attempts of keys that aren't hit again"""
+        with self._sweep_lock:
+            if now - self._swept_at < DATABASE_STORE_SWEEP_SECONDS:
+                return False
+            self._swept_at = now
+            return True
+
+    def window(self, key: str, since: float):
+        with SessionLocal() as db:
+            count, oldest = db.query(func.count(ThrottleHit.id), func.min(ThrottleHit.hit_at)) \
+                .filter(ThrottleHit.key == key, ThrottleHit.hit_at > since).one()
+        return count, oldest
+
+    def add(self, key: str, now: float, since: float):
+        with SessionLocal() as db:
+            if self._sweep_due(now):
+                # Every key shares the same window, so this clears one-off addresses and usernames too
+                db.query(ThrottleHit).filter(ThrottleHit.hit_at <= since).delete(synchronize_session=False)
+            else:
+                db.query(ThrottleHit).filter(ThrottleHit.key == key, ThrottleHit.hit_at <= since) \
+                    .delete(synchronize_session=False)
+            db.add(ThrottleHit(key=key, hit_at=now))
+            db.commit()
+
+    def clear(self, key: str):
+        with SessionLocal() as db:
+            db.query(ThrottleHit).filter(ThrottleHit.key == key).delete(synchronize_session=False)
+            db.commit()
+
+_store = DatabaseHitStore() if LOGIN_THROTTLE_BACKEND == "database" else MemoryHitStore()
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+def _limits():
+    """Returns (login_attempts, window in seconds) from the security settings"""
+    # Imported here because admin.py imports this module
+    from admin import get_site_setting
+    return int(get_site_setting("security", "login_attempts")), int(get_site_setting("security", "lockout_time")) * 60
+
+def _count(name: str):
+    with _stats_lock:
+        _stats[name] += 1
+
+def _retry_after(limits: Iterable, window: int) -> Optional[int]:
+    """Seconds until every (key, limit) pair is back under its limit, or None if none is over"""
+    now = time.time()
+    waits = []
+    for key, limit in limits:
+        count, oldest = _store.window(key, now - window)
+        if count >= limit:
+            waits.append(max(1, int(oldest + window - now) + 1))
+    return max(waits) if waits else None
+
+def _ip_key(ip: Optional[str]) -> str:
+    return f"ip:{ip or 'unknown'}"
+
+def _user_key(username: str) -> str:
+    return f"user:{username.strip().lower()}"
+
+def check_login(ip: Optional[str], username: str) -> Optional[int]:
+    """
+    Checks a login attempt against the limits before its password is verified.
+    Returns None if it may go ahead, otherwise the seconds to wait.
+    """
+    attempts, window = _limits()
+    _count("login_checked")
+    retry_after = _retry_after([
+        ("login-" + _user_key(username), attempts),
+        ("login-" + _ip_key(ip), attempts * LOGIN_THROTTLE_IP_MULTIPLIER)
+    ], window)
+    if retry_after is not None:
+        _count("login_shed")
+    return retry_after
+
+def record_login_failure(ip: Optional[str], username: str):
+    """Counts a failed login against its username and address"""
+    _, window = _limits()
+    now = time.time()
+    _store.add("login-" + _user_key(username), now, now - window)
+    _store.add("login-" + _ip_key(ip), now, now - window)
+
+def record_login_success(username: str):
+    """Clears the failed logins of a username"""
+    _store.clear("login-" + _user_key(username))
+
+def check_registration(ip: Optional[str]) -> Optional[int]:
+    """
+    Checks a registration against the limits before its password is hashed.
+    Returns None if it may go ahead, otherwise the seconds to wait.
+    """
+    attempts, window = _limits()
+    _count("register_checked")
+    retry_after = _retry_after([("register-" + _ip_key(ip), attempts)], window)
+    if retry_after is not None:
+        _count("register_shed")
+    return retry_after
+
+def record_registration(ip: Optional[str]):
+    """Counts a registration against its address"""
+    _, window = _limits()
+    now = time.time()
+    _store.add("register-" + _ip_key(ip), now, now - window)
+
+def throttle_stats() -> dict:
+    """Checks made and attempts shed since the process started"""
+    with _stats_lock:
+        return {
+            "login_checked": _stats["login_checked"],
+            "login_shed": _stats["login_shed"],
+            "register_checked": _stats["register_checked"],
+            "register_shed": _stats["register_shed"]
+        }
@@ -3,6 +3,7 @@
 from fastapi import FastAPI, Request, Form, Depends, HTTPException, status, Cookie, WebSocket, WebSocketDisconnect, File, UploadFile
 import asyncio
 import time
+import math
 from jose import JWTError, jwt
 from auth import SECRET_KEY, ALGORITHM
 from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, FileResponse
@@ -11,6 +12,7 @@ from fastapi.templating import Jinja2Templates
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 import sqlalchemy.orm
 from typing import List, Optional
@@ -25,57 +27,44 @@ from pathlib import Path
 from dotenv import load_dotenv
 
 # Import models and database
-from models import User, Role, Category, Forum, Thread, Post, Shoutbox, UserProfile, ThreadView, Product
-from database import SessionLocal, engine, Base
+from models import User, Role, Category, Forum, Thread, Post, UserProfile, Product
+from database import SessionLocal, engine, Base, ensure_columns, ensure_indexes, counted_as, pool_checkouts
+from forum_stats import record_thread_created, record_post_created, refresh_forum_stats, rebuild_forum_stats
 
 # Import admin functionality
 from admin import (
     admin_dashboard, user_list, user_form, user_toggle, user_delete, user_save, forum_management, category_form, forum_form, 
                 category_save, forum_save, site_settings, settings_save, admin_required, thread_list, thread_delete,
-                thread_toggle_sticky, product_list, product_form, product_save, product_delete, product_toggle_featured
+                thread_toggle_sticky, product_list, product_form, product_save, product_delete, product_toggle_featured,
+                get_site_setting
 )
 
 # Import authentication functions
 from auth import (
-    authenticate_user, create_access_token, get_current_active_user, 
+    authenticate_user, create_user_token, get_current_active_user, 
     get_optional_user, google_sso, get_or_create_oauth_user, create_user,
     get_password_hash, ACCESS_TOKEN_EXPIRE_MINUTES
 )
 
 # Import utility functions
-from utils import validate_discord_username, validate_display_name, filter_offensive_content, render_markdown
-
-# Import requests for reCAPTCHA verification
-import requests
-import urllib.parse
+from utils import validate_discord_username, validate_display_name, filter_offensive_content, rendered_html, decode_cursor
+from rendered_content import rerender_stale_content_in_background
+from author_cards import get_author_cards, invalidate_author_card
+from principals import invalidate_principal, revoke_claims
+from passwords import PasswordHashingBusy, shutdown_password_pool
+import queries
+from thread_views import record_thread_view, flush_thread_views, flush_thread_views_periodically
+from login_throttle import check_login, record_login_failure, record_login_success, check_registration, record_registration
+from connection_manager import ConnectionManager, DEFAULT_CHANNEL
+from presence import Presence, user_card
+from pubsub import create_pubsub
+from shoutbox_writer import ShoutboxWriter
+from shoutbox_history import ShoutboxHistory, format_message_time
+from turnstile import TURNSTILE_SITE_KEY, verify_turnstile, close_client as close_turnstile_client
 
 # Load environment variables
 load_dotenv()
 
-# Cloudflare Turnstile configuration
-TURNSTILE_SITE_KEY = os.getenv('TURNSTILE_SITE_KEY', '')
-TURNSTILE_SECRET_KEY = os.getenv('TURNSTILE_SECRET_KEY', '')
-
-# Cloudflare Turnstile verification function
-def verify_turnstile(turnstile_response):
-    """Verify Cloudflare Turnstile response"""
-    if not TURNSTILE_SECRET_KEY or not turnstile_response:
-        # If no secret key is configured or no response provided, skip verification in development
-        return True
-        
-    data = {
-        'secret': TURNSTILE_SECRET_KEY,
-        'response': turnstile_response
-    }
-    
-    try:
-        resp = requests.post('https://challenges.cloudflare.com/turnstile/v0/siteverify', data=data)
-        result = resp.json()
-        return result.get('success', False)
-    except Exception as e:
-        print(f"Turnstile verification error: {e}")
-        return False
-
 # Creating a new FastAPI instance
 app = FastAPI(debug=True, title="CottageWare")
 
@@ -88,6 +77,21 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class CountPoolCheckouts:
+    """Counts the pooled connections checked out for requests and WebSockets under "http" and "websocket" """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+        with counted_as(scope["type"]):
+            await self.app(scope, receive, send)
+
+app.add_middleware(CountPoolCheckouts)
+
 # Mounting static files at /static route
 app.mount("/static", StaticFiles(directory="static"), name="static")
 # Content is now inside static directory
@@ -97,10 +101,72 @@ os.makedirs(os.path.join("static", "uploads", "profile-pics"), exist_ok=True)
 
 # Initializing Jinja2Templates for templating
 templates = Jinja2Templates(directory="templates")
+templates.env.filters["rendered"] = rendered_html
+templates.env.filters["message_time"] = format_message_time
 
 # Creating all tables in the database
 Base.metadata.create_all(bind=engine)
 
+# Add forum statistics columns to existing databases and backfill them once
+if ensure_columns(Forum.__table__):
+    with SessionLocal() as stats_db:
+        rebuild_forum_stats(stats_db)
+        stats_db.commit()
+ensure_indexes(Thread.__table__)
+ensure_indexes(Post.__table__)
+
+# Add rendered HTML columns to existing databases, they are filled in by the background task below
+for rendered_model in (Thread, Post, UserProfile, Product):
+    ensure_columns(rendered_model.__table__)
+
+# Add the token version used by access token claims to existing databases
+ensure_columns(User.__table__)
+
+@app.on_event("startup")
+async def start_background_rendering():
+    """Re-render stored HTML that is missing or from an older renderer version"""
+    # Keep a reference, the event loop only holds tasks weakly
+    app.state.rerender_task = asyncio.create_task(rerender_stale_content_in_background())
+
+@app.on_event("shutdown")
+async def stop_background_rendering():
+    """Stop re-rendering, the rows left are picked up on the next start"""
+    task = app.state.rerender_task
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+@app.on_event("startup")
+async def start_view_flushing():
+    """Write thread views recorded by read_thread every few seconds"""
+    app.state.view_flush_task = asyncio.create_task(flush_thread_views_periodically())
+
+@app.on_event("shutdown")
+async def flush_pending_views():
+    """Stop the periodic flush, then write the thread views recorded since the last one"""
+    task = app.state.view_flush_task
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    try:
+        await run_in_threadpool(flush_thread_views)
+    except Exception as e:
+        print(f"Error flushing thread views on shutdown: {e}")
+
+@app.on_event("shutdown")
+async def close_turnstile_connections():
+    """Close the keep-alive connections used for Turnstile verification"""
+    await close_turnstile_client()
+
+@app.on_event("shutdown")
+def stop_password_workers():
+    """Stop the processes that hash and verify passwords"""
+    shutdown_password_pool()
+
 # Cloudflare Turnstile verification and Email functions removed
 
 # Route for robots.txt
@@ -163,7 +229,8 @@ async def http_exception_handler(request: Request, exc: HTTPException):
             "error_details": None,
             "current_user": None
         },
-        status_code=exc.status_code
+        status_code=exc.status_code,
+        headers=getattr(exc, "headers", None)
     )
 
 # Dependency to get the DB session
@@ -176,38 +243,21 @@ def get_db():
 
 # Defining a route for the home page
 @app.get("/", response_class=HTMLResponse)
-async def read_home(request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
+def read_home(request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
     """
     Handles GET requests to the root URL (/).
     """
-    # Get latest threads for the home page
-    latest_threads = db.query(Thread).order_by(Thread.created_at.desc()).limit(5).all()
-    
     # Get Sell.app configuration for the featured product
     sellapp_store_id = os.getenv("SELLAPP_STORE_ID", "60377")
     
-    # Get featured products from database
-    featured_products = db.query(Product).filter(Product.is_featured == True).all()
-    
-    # Process featured products with markdown and truncate descriptions
-    for product in featured_products:
-        if product.description:
-            product.full_description_html = render_markdown(product.description)
-            # Create a truncated version for display
-            if len(product.description) > 250:
-                product.short_description = product.description[:250] + "..."
-            else:
-                product.short_description = product.description
-            product.short_description_html = render_markdown(product.short_description)
-    
+    # Get latest threads and featured products (descriptions are rendered when saved)
     return templates.TemplateResponse(
         "index.html", 
         {
             "request": request, 
             "current_user": current_user,
-            "latest_threads": latest_threads,
             "sellapp_store_id": sellapp_store_id,
-            "featured_products": featured_products
+            **queries.home_page(db)
         }
     )
 
@@ -264,7 +314,7 @@ async def contact_us_redirect(request: Request):
 
 # Health check endpoint
 @app.get("/health")
-async def health_check(db: Session = Depends(get_db)):
+def health_check(db: Session = Depends(get_db)):
     """
     Health check endpoint for monitoring service availability.
     Verifies database connectivity and returns 200 OK if the service is healthy.
@@ -283,40 +333,25 @@ async def health_check(db: Session = Depends(get_db)):
 
 # Defining a route for the forum page
 @app.get("/forum", response_class=HTMLResponse)
-async def read_forum(request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
+def read_forum(request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
     """
     Handles GET requests to the /forum URL.
     """
-    # Get public categories with forums
-    categories = db.query(Category).filter(Category.is_public == True).order_by(Category.order).all()
-    
-    # Filter forums based on user's access level
-    for category in categories:
-        # Filter forums that the user can access and are public
-        category.forums = [forum for forum in category.forums if forum.can_access(current_user) and forum.is_public]
-    
-    # Filter out empty categories
-    categories = [category for category in categories if category.forums]
+    # Get public categories with the forums the user can access and recent threads
+    forum_index = queries.forum_index(db, current_user, public=True)
     
-    # Get recent threads
-    recent_threads = db.query(Thread).order_by(Thread.created_at.desc()).limit(5).all()
-    # Get shoutbox messages with user information (only public messages)
-    shoutbox_messages = db.query(Shoutbox).join(User, User.id == Shoutbox.user_id) \
-        .filter(Shoutbox.shoutbox_type == "public") \
-        .order_by(Shoutbox.created_at.desc()).limit(10).all()
-    
-    # Get online users count (actual list will be updated via WebSocket)
-    online_users_count = len(set(conn["user"].id for conn in active_connections if conn["user"] is not None))
-    guest_count = sum(1 for conn in active_connections if conn["user"] is None)
+    # Get online users count across all workers (actual list will be updated via WebSocket)
+    online_counts = presence.counts()
+    online_users_count = online_counts["registered_count"]
+    guest_count = online_counts["guest_count"]
     
     return templates.TemplateResponse(
         "forum.html", 
         {
             "request": request, 
             "current_user": current_user,
-            "categories": categories,
-            "recent_threads": recent_threads,
-            "shoutbox_messages": shoutbox_messages,
+            **forum_index,
+            "shoutbox_messages": shoutbox_history.recent("public"),
             "online_users_count": online_users_count,
             "guest_count": guest_count,
             "total_online": online_users_count + guest_count
@@ -325,7 +360,7 @@ async def read_forum(request: Request, db: Session = Depends(get_db), current_us
 
 # Route for the private forum page
 @app.get("/forum/private", response_class=HTMLResponse)
-async def read_private_forum(request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
+def read_private_forum(request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
     """
     Handles GET requests to the /forum/private URL.
     """
@@ -333,36 +368,21 @@ async def read_private_forum(request: Request, db: Session = Depends(get_db), cu
     if not current_user or not current_user.profile or current_user.profile.account_tier < 2:
         return RedirectResponse(url="/forum", status_code=303)
     
-    # Get private categories with forums (not public or private-specific categories)
-    categories = db.query(Category).filter(Category.is_public == False).order_by(Category.order).all()
-    
-    # Filter forums based on user's access level
-    for category in categories:
-        # Filter forums that the user can access and are private
-        category.forums = [forum for forum in category.forums if forum.can_access(current_user) and not forum.is_public]
-    
-    # Filter out empty categories
-    categories = [category for category in categories if category.forums]
+    # Get private categories with the forums the user can access and recent threads
+    forum_index = queries.forum_index(db, current_user, public=False)
     
-    # Get recent threads
-    recent_threads = db.query(Thread).order_by(Thread.created_at.desc()).limit(5).all()
-    # Get shoutbox messages with user information (only private messages)
-    shoutbox_messages = db.query(Shoutbox).join(User, User.id == Shoutbox.user_id) \
-        .filter(Shoutbox.shoutbox_type == "private") \
-        .order_by(Shoutbox.created_at.desc()).limit(10).all()
-    
-    # Get online users count (actual list will be updated via WebSocket)
-    online_users_count = len(set(conn["user"].id for conn in active_connections if conn["user"] is not None))
-    guest_count = sum(1 for conn in active_connections if conn["user"] is None)
+    # Get online users count across all workers (actual list will be updated via WebSocket)
+    online_counts = presence.counts()
+    online_users_count = online_counts["registered_count"]
+    guest_count = online_counts["guest_count"]
     
     return templates.TemplateResponse(
         "forum_private.html", 
         {
             "request": request, 
             "current_user": current_user,
-            "categories": categories,
-            "recent_threads": recent_threads,
-            "shoutbox_messages": shoutbox_messages,
+            **forum_index,
+            "shoutbox_messages": shoutbox_history.recent("private"),
             "online_users_count": online_users_count,
             "guest_count": guest_count,
             "total_online": online_users_count + guest_count
@@ -371,16 +391,19 @@ async def read_private_forum(request: Request, db: Session = Depends(get_db), cu
 
 # Route for viewing a specific forum
 @app.get("/forum/{forum_id}", response_class=HTMLResponse)
-async def read_forum_detail(forum_id: int, request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
+def read_forum_detail(forum_id: int, request: Request, after: Optional[str] = None, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
     """
     Handles GET requests to view a specific forum.
+    Threads are paginated with a keyset cursor over (is_sticky, updated_at, id).
     """
     forum = db.query(Forum).filter(Forum.id == forum_id).first()
     if not forum:
         raise HTTPException(status_code=404, detail="Forum not found")
     
-    # Get threads in this forum
-    threads = db.query(Thread).filter(Thread.forum_id == forum_id).order_by(Thread.is_sticky.desc(), Thread.updated_at.desc()).all()
+    threads_per_page = get_site_setting("forum", "threads_per_page")
+    # A cursor with values of the wrong types is ignored and the first page is shown
+    cursor = decode_cursor(after, 3, types=((bool, type(None)), datetime, int))
+    threads, next_cursor = queries.forum_threads_page(db, forum_id, cursor, threads_per_page)
     
     return templates.TemplateResponse(
         "forum_detail.html", 
@@ -388,17 +411,28 @@ async def read_forum_detail(forum_id: int, request: Request, db: Session = Depen
             "request": request, 
             "current_user": current_user,
             "forum": forum,
-            "threads": threads
+            "threads": threads,
+            "thread_stats": queries.get_thread_reply_stats(db, [thread.id for thread in threads]),
+            "is_first_page": cursor is None,
+            "next_cursor": next_cursor
         }
     )
 
+def get_post_url(db: Session, post: Post, current_user: Optional[User]):
+    """Get the URL of the thread page holding a post, anchored to the post"""
+    posts_query = queries.visible_posts_query(db, post.thread, current_user)
+    cursor = queries.get_post_page_cursor(posts_query, post, get_site_setting("forum", "posts_per_page"))
+    page_query = f"?after={cursor}" if cursor else ""
+    return f"/thread/{post.thread_id}{page_query}#post-{post.id}"
+
 # Route for viewing a specific thread
 @app.get("/thread/{thread_id}", response_class=HTMLResponse)
-async def read_thread(thread_id: int, request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
+def read_thread(thread_id: int, request: Request, after: Optional[str] = None, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
     """
     Handles GET requests to view a specific thread.
+    Replies are paginated with a keyset cursor over (created_at, id).
     """
-    thread = db.query(Thread).filter(Thread.id == thread_id).first()
+    thread = queries.thread_page(db, thread_id)
     if not thread:
         raise HTTPException(status_code=404, detail="Thread not found")
         
@@ -406,63 +440,22 @@ async def read_thread(thread_id: int, request: Request, db: Session = Depends(ge
     if not thread.forum.can_access(current_user):
         raise HTTPException(status_code=403, detail="You don't have permission to view this thread")
     
-    # Only increment view count if this is a new view for this user
-    if current_user:
-        # Check if the user has already viewed this thread
-        existing_view = db.query(ThreadView).filter(
-            ThreadView.thread_id == thread_id,
-            ThreadView.user_id == current_user.id
-        ).first()
-        
-        if not existing_view:
-            # This is a new view, increment count and record the view
-            thread.views += 1
-            
-            # Record that this user has viewed this thread
-            thread_view = ThreadView(
-                thread_id=thread_id,
-                user_id=current_user.id
-            )
-            db.add(thread_view)
-            db.commit()
-        else:
-            # Update the viewed_at timestamp for returning viewers
-            existing_view.viewed_at = datetime.now()
-            db.commit()
-    else:
-        # For guests, always increment the view count
-        thread.views += 1
-        db.commit()
+    # Count the view, it is written to the database in the background with other views
+    record_thread_view(thread_id, current_user.id if current_user else None)
     
-    # Get posts in this thread
-    posts = db.query(Post).filter(Post.thread_id == thread_id).order_by(Post.created_at).all()
+    posts_per_page = get_site_setting("forum", "posts_per_page")
     
-    # If the user doesn't have required access level (for private forum threads),
-    # hide posts that they shouldn't see
-    filtered_posts = []
-    for post in posts:
-        if post.author_id == current_user.id if current_user else False:
-            # Users can always see their own posts
-            filtered_posts.append(post)
-        elif thread.forum.is_public or (current_user and current_user.profile and current_user.profile.account_tier >= thread.forum.access_level):
-            # Add post if the forum is public or user has appropriate access level
-            filtered_posts.append(post)
+    # Only query the posts this user may see, one page at a time
+    posts_query = queries.visible_posts_query(db, thread, current_user)
+    # A cursor with values of the wrong types is ignored and the first page is shown
+    cursor = decode_cursor(after, 2, types=(datetime, int))
+    posts, next_cursor = queries.thread_posts_page(posts_query, cursor, posts_per_page)
     
-    # Use filtered posts instead of all posts
-    posts = filtered_posts
+    reply_count = posts_query.count()
+    last_page_cursor = queries.get_last_page_cursor(posts_query, reply_count, posts_per_page) if next_cursor else None
     
-    # Render markdown for thread content and post content
-    thread.content = render_markdown(thread.content)
-    
-    # Process signatures
-    if thread.author.profile and thread.author.profile.signature:
-        thread.author.profile.signature = render_markdown(thread.author.profile.signature)
-    
-    # Process posts content
-    for post in posts:
-        post.content = render_markdown(post.content)
-        if post.author.profile and post.author.profile.signature:
-            post.author.profile.signature = render_markdown(post.author.profile.signature)
+    # Author sidebars and signatures, one cached card per distinct author
+    author_cards = get_author_cards(db, [thread.author_id] + [post.author_id for post in posts])
     
     return templates.TemplateResponse(
         "thread.html", 
@@ -471,13 +464,29 @@ async def read_thread(thread_id: int, request: Request, db: Session = Depends(ge
             "current_user": current_user,
             "thread": thread,
             "posts": posts,
-            "reply_count": len(posts) - 1 if len(posts) > 0 else 0
+            "author_cards": author_cards,
+            "reply_count": reply_count,
+            "is_first_page": cursor is None,
+            "next_cursor": next_cursor,
+            "last_page_cursor": last_page_cursor
         }
     )
 
+# Permalink for a post
+@app.get("/post/{post_id}")
+def read_post(post_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
+    """
+    Redirects to the thread page holding a post.
+    """
+    post = queries.post_with_thread(db, post_id)
+    if not post:
+        raise HTTPException(status_code=404, detail="Post not found")
+    
+    return RedirectResponse(url=get_post_url(db, post, current_user), status_code=303)
+
 # Route for creating a new thread
 @app.get("/forum/{forum_id}/new-thread", response_class=HTMLResponse)
-async def new_thread_form(forum_id: int, request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
+def new_thread_form(forum_id: int, request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
     """
     Displays the form to create a new thread.
     """
@@ -485,7 +494,7 @@ async def new_thread_form(forum_id: int, request: Request, db: Session = Depends
     if not current_user:
         return RedirectResponse(url=f"/login?next=/forum/{forum_id}/new-thread", status_code=303)
     
-    forum = db.query(Forum).filter(Forum.id == forum_id).first()
+    forum = queries.forum_with_category(db, forum_id)
     if not forum:
         raise HTTPException(status_code=404, detail="Forum not found")
     
@@ -504,7 +513,7 @@ async def new_thread_form(forum_id: int, request: Request, db: Session = Depends
 
 # Route for submitting a new thread
 @app.post("/forum/{forum_id}/new-thread")
-async def create_thread(forum_id: int, title: str = Form(...), content: str = Form(...), db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
+def create_thread(forum_id: int, title: str = Form(...), content: str = Form(...), db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
     """
     Handles POST requests to create a new thread.
     """
@@ -535,8 +544,11 @@ async def create_thread(forum_id: int, title: str = Form(...), content: str = Fo
         created_at=datetime.now(),
         updated_at=datetime.now()
     )
+    new_thread.render_html()
     
     db.add(new_thread)
+    db.flush()
+    record_thread_created(db, new_thread)
     db.commit()
     db.refresh(new_thread)
     
@@ -544,41 +556,56 @@ async def create_thread(forum_id: int, title: str = Form(...), content: str = Fo
 
 # Admin Panel Routes
 @app.get("/admin", response_class=HTMLResponse)
-async def admin_home(request: Request, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
+def admin_home(request: Request, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
     """Admin dashboard page"""
-    template_data = await admin_dashboard(request, db, current_user)
+    template_data = admin_dashboard(request, db, current_user)
     return templates.TemplateResponse("admin/dashboard.html", template_data)
 
+@app.get("/admin/websocket/stats")
+def admin_websocket_stats(current_user: User = Depends(admin_required())):
+    """Open WebSocket connections, broadcast delivery metrics, shoutbox write batches and pooled connections by subsystem"""
+    return JSONResponse(content={
+        "connections": len(connection_manager),
+        "users": connection_manager.user_count,
+        "guests": connection_manager.guest_count,
+        **connection_manager.metrics.snapshot(),
+        "shoutbox_writes": shoutbox_writer.metrics.snapshot(),
+        "db_pool": {
+            "checked_out": engine.pool.checkedout(),
+            "subsystems": pool_checkouts.snapshot()
+        }
+    })
+
 @app.get("/admin/users", response_class=HTMLResponse)
-async def admin_users(request: Request, page: int = 1, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
+def admin_users(request: Request, page: int = 1, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
     """Admin users list page"""
-    template_data = await user_list(request, db, current_user, page)
+    template_data = user_list(request, db, current_user, page)
     return templates.TemplateResponse("admin/users.html", template_data)
 
 @app.get("/admin/users/new", response_class=HTMLResponse)
-async def admin_new_user(request: Request, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
+def admin_new_user(request: Request, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
     """Admin new user form"""
-    template_data = await user_form(request, db, current_user)
+    template_data = user_form(request, db, current_user)
     return templates.TemplateResponse("admin/user_form.html", template_data)
 
 @app.get("/admin/users/{user_id}/edit", response_class=HTMLResponse)
-async def admin_edit_user(request: Request, user_id: int, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
+def admin_edit_user(request: Request, user_id: int, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
     """Admin edit user form"""
-    template_data = await user_form(request, db, current_user, user_id)
+    template_data = user_form(request, db, current_user, user_id)
     return templates.TemplateResponse("admin/user_form.html", template_data)
 
 @app.get("/admin/users/{user_id}/toggle")
-async def admin_toggle_user(user_id: int, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
+def admin_toggle_user(user_id: int, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
     """Toggle user active status"""
-    return await user_toggle(db, current_user, user_id)
+    return user_toggle(db, current_user, user_id)
 
 @app.get("/admin/users/{user_id}/delete")
-async def admin_delete_user(user_id: int, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
+def admin_delete_user(user_id: int, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
     """Delete a user"""
-    return await user_delete(db, current_user, user_id)
+    return user_delete(db, current_user, user_id)
 
 @app.post("/admin/users/save")
-async def admin_save_user(
+def admin_save_user(
     request: Request,
     username: str = Form(...),
     email: str = Form(...),
@@ -607,41 +634,41 @@ async def admin_save_user(
         'is_active': is_active,
         'user_id': user_id
     }
-    return await user_save(db, current_user, form_data, avatar)
+    return user_save(db, current_user, form_data, avatar)
 
 # Forum Management Routes
 @app.get("/admin/forums", response_class=HTMLResponse)
-async def admin_forums(request: Request, tab: str = "categories", page: int = 1, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
+def admin_forums(request: Request, tab: str = "categories", page: int = 1, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
     """Admin forums management page"""
-    template_data = await forum_management(request, db, current_user, tab, page)
+    template_data = forum_management(request, db, current_user, tab, page)
     return templates.TemplateResponse("admin/forums.html", template_data)
 
 @app.get("/admin/forums/categories/new", response_class=HTMLResponse)
-async def admin_new_category(request: Request, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
+def admin_new_category(request: Request, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
     """Admin new category form"""
-    template_data = await category_form(request, db, current_user)
+    template_data = category_form(request, db, current_user)
     return templates.TemplateResponse("admin/category_form.html", template_data)
 
 @app.get("/admin/forums/categories/{category_id}/edit", response_class=HTMLResponse)
-async def admin_edit_category(request: Request, category_id: int, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
+def admin_edit_category(request: Request, category_id: int, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
     """Admin edit category form"""
-    template_data = await category_form(request, db, current_user, category_id)
+    template_data = category_form(request, db, current_user, category_id)
     return templates.TemplateResponse("admin/category_form.html", template_data)
 
 @app.get("/admin/forums/new", response_class=HTMLResponse)
-async def admin_new_forum(request: Request, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
+def admin_new_forum(request: Request, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
     """Admin new forum form"""
-    template_data = await forum_form(request, db, current_user)
+    template_data = forum_form(request, db, current_user)
     return templates.TemplateResponse("admin/forum_form.html", template_data)
 
 @app.get("/admin/forums/{forum_id}/edit", response_class=HTMLResponse)
-async def admin_edit_forum(request: Request, forum_id: int, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
+def admin_edit_forum(request: Request, forum_id: int, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
     """Admin edit forum form"""
-    template_data = await forum_form(request, db, current_user, forum_id)
+    template_data = forum_form(request, db, current_user, forum_id)
     return templates.TemplateResponse("admin/forum_form.html", template_data)
 
 @app.post("/admin/forums/categories/save")
-async def admin_save_category(
+def admin_save_category(
     name: str = Form(...),
     description: str = Form(""),
     display_order: int = Form(0),
@@ -660,12 +687,12 @@ async def admin_save_category(
     }
     
     # Call the admin function to save the category
-    result = await category_save(db, current_user, form_data)
+    result = category_save(db, current_user, form_data)
     
     return result
 
 @app.get("/admin/forums/categories/{category_id}/delete")
-async def admin_delete_category(
+def admin_delete_category(
     category_id: int,
     db: Session = Depends(get_db),
     current_user: User = Depends(admin_required())
@@ -697,7 +724,7 @@ async def admin_delete_category(
 
 # Handle the misspelled URL path (categorys instead of categories)
 @app.get("/admin/forums/categorys/{category_id}/delete")
-async def admin_delete_category_misspelled(
+def admin_delete_category_misspelled(
     category_id: int,
     db: Session = Depends(get_db),
     current_user: User = Depends(admin_required())
@@ -706,7 +733,7 @@ async def admin_delete_category_misspelled(
     return RedirectResponse(url=f"/admin/forums/categories/{category_id}/delete", status_code=307)
 
 @app.post("/admin/forums/save")
-async def admin_save_forum(
+def admin_save_forum(
     name: str = Form(...),
     description: str = Form(""),
     category_id: int = Form(...),
@@ -729,39 +756,39 @@ async def admin_save_forum(
         'is_locked': is_locked,
         'forum_id': forum_id
     }
-    return await forum_save(db, current_user, form_data)
+    return forum_save(db, current_user, form_data)
 
 # Admin product routes
 @app.get("/admin/products", response_class=HTMLResponse)
-async def admin_products_page(
+def admin_products_page(
     request: Request,
     page: int = 1,
     db: Session = Depends(get_db),
     current_user: User = Depends(admin_required())
 ):
     """Admin products management page"""
-    context = await product_list(request, db, current_user, page)
+    context = product_list(request, db, current_user, page)
     return templates.TemplateResponse("admin/products.html", context)
 
 @app.get("/admin/products/new", response_class=HTMLResponse)
-async def admin_product_new_page(
+def admin_product_new_page(
     request: Request,
     db: Session = Depends(get_db),
     current_user: User = Depends(admin_required())
 ):
     """Admin new product form page"""
-    context = await product_form(request, db, current_user)
+    context = product_form(request, db, current_user)
     return templates.TemplateResponse("admin/product_form.html", context)
 
 @app.get("/admin/products/{product_id}/edit", response_class=HTMLResponse)
-async def admin_product_edit_page(
+def admin_product_edit_page(
     request: Request,
     product_id: int,
     db: Session = Depends(get_db),
     current_user: User = Depends(admin_required())
 ):
     """Admin edit product form page"""
-    context = await product_form(request, db, current_user, product_id)
+    context = product_form(request, db, current_user, product_id)
     return templates.TemplateResponse("admin/product_form.html", context)
 
 @app.post("/admin/products/save")
@@ -776,7 +803,8 @@ async def admin_save_product(
     
     # Call the product_save function with proper debugging
     try:
-        result = await product_save(request, db, current_user)
+        form = await request.form()
+        result = await run_in_threadpool(product_save, form, db, current_user)
         return result
     except Exception as e:
         print(f"Error saving product: {str(e)}")
@@ -785,28 +813,28 @@ async def admin_save_product(
         return RedirectResponse(url="/admin/products?error=Error+saving+product", status_code=303)
 
 @app.get("/admin/products/{product_id}/delete")
-async def admin_delete_product(
+def admin_delete_product(
     product_id: int,
     db: Session = Depends(get_db),
     current_user: User = Depends(admin_required())
 ):
     """Delete a product"""
-    return await product_delete(db, current_user, product_id)
+    return product_delete(db, current_user, product_id)
 
 @app.get("/admin/products/{product_id}/toggle-featured")
-async def admin_toggle_product_featured(
+def admin_toggle_product_featured(
     product_id: int,
     db: Session = Depends(get_db),
     current_user: User = Depends(admin_required())
 ):
     """Toggle product featured status"""
-    return await product_toggle_featured(db, current_user, product_id)
+    return product_toggle_featured(db, current_user, product_id)
 
 # Site Settings Routes
 @app.get("/admin/settings", response_class=HTMLResponse)
-async def admin_settings(request: Request, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
+def admin_settings(request: Request, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
     """Admin site settings page"""
-    context = await site_settings(request, db, current_user)
+    context = site_settings(request, db, current_user)
     return templates.TemplateResponse("admin/settings.html", context)
 
 @app.post("/admin/settings/save")
@@ -818,25 +846,25 @@ async def admin_save_settings(
 ):
     """Save site settings"""
     form_data = await request.form()
-    result = await settings_save(db, current_user, dict(form_data))
+    result = await run_in_threadpool(settings_save, db, current_user, dict(form_data))
     return RedirectResponse("/admin/settings?success=Settings+saved", status_code=303)
 
 # Thread Management Routes
 @app.get("/admin/threads/delete/{thread_id}")
-async def admin_delete_thread(thread_id: int, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
+def admin_delete_thread(thread_id: int, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
     """Delete a thread"""
-    result = await thread_delete(db, current_user, thread_id)
+    result = thread_delete(db, current_user, thread_id)
     return RedirectResponse("/admin/forums?tab=threads&success=Thread+deleted", status_code=303)
 
 @app.get("/admin/threads/pin/{thread_id}")
-async def admin_toggle_thread_sticky(thread_id: int, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
+def admin_toggle_thread_sticky(thread_id: int, db: Session = Depends(get_db), current_user: User = Depends(admin_required())):
     """Toggle thread sticky status"""
-    result = await thread_toggle_sticky(db, current_user, thread_id)
+    result = thread_toggle_sticky(db, current_user, thread_id)
     return RedirectResponse("/admin/forums?tab=threads&success=Thread+updated", status_code=303)
 
 # Route for replying to a thread
 @app.post("/thread/{thread_id}/reply")
-async def reply_to_thread(thread_id: int, content: str = Form(...), db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
+def reply_to_thread(thread_id: int, content: str = Form(...), db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
     """
     Handles POST requests to reply to a thread.
     """
@@ -873,18 +901,21 @@ async def reply_to_thread(thread_id: int, content: str = Form(...), db: Session
         created_at=datetime.now(),
         updated_at=datetime.now()
     )
+    new_post.render_html()
     
     # Update thread's updated_at timestamp
     thread.updated_at = datetime.now()
     
     db.add(new_post)
+    db.flush()
+    record_post_created(db, thread, new_post)
     db.commit()
     
-    return RedirectResponse(url=f"/thread/{thread_id}#post-{new_post.id}", status_code=303)
+    return RedirectResponse(url=get_post_url(db, new_post, current_user), status_code=303)
 
 # Route for editing a post
 @app.get("/post/{post_id}/edit", response_class=HTMLResponse)
-async def edit_post_form(post_id: int, request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
+def edit_post_form(post_id: int, request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
     """
     Displays the form to edit a post.
     """
@@ -893,7 +924,7 @@ async def edit_post_form(post_id: int, request: Request, db: Session = Depends(g
         return RedirectResponse(url=f"/login?next=/post/{post_id}/edit", status_code=303)
     
     # Get the post
-    post = db.query(Post).filter(Post.id == post_id).first()
+    post = queries.post_with_thread(db, post_id)
     if not post:
         raise HTTPException(status_code=404, detail="Post not found")
     
@@ -916,7 +947,7 @@ async def edit_post_form(post_id: int, request: Request, db: Session = Depends(g
     )
 
 @app.post("/post/{post_id}/edit")
-async def update_post(post_id: int, content: str = Form(...), db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
+def update_post(post_id: int, content: str = Form(...), db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
     """
     Handles POST requests to update a post.
     """
@@ -942,6 +973,7 @@ async def update_post(post_id: int, content: str = Form(...), db: Session = Depe
     
     # Update the post
     post.content = content
+    post.render_html()
     post.updated_at = datetime.now()
     
     # Update thread's updated_at timestamp
@@ -950,11 +982,11 @@ async def update_post(post_id: int, content: str = Form(...), db: Session = Depe
     
     db.commit()
     
-    return RedirectResponse(url=f"/thread/{post.thread_id}#post-{post.id}", status_code=303)
+    return RedirectResponse(url=get_post_url(db, post, current_user), status_code=303)
 
 # Route for editing a thread
 @app.get("/thread/{thread_id}/edit", response_class=HTMLResponse)
-async def edit_thread_form(thread_id: int, request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
+def edit_thread_form(thread_id: int, request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
     """
     Displays the form to edit a thread.
     """
@@ -963,7 +995,7 @@ async def edit_thread_form(thread_id: int, request: Request, db: Session = Depen
         return RedirectResponse(url=f"/login?next=/thread/{thread_id}/edit", status_code=303)
     
     # Get the thread
-    thread = db.query(Thread).filter(Thread.id == thread_id).first()
+    thread = queries.thread_page(db, thread_id)
     if not thread:
         raise HTTPException(status_code=404, detail="Thread not found")
     
@@ -982,7 +1014,7 @@ async def edit_thread_form(thread_id: int, request: Request, db: Session = Depen
     )
 
 @app.post("/thread/{thread_id}/edit")
-async def update_thread(thread_id: int, title: str = Form(...), content: str = Form(...), db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
+def update_thread(thread_id: int, title: str = Form(...), content: str = Form(...), db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
     """
     Handles POST requests to update a thread.
     """
@@ -1009,6 +1041,7 @@ async def update_thread(thread_id: int, title: str = Form(...), content: str = F
     # Update the thread
     thread.title = title
     thread.content = content
+    thread.render_html()
     thread.updated_at = datetime.now()
     
     db.commit()
@@ -1017,7 +1050,7 @@ async def update_thread(thread_id: int, title: str = Form(...), content: str = F
 
 # Route for deleting a thread
 @app.get("/thread/{thread_id}/delete")
-async def delete_thread(thread_id: int, request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
+def delete_thread(thread_id: int, request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
     """
     Handles requests to delete a thread.
     """
@@ -1043,13 +1076,15 @@ async def delete_thread(thread_id: int, request: Request, db: Session = Depends(
     
     # Delete the thread
     db.delete(thread)
+    db.flush()
+    refresh_forum_stats(db, forum_id)
     db.commit()
     
     return RedirectResponse(url=f"/forum/{forum_id}", status_code=303)
 
 # Route for deleting a post
 @app.get("/post/{post_id}/delete")
-async def delete_post(post_id: int, request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
+def delete_post(post_id: int, request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
     """
     Handles requests to delete a post.
     """
@@ -1069,54 +1104,68 @@ async def delete_post(post_id: int, request: Request, db: Session = Depends(get_
     
     # Get the thread ID for redirection after deletion
     thread_id = post.thread_id
+    forum_id = post.thread.forum_id
     
     # Delete the post
     db.delete(post)
+    db.flush()
+    refresh_forum_stats(db, forum_id)
     db.commit()
     
     return RedirectResponse(url=f"/thread/{thread_id}", status_code=303)
 
 # Route for posting to the shoutbox
 @app.post("/shoutbox", response_class=RedirectResponse)
-async def post_shoutbox(message: str = Form(...), db: Session = Depends(get_db), current_user: User = Depends(get_current_active_user)):
+async def post_shoutbox(message: str = Form(...), current_user: User = Depends(get_current_active_user)):
     """
     Handles POST requests to post a message to the shoutbox.
     """
     # Filter offensive content
     is_clean, filtered_message, _ = filter_offensive_content(message)
     
-    # Create new shoutbox message
-    new_message = Shoutbox(
-        user_id=current_user.id,
-        message=filtered_message
-    )
-    
-    db.add(new_message)
-    db.commit()
-    
-    # Broadcast the message to all clients
-    await broadcast_shoutbox_message(new_message, db)
+    # Store the message and broadcast it to all clients
+    data = await shoutbox_writer.save(current_user.id, filtered_message)
+    # With pub/sub across workers the broadcast may not be back yet, so the redirected page
+    # wouldn't show it; the history skips it when the broadcast arrives
+    shoutbox_history.add(data)
     
     return RedirectResponse(url="/forum", status_code=303)
 
 # Authentication routes
 @app.post("/token")
-async def login_for_access_token(response: JSONResponse, form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+def login_for_access_token(request: Request, form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     """
     Handles user login and returns an access token.
     """
-    user = authenticate_user(db, form_data.username, form_data.password)
+    client_ip = request.client.host if request.client else None
+    retry_after = check_login(client_ip, form_data.username)
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many failed login attempts, please try again later",
+            headers={"Retry-After": str(retry_after)},
+        )
+    
+    try:
+        user = authenticate_user(db, form_data.username, form_data.password)
+    except PasswordHashingBusy:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many login attempts right now, please try again",
+            headers={"Retry-After": "5"},
+        )
     if not user:
+        record_login_failure(client_ip, form_data.username)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
     
+    record_login_success(form_data.username)
+    
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
-    )
+    access_token = create_user_token(user, expires_delta=access_token_expires)
     
     # Set cookie
     response = JSONResponse(content={"access_token": access_token, "token_type": "bearer"})
@@ -1146,31 +1195,55 @@ async def login_page(request: Request, current_user: User = Depends(get_optional
 
 # Login form submission
 @app.post("/login")
-async def login(request: Request, response: JSONResponse, username: str = Form(...), password: str = Form(...), 
+async def login(request: Request, username: str = Form(...), password: str = Form(...), 
         cf_turnstile_response: str = Form(None, alias="cf-turnstile-response"), db: Session = Depends(get_db)):
     """
     Handles login form submission.
     """
     # Verify Turnstile
-    if not verify_turnstile(cf_turnstile_response):
+    if not await verify_turnstile(cf_turnstile_response, request.client.host if request.client else None):
         return templates.TemplateResponse(
             "login.html", 
             {"request": request, "error": "Please complete the CAPTCHA verification", "current_user": None, "turnstile_site_key": TURNSTILE_SITE_KEY},
             status_code=400
         )
     
-    user = authenticate_user(db, username, password)
+    return await run_in_threadpool(log_in_user, request, db, username, password)
+
+def log_in_user(request: Request, db: Session, username: str, password: str):
+    """
+    Checks the credentials of a login form and sets the access token cookie.
+    Runs in the threadpool.
+    """
+    client_ip = request.client.host if request.client else None
+    retry_after = check_login(client_ip, username)
+    if retry_after:
+        return templates.TemplateResponse(
+            "login.html", 
+            {"request": request, "error": f"Too many failed login attempts, please try again in {math.ceil(retry_after / 60)} minute(s)", "current_user": None, "turnstile_site_key": TURNSTILE_SITE_KEY},
+            status_code=429,
+            headers={"Retry-After": str(retry_after)}
+        )
+    
+    try:
+        user = authenticate_user(db, username, password)
+    except PasswordHashingBusy:
+        return templates.TemplateResponse(
+            "login.html", 
+            {"request": request, "error": "Too many login attempts right now, please try again", "current_user": None, "turnstile_site_key": TURNSTILE_SITE_KEY},
+            status_code=503
+        )
     if not user:
+        record_login_failure(client_ip, username)
         return templates.TemplateResponse(
             "login.html", 
             {"request": request, "error": "Invalid username or password", "current_user": None, "turnstile_site_key": TURNSTILE_SITE_KEY},
             status_code=400
         )
+    record_login_success(username)
     
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
-    )
+    access_token = create_user_token(user, expires_delta=access_token_expires)
     
     # Set cookie and redirect
     response = RedirectResponse(url="/", status_code=303)
@@ -1216,13 +1289,30 @@ async def register(request: Request, username: str = Form(...), email: str = For
     Handles registration form submission.
     """
     # Verify Turnstile
-    if not verify_turnstile(cf_turnstile_response):
+    if not await verify_turnstile(cf_turnstile_response, request.client.host if request.client else None):
         return templates.TemplateResponse(
             "register.html", 
             {"request": request, "error": "Please complete the CAPTCHA verification", "current_user": None, "turnstile_site_key": TURNSTILE_SITE_KEY},
             status_code=400
         )
     
+    return await run_in_threadpool(register_user, request, db, username, email, password, confirm_password)
+
+def register_user(request: Request, db: Session, username: str, email: str, password: str, confirm_password: str):
+    """
+    Creates the account of a registration form and logs the new user in.
+    Runs in the threadpool.
+    """
+    client_ip = request.client.host if request.client else None
+    retry_after = check_registration(client_ip)
+    if retry_after:
+        return templates.TemplateResponse(
+            "register.html", 
+            {"request": request, "error": f"Too many sign-ups from your network, please try again in {math.ceil(retry_after / 60)} minute(s)", "current_user": None, "turnstile_site_key": TURNSTILE_SITE_KEY},
+            status_code=429,
+            headers={"Retry-After": str(retry_after)}
+        )
+    
     # Validate passwords match
     if password != confirm_password:
         return templates.TemplateResponse(
@@ -1244,7 +1334,15 @@ async def register(request: Request, username: str = Form(...), email: str = For
         )
     
     # Create new user
-    user = create_user(db, username, email, password)
+    record_registration(client_ip)
+    try:
+        user = create_user(db, username, email, password)
+    except PasswordHashingBusy:
+        return templates.TemplateResponse(
+            "register.html", 
+            {"request": request, "error": "Too many sign-ups right now, please try again", "current_user": None, "turnstile_site_key": TURNSTILE_SITE_KEY},
+            status_code=503
+        )
     
     # Add user role
     user_role = db.query(Role).filter(Role.name == "User").first()
@@ -1259,9 +1357,7 @@ async def register(request: Request, username: str = Form(...), email: str = For
     
     # Log the user in
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
-    )
+    access_token = create_user_token(user, expires_delta=access_token_expires)
     
     # Set cookie and redirect
     response = RedirectResponse(url="/", status_code=303)
@@ -1284,6 +1380,54 @@ async def auth_google():
     async with google_sso:
         return await google_sso.get_login_redirect()
 
+def get_google_user(db: Session, user_data):
+    """
+    Get or create the user for a verified Google account.
+    Runs in the threadpool.
+    """
+    oauth_id = user_data.id
+    email = user_data.email
+    username = email.split("@")[0]  # Simple username from email
+    
+    # Check if username already exists (not from this OAuth user)
+    existing_user = db.query(User).filter(User.username == username).first()
+    if existing_user and (existing_user.oauth_id != oauth_id or existing_user.oauth_provider != "google"):
+        # Generate a unique username
+        base_username = username
+        counter = 1
+        while existing_user:
+            username = f"{base_username}{counter}"
+            counter += 1
+            existing_user = db.query(User).filter(User.username == username).first()
+    
+    user = get_or_create_oauth_user(
+        db=db,
+        oauth_provider="google",
+        oauth_id=oauth_id,
+        email=email,
+        username=username,
+        avatar_url=user_data.picture
+    )
+    
+    # Ensure user has a profile
+    if not user.profile:
+        profile = UserProfile(user_id=user.id)
+        db.add(profile)
+        db.commit()
+    
+    # Ensure user has User role
+    user_role = db.query(Role).filter(Role.name == "User").first()
+    if user_role and user_role not in user.roles:
+        user.roles.append(user_role)
+        db.commit()
+    
+    # The avatar may have been refreshed from Google
+    invalidate_author_card(user.id)
+    
+    # Reload what the commits expired here rather than on the event loop
+    db.refresh(user)
+    return user
+
 @app.get("/auth/google/callback")
 async def auth_google_callback(request: Request, db: Session = Depends(get_db)):
     """
@@ -1294,47 +1438,11 @@ async def auth_google_callback(request: Request, db: Session = Depends(get_db)):
             user_data = await google_sso.verify_and_process(request)
         
         # Get or create user
-        oauth_id = user_data.id
-        email = user_data.email
-        username = email.split("@")[0]  # Simple username from email
-        
-        # Check if username already exists (not from this OAuth user)
-        existing_user = db.query(User).filter(User.username == username).first()
-        if existing_user and (existing_user.oauth_id != oauth_id or existing_user.oauth_provider != "google"):
-            # Generate a unique username
-            base_username = username
-            counter = 1
-            while existing_user:
-                username = f"{base_username}{counter}"
-                counter += 1
-                existing_user = db.query(User).filter(User.username == username).first()
-        
-        user = get_or_create_oauth_user(
-            db=db,
-            oauth_provider="google",
-            oauth_id=oauth_id,
-            email=email,
-            username=username,
-            avatar_url=user_data.picture
-        )
-        
-        # Ensure user has a profile
-        if not user.profile:
-            profile = UserProfile(user_id=user.id)
-            db.add(profile)
-            db.commit()
-        
-        # Ensure user has User role
-        user_role = db.query(Role).filter(Role.name == "User").first()
-        if user_role and user_role not in user.roles:
-            user.roles.append(user_role)
-            db.commit()
+        user = await run_in_threadpool(get_google_user, db, user_data)
         
         # Create access token
         access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = create_access_token(
-            data={"sub": user.username}, expires_delta=access_token_expires
-        )
+        access_token = await run_in_threadpool(create_user_token, user, access_token_expires)
         
         # Set cookie and redirect
         response = RedirectResponse(url="/", status_code=303)
@@ -1354,7 +1462,7 @@ async def auth_google_callback(request: Request, db: Session = Depends(get_db)):
 
 # Products page
 @app.get("/products", response_class=HTMLResponse)
-async def read_products(request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
+def read_products(request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
     """
     Handles GET requests to the /products URL.
     Displays products using Sell.app embedded storefront.
@@ -1365,31 +1473,9 @@ async def read_products(request: Request, db: Session = Depends(get_db), current
     # Get products from database and sort alphabetically
     products = db.query(Product).order_by(Product.name).all()
     
-    # Get featured products
+    # Get featured products (descriptions are rendered when saved)
     featured_products = db.query(Product).filter(Product.is_featured == True).all()
     
-    # Process product descriptions with markdown and truncate long descriptions
-    for product in products:
-        # First render markdown
-        if product.description:
-            product.full_description_html = render_markdown(product.description)
-            # Create a truncated version for display
-            if len(product.description) > 250:
-                product.short_description = product.description[:250] + "..."
-            else:
-                product.short_description = product.description
-            product.short_description_html = render_markdown(product.short_description)
-    
-    # Process featured products similarly
-    for product in featured_products:
-        if product.description:
-            product.full_description_html = render_markdown(product.description)
-            if len(product.description) > 250:
-                product.short_description = product.description[:250] + "..."
-            else:
-                product.short_description = product.description
-            product.short_description_html = render_markdown(product.short_description)
-    
     return templates.TemplateResponse(
         "products.html",
         {
@@ -1405,7 +1491,7 @@ async def read_products(request: Request, db: Session = Depends(get_db), current
 
 # Profile page
 @app.get("/profile", response_class=HTMLResponse)
-async def profile_page(request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
+def profile_page(request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
     """
     Displays the current user's profile page.
     """
@@ -1413,34 +1499,21 @@ async def profile_page(request: Request, db: Session = Depends(get_db), current_
     if not current_user:
         return RedirectResponse(url="/login?next=/profile", status_code=303)
         
-    # Get user with related data
-    user = db.query(User).filter(User.id == current_user.id).first()
-    
-    # Get user's posts and threads
-    posts = db.query(Post).filter(Post.author_id == user.id).order_by(Post.created_at.desc()).limit(10).all()
-    threads = db.query(Thread).filter(Thread.author_id == user.id).order_by(Thread.created_at.desc()).limit(10).all()
-    
-    # Render Markdown for bio and signature if they exist
-    if user.profile and user.profile.bio:
-        user.profile.bio = render_markdown(user.profile.bio)
-    
-    if user.profile and user.profile.signature:
-        user.profile.signature = render_markdown(user.profile.signature)
+    # Get user with related data, latest posts and threads
+    profile = queries.profile_page(db, current_user.id)
     
     return templates.TemplateResponse(
         "profile.html", 
         {
             "request": request, 
             "current_user": current_user,
-            "user": user,
-            "posts": posts,
-            "threads": threads
+            **profile
         }
     )
 
 # Profile edit page
 @app.get("/profile/edit", response_class=HTMLResponse)
-async def profile_edit_page(request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
+def profile_edit_page(request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
     """
     Displays the profile edit page.
     """
@@ -1462,7 +1535,7 @@ async def profile_edit_page(request: Request, db: Session = Depends(get_db), cur
 
 # Profile edit form submission
 @app.post("/profile/edit", response_class=HTMLResponse)
-async def profile_edit(request: Request, 
+def profile_edit(request: Request, 
                       avatar_file: UploadFile = File(None), 
                       clipboard_image_data: str = Form(None),
                       display_name: str = Form(None), 
@@ -1639,79 +1712,113 @@ async def profile_edit(request: Request,
     user.profile.website = website
     user.profile.discord = discord
     user.profile.signature = signature
+    user.profile.render_html()
     
+    # Tokens carry the display name
+    revoke_claims(user)
     db.commit()
+    invalidate_author_card(user.id)
+    invalidate_principal(user.id)
     
     return RedirectResponse(url="/profile", status_code=303)
 
 # User profile page
 @app.get("/users/{username}.{uid}", response_class=HTMLResponse)
-async def user_profile_page(username: str, uid: int, request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
+def user_profile_page(username: str, uid: int, request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_optional_user)):
     """
     Displays a user's profile page.
     """
-    # Get user with related data
-    user = db.query(User).filter(User.id == uid, User.username == username).first()
-    if not user:
+    # Get user with related data, latest posts and threads
+    profile = queries.profile_page(db, uid, username)
+    if not profile:
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Get user's posts and threads
-    posts = db.query(Post).filter(Post.author_id == user.id).order_by(Post.created_at.desc()).limit(10).all()
-    threads = db.query(Thread).filter(Thread.author_id == user.id).order_by(Thread.created_at.desc()).limit(10).all()
-    
-    # Render Markdown for bio and signature if they exist
-    if user.profile and user.profile.bio:
-        user.profile.bio = render_markdown(user.profile.bio)
-    
-    if user.profile and user.profile.signature:
-        user.profile.signature = render_markdown(user.profile.signature)
-    
     return templates.TemplateResponse(
         "user_profile.html", 
         {
             "request": request, 
             "current_user": current_user,
-            "user": user,
-            "posts": posts,
-            "threads": threads
+            **profile
         }
     )
 
 # WebSocket connection handling
-active_connections: List[dict] = []  # List of {"websocket": WebSocket, "user": User}
+connection_manager = ConnectionManager()
+# Broadcasts go through pub/sub so every worker sends them to its own connections
+pubsub = create_pubsub()
+presence = Presence(connection_manager, pubsub)
+# Recent shoutbox messages of every channel, for the forum pages and reconnecting clients
+shoutbox_history = ShoutboxHistory()
+
+# Lowest account tier that may subscribe to each shoutbox channel
+SHOUTBOX_CHANNEL_TIERS = {
+    "public": UserProfile.TIER_UNREGISTERED,
+    "private": UserProfile.TIER_CUSTOMER
+}
+
+def can_use_channel(user, channel: str) -> bool:
+    """Whether a connection's user (None for guests) may read and post to a shoutbox channel"""
+    if channel not in SHOUTBOX_CHANNEL_TIERS:
+        return False
+    account_tier = user.profile.account_tier if user and user.profile else UserProfile.TIER_UNREGISTERED
+    return account_tier >= SHOUTBOX_CHANNEL_TIERS[channel]
+
+def deliver_broadcast(data: dict):
+    """Sends a broadcast from any worker to this worker's connections, or those on its channel"""
+    if data["message"]["type"] == "shoutbox_message":
+        shoutbox_history.add(data["message"]["data"])
+    connection_manager.broadcast(data["message"], data.get("channel"))
+
+def replay_shoutbox(connection, channel: str, since_id: Optional[int]):
+    """Sends a reconnecting client the messages of a channel it missed, from shoutbox_history"""
+    if since_id is None:
+        return
+    missed = shoutbox_history.since(channel, since_id)
+    for data in missed:
+        connection_manager.send(connection, {"type": "shoutbox_message", "data": data})
+    if missed:
+        print(f"[DEBUG] Replayed {len(missed)} {channel} shoutbox messages after ID {since_id}")
+
+def parse_since_id(value) -> Optional[int]:
+    """The since_id a client sent, None if it sent none or something else"""
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+pubsub.subscribe("broadcast", deliver_broadcast)
+
+def load_shoutbox_history():
+    """Fill shoutbox_history from the database. Runs in the threadpool."""
+    db = SessionLocal()
+    try:
+        shoutbox_history.load(db, SHOUTBOX_CHANNEL_TIERS)
+    finally:
+        db.close()
+
+@app.on_event("startup")
+async def start_broadcasting():
+    """Connect to the other workers, load the shoutbox history, start sharing presence and writing shoutbox messages"""
+    await pubsub.start()
+    # Loaded after connecting so messages sent meanwhile are recorded too, the two are merged
+    await run_in_threadpool(load_shoutbox_history)
+    presence.start()
+    shoutbox_writer.start()
+
+@app.on_event("shutdown")
+async def stop_broadcasting():
+    """Write the queued shoutbox messages, tell the other workers this one's connections are gone and disconnect from them"""
+    await shoutbox_writer.stop()
+    await presence.stop()
+    await pubsub.stop()
 
 from starlette.websockets import WebSocketState
 
-@app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)):
+def get_websocket_user(db: Session, token: Optional[str], user_id: Optional[str], username: Optional[str]):
     """
-    Handles WebSocket connections for real-time updates.
+    Authenticate a WebSocket connection, returns the user or None for guests.
+    Runs in the threadpool.
     """
-    # Add connection status tracking
-    connection_accepted = False
-    
-    try:
-        # Accept the connection first
-        await websocket.accept()
-        connection_accepted = True
-        print("[DEBUG] WebSocket connection accepted")
-        
-        # Add a small delay after accepting to ensure connection stabilizes
-        await asyncio.sleep(0.5)
-        
-        # Try to get token and user info from query params
-        query_params = websocket.query_params
-        token = query_params.get("token") if query_params else None
-        user_id = query_params.get("user_id") if query_params else None
-        username = query_params.get("username") if query_params else None
-        
-        print(f"[DEBUG] Query params: token={token[:10] if token else 'None'}, user_id={user_id}, username={username}")
-    except Exception as e:
-        print(f"[DEBUG] Error in initial WebSocket setup: {e}")
-        if not connection_accepted:
-            return  # Exit early if we couldn't even accept the connection
-    
-    # Get user from token if provided
     user = None
     
     # First try token-based authentication
@@ -1722,7 +1829,7 @@ async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)
             token_username = payload.get("sub")
             print(f"[DEBUG] Token payload username: {token_username}")
             if token_username:
-                user = db.query(User).filter(User.username == token_username).first()
+                user = db.query(User).options(sqlalchemy.orm.joinedload(User.profile)).filter(User.username == token_username).first()
                 if user:
                     print(f"[DEBUG] WebSocket authenticated via token as user: {token_username} (ID: {user.id})")
                 else:
@@ -1740,7 +1847,7 @@ async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)
             # Convert user_id to integer
             user_id_int = int(user_id)
             # Look up the user by ID and username
-            user = db.query(User).filter(User.id == user_id_int, User.username == username).first()
+            user = db.query(User).options(sqlalchemy.orm.joinedload(User.profile)).filter(User.id == user_id_int, User.username == username).first()
             if user:
                 print(f"[DEBUG] WebSocket authenticated via direct params as user: {username} (ID: {user_id})")
             else:
@@ -1748,13 +1855,65 @@ async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)
         except Exception as e:
             print(f"[DEBUG] Error authenticating with direct params: {e}")
     
+    # Detach the user (with its profile, for presence), it is used long after the session is closed
+    if user:
+        db.expunge(user)
+    return user
+
+def authenticate_websocket(token: Optional[str], user_id: Optional[str], username: Optional[str]):
+    """
+    Authenticate a WebSocket connection with a session of its own, returns the user or None for guests.
+    The pooled connection goes back as soon as the user is loaded rather than staying checked
+    out while the socket is open. Runs in the threadpool.
+    """
+    with SessionLocal() as db:
+        return get_websocket_user(db, token, user_id, username)
+
+@app.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    """
+    Handles WebSocket connections for real-time updates.
+    """
+    # Add connection status tracking
+    connection_accepted = False
+    
+    try:
+        # Accept the connection first
+        await websocket.accept()
+        connection_accepted = True
+        print("[DEBUG] WebSocket connection accepted")
+        
+        # Add a small delay after accepting to ensure connection stabilizes
+        await asyncio.sleep(0.5)
+        
+        # Try to get token and user info from query params
+        query_params = websocket.query_params
+        token = query_params.get("token") if query_params else None
+        user_id = query_params.get("user_id") if query_params else None
+        username = query_params.get("username") if query_params else None
+        # Newest shoutbox message a reconnecting client has, the ones after it are replayed
+        since_id = parse_since_id(query_params.get("since_id")) if query_params else None
+        # The shoutbox channel the socket starts on, checked once the user is known
+        channel = query_params.get("channel", DEFAULT_CHANNEL) if query_params else DEFAULT_CHANNEL
+        
+        print(f"[DEBUG] Query params: token={token[:10] if token else 'None'}, user_id={user_id}, username={username}")
+    except Exception as e:
+        print(f"[DEBUG] Error in initial WebSocket setup: {e}")
+        if not connection_accepted:
+            return  # Exit early if we couldn't even accept the connection
+    
+    # Get user from token if provided, or from user_id and username
+    user = await run_in_threadpool(authenticate_websocket, token, user_id, username)
+    # The user's entry in the online users list, kept by presence while they are connected
+    card = user_card(user) if user else None
+    
     # If no authentication worked
     if not user:
         print("[DEBUG] No authentication successful, connecting as anonymous guest")
     
-    # Create connection info object with unique identifier
-    connection_id = id(websocket)
-    connection_info = {"websocket": websocket, "user": user, "id": connection_id}
+    if not can_use_channel(user, channel):
+        print(f"[DEBUG] Refused channel {channel!r} at connect, starting on {DEFAULT_CHANNEL}")
+        channel = DEFAULT_CHANNEL
     
     # Handle existing connections with more caution
     # Handle multiple connections from the same user more carefully
@@ -1762,11 +1921,11 @@ async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)
     # but close any that seem stale or problematic
     if user:
         stale_connections = []
-        for i, conn in enumerate(active_connections[:]):
-            if conn.get("user") and conn.get("user").id == user.id and conn.get("id") != connection_id:
+        for conn in connection_manager.user_connections(user.id):
+            if conn.websocket is not websocket:
                 try:
                     # Check if connection seems stale
-                    ws_state = conn["websocket"].client_state
+                    ws_state = conn.websocket.client_state
                     if ws_state == WebSocketState.DISCONNECTED:
                         stale_connections.append(conn)
                     elif ws_state != WebSocketState.CONNECTED:
@@ -1783,25 +1942,25 @@ async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)
                 print(f"[DEBUG] Cleaning up stale connection for user {user.username}")
                 try:
                     # Try to close, but don't worry if it fails
-                    await conn["websocket"].close(code=1001, reason="Stale connection")
+                    await conn.websocket.close(code=1001, reason="Stale connection")
                 except Exception:
                     pass
                 
-                # Remove from active list
-                if conn in active_connections:
-                    active_connections.remove(conn)
+                # Remove from the registry
+                if connection_manager.remove(conn):
+                    presence.left()
             except Exception as e:
                 print(f"[DEBUG] Error cleaning up stale connection: {e}")
     
     # Let clients manage their own connections
     if user:
-        existing_connections = [c for c in active_connections if c.get("user") and c.get("user").id == user.id]
+        existing_connections = connection_manager.user_connections(user.id)
         if existing_connections:
             print(f"[DEBUG] User {user.username} has {len(existing_connections)} existing connections")
     
     # Add the new connection
-    active_connections.append(connection_info)
-    print(f"[DEBUG] Added connection to active_connections, now have {len(active_connections)}")
+    connection_info = connection_manager.add(websocket, user, channels=(channel,))
+    print(f"[DEBUG] Added connection to connection_manager, now have {len(connection_manager)}")
     
     # Add a short delay before sending initial messages
     # This helps ensure the client is ready to receive
@@ -1809,7 +1968,7 @@ async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)
     
     # Send connection confirmation
     try:
-        await websocket.send_json({
+        connection_manager.send(connection_info, {
             "type": "connection_established",
             "authenticated": user is not None,
             "username": user.username if user else None,
@@ -1817,12 +1976,13 @@ async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)
         })
         print("[DEBUG] Sent connection confirmation")
         
-        # Wait a bit more before broadcasting to all clients
-        await asyncio.sleep(0.2)
+        # Send the full online users list to this client, the others get the change with the next presence update
+        presence.joined(card)
+        connection_manager.send(connection_info, {"type": "online_users", "data": presence.snapshot()})
+        print("[DEBUG] Sent online users snapshot after connection")
         
-        # Update online users list
-        await broadcast_online_users()
-        print("[DEBUG] Broadcasted online users after connection")
+        # since_id is the newest message of the channel the socket starts on, other channels replay on subscribe
+        replay_shoutbox(connection_info, channel, since_id)
     except Exception as e:
         print(f"[DEBUG] Error in initial communication: {e}")
     
@@ -1839,9 +1999,26 @@ async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)
                 # Handle different message types
                 if message_type == 'ping':
                     # Respond to ping with pong
-                    await websocket.send_json({'type': 'pong'})
+                    connection_manager.send(connection_info, {'type': 'pong'})
                     print("[DEBUG] Sent pong response")
                     
+                elif message_type in ('subscribe', 'unsubscribe'):
+                    # Join or leave a shoutbox channel, only messages of joined channels are sent to a connection
+                    channel = json_data.get('channel', '')
+                    if message_type == 'unsubscribe':
+                        connection_manager.unsubscribe(connection_info, channel)
+                    elif can_use_channel(user, channel):
+                        connection_manager.subscribe(connection_info, channel)
+                        replay_shoutbox(connection_info, channel, parse_since_id(json_data.get('since_id')))
+                    else:
+                        print(f"[DEBUG] Refused subscription to channel {channel!r}")
+                        connection_manager.send(connection_info, {
+                            'type': 'error',
+                            'message': f'Not allowed to subscribe to {channel}'
+                        })
+                        continue
+                    connection_manager.send(connection_info, {'type': f'{message_type}d', 'channel': channel})
+                    
                 elif message_type == 'shoutbox_message':
                     # Process shoutbox message
                     content = json_data.get('content', '').strip()
@@ -1855,7 +2032,8 @@ async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)
                         # Verify the sender ID matches the connected user
                         is_authorized = False
                         
-                        if user and user.id == sender_id and user.username == sender_username:
+                        if user and user.id == sender_id and user.username == sender_username \
+                                and can_use_channel(user, shoutbox_type):
                             is_authorized = True
                         
                         if is_authorized:
@@ -1863,22 +2041,12 @@ async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)
                             filtered_content = content
                             # could add filtering logic here if needed
                             
-                            # Save to database
-                            new_message = Shoutbox(
-                                user_id=sender_id,
-                                message=filtered_content,
-                                shoutbox_type=shoutbox_type
-                            )
-                            db.add(new_message)
-                            db.commit()
-                            db.refresh(new_message)
-                            print(f"[DEBUG] Saved {shoutbox_type} shoutbox message from {sender_username} (ID: {new_message.id})")
-                            
-                            # Broadcast to all users
-                            await broadcast_shoutbox_message(new_message, db)
+                            # Queue it to be saved with the other messages of the moment, then broadcast
+                            await shoutbox_writer.submit(sender_id, filtered_content, shoutbox_type)
+                            print(f"[DEBUG] Queued {shoutbox_type} shoutbox message from {sender_username}")
                         else:
                             print(f"[DEBUG] Unauthorized message attempt from {sender_username} claiming to be {sender_id}")
-                            await websocket.send_json({
+                            connection_manager.send(connection_info, {
                                 'type': 'error',
                                 'message': 'Unauthorized message attempt'
                             })
@@ -1901,16 +2069,11 @@ async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)
     finally:
         # Clean up connection on disconnect
         try:
-            if connection_info in active_connections:
-                active_connections.remove(connection_info)
-                print(f"[DEBUG] Removed connection from active_connections, now have {len(active_connections)}")
+            connection_manager.remove(connection_info)
+            print(f"[DEBUG] Removed connection from connection_manager, now have {len(connection_manager)}")
             
-            # Add a short delay before broadcasting disconnect
-            await asyncio.sleep(0.2)
-            
-            # Update online users after disconnect
-            await broadcast_online_users()
-            print("[DEBUG] Broadcasted online users after disconnect")
+            # Evicted connections are already gone from the manager, presence is told either way
+            presence.left()
             
         except Exception as e:
             print(f"[DEBUG] Error in disconnection cleanup: {e}")
@@ -1924,196 +2087,26 @@ async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)
                 print(f"[DEBUG] Error closing websocket in cleanup: {e}")
 
 # Function to broadcast messages to all connected WebSocket clients
-async def broadcast_message(message_type: str, data: dict):
+async def broadcast_message(message_type: str, data: dict, channel: Optional[str] = None):
     """
-    Broadcasts a message to all connected WebSocket clients.
+    Broadcasts a message to all connected WebSocket clients, or the subscribers of a channel.
+    The message is queued for each connection and written by its writer task,
+    connections that fall too far behind are evicted (see connection_manager.py).
     """
-    # Create a list of connections that need to be removed
-    connections_to_remove = []
-    
     # Use a standard message format for all messages
     message = {"type": message_type, "data": data}
-    print(f"[DEBUG] Broadcasting message type: {message_type} to {len(active_connections)} connections")
-    print(f"[DEBUG] Message data: {str(data)[:100]}{'...' if len(str(data)) > 100 else ''}")
-    
-    # Track successful sends
-    success_count = 0
-    
-    # Make a safe copy of active_connections to avoid modification during iteration
-    current_connections = list(active_connections)
-    
-    for connection_info in current_connections:
-        # Check if connection is still active before attempting to send
-        if connection_info not in active_connections:
-            continue
-            
-        try:
-            # Check if the websocket is closed before sending
-            if connection_info["websocket"].client_state == WebSocketState.DISCONNECTED:
-                connections_to_remove.append(connection_info)
-                continue
-                
-            await connection_info["websocket"].send_json(message)
-            success_count += 1
-        except WebSocketDisconnect:
-            # Handle expected disconnect
-            print(f"[DEBUG] Connection already disconnected: {id(connection_info['websocket'])}")
-            connections_to_remove.append(connection_info)
-        except Exception as e:
-            print(f"[DEBUG] Error broadcasting message to connection {id(connection_info['websocket'])}: {e}")
-            # Mark for removal
-            connections_to_remove.append(connection_info)
+    print(f"[DEBUG] Broadcasting message type: {message_type} to channel {channel or '(all)'}")
     
-    print(f"[DEBUG] Successfully sent message to {success_count}/{len(active_connections)} connections")
-    
-    # Remove any closed connections
-    if connections_to_remove:
-        print(f"[DEBUG] Removing {len(connections_to_remove)} closed connections")
-        for conn in connections_to_remove:
-            try:
-                if conn in active_connections:
-                    active_connections.remove(conn)
-            except Exception as e:
-                print(f"[DEBUG] Error removing connection: {e}")
+    await pubsub.publish("broadcast", {"message": message, "channel": channel})
 
 # Function to broadcast shoutbox message
-async def broadcast_shoutbox_message(message: Shoutbox, db: Session):
+async def broadcast_shoutbox_message(data: dict):
     """
-    Broadcasts a shoutbox message to all connected clients.
+    Broadcasts a stored shoutbox message to the subscribers of its channel.
+    Called by shoutbox_writer once the batch with the message is committed.
     """
-    # Get user information for the message
-    print(f"[DEBUG] Preparing to broadcast {message.shoutbox_type} shoutbox message ID: {message.id}")
-    
-    try:
-        user = db.query(User).filter(User.id == message.user_id).first()
-        
-        if not user:
-            print(f"[DEBUG] User not found for message ID: {message.id}, user_id: {message.user_id}")
-            # Use a fallback for guest/system messages
-            data = {
-                "id": message.id,
-                "user_id": message.user_id,
-                "username": "Guest",  # Fallback name
-                "avatar_url": "/static/images/default-avatar.png",
-                "message": message.message,
-                "created_at": message.created_at.isoformat(),
-                "account_tier": 0,
-                "tier_name": "Guest",
-                "shoutbox_type": message.shoutbox_type
-            }
-        else:
-            print(f"[DEBUG] Broadcasting {message.shoutbox_type} message from user: {user.username} (ID: {user.id})")
-            data = {
-                "id": message.id,
-                "user_id": user.id,
-                "username": user.username,
-                "display_name": user.profile.display_name if user.profile and user.profile.display_name else None,
-                "avatar_url": user.avatar_url or '/static/images/default-avatar.png',
-                "message": message.message,
-                "created_at": message.created_at.isoformat(),
-                "account_tier": user.profile.account_tier if user.profile else 0,
-                "tier_name": user.profile.tier_name if user.profile else "Unregistered",
-                "shoutbox_type": message.shoutbox_type
-            }
-        
-        print(f"[DEBUG] {message.shoutbox_type.capitalize()} shoutbox message data prepared: {str(data)[:100]}...")
-        await broadcast_message("shoutbox_message", data)
-        
-        # For debugging, count active connections
-        connection_count = len(active_connections)
-        print(f"[DEBUG] Broadcasting to {connection_count} active connections")
-    except Exception as e:
-        print(f"[DEBUG] Error in broadcast_shoutbox_message: {e}")
+    print(f"[DEBUG] {data['shoutbox_type'].capitalize()} shoutbox message {data['id']} prepared")
+    await broadcast_message("shoutbox_message", data, channel=data["shoutbox_type"])
 
-# Function to broadcast online users
-async def broadcast_online_users():
-    """
-    Broadcasts the list of online users to all connected clients.
-    """
-    # Create a new database session for this function
-    db = SessionLocal()
-    try:
-        # Get unique online users
-        online_users = []
-        user_ids = set()
-        
-        # Debug output with detailed connection info
-        print(f"[DEBUG] Broadcasting online users, active connections: {len(active_connections)}")
-        
-        # Print detailed information about each connection
-        for i, conn in enumerate(active_connections):
-            print(f"[DEBUG] Connection {i+1}: User={conn['user'].username if conn['user'] else 'Guest'}, "  
-                  f"ID={conn['id']}, "  
-                  f"WebSocket_ID={id(conn['websocket'])}")
-            
-        authenticated_count = sum(1 for conn in active_connections if conn["user"] is not None)
-        print(f"[DEBUG] Authenticated connections: {authenticated_count}")
-        
-        # First process all registered users individually
-        for connection_info in active_connections:
-            user = connection_info["user"]
-            if user and user.id not in user_ids:
-                # Refresh the user object from the database to ensure it's bound to a session
-                fresh_user = db.query(User).options(
-                    sqlalchemy.orm.joinedload(User.profile)
-                ).filter(User.id == user.id).first()
-                
-                if not fresh_user:
-                    continue
-                    
-                user_ids.add(fresh_user.id)
-                print(f"[DEBUG] Adding online user: {fresh_user.username} (ID: {fresh_user.id})")
-                
-                # Get account tier information
-                account_tier = 0
-                tier_name = "Unregistered"
-                if fresh_user.profile:
-                    account_tier = fresh_user.profile.account_tier
-                    tier_name = fresh_user.profile.tier_name
-                    print(f"[DEBUG] User {fresh_user.username} has tier: {tier_name} (level {account_tier})")
-                else:
-                    print(f"[DEBUG] User {fresh_user.username} has no profile or tier information")
-                
-                online_users.append({
-                    "id": fresh_user.id,
-                    "username": fresh_user.username,
-                    "display_name": fresh_user.profile.display_name if fresh_user.profile and fresh_user.profile.display_name else None,
-                    "avatar_url": fresh_user.avatar_url or '/static/images/default-avatar.png',
-                    "account_tier": account_tier,
-                    "tier_name": tier_name,
-                    "is_registered": True
-                })
-        
-        # Count guests (connections without users)
-        guest_count = sum(1 for conn in active_connections if conn["user"] is None)
-        print(f"[DEBUG] Guest count: {guest_count}")
-        
-        # If there are guests, add a single entry for them in the users list
-        if guest_count > 0:
-            online_users.append({
-                "id": 0,  # Special ID for guests
-                "username": f"Guests ({guest_count})",
-                "avatar_url": '/static/images/default-avatar.png',
-                "account_tier": 0,
-                "tier_name": "Guest",
-                "is_registered": False,
-                "count": guest_count
-            })
-        
-        # Make sure to sort the users with registered users first, then guests
-        online_users = sorted(online_users, key=lambda x: (not x.get("is_registered"), x.get("username", "").lower()))
-        
-        data = {
-            "users": online_users,
-            "guest_count": guest_count,
-            "registered_count": len(online_users) - (1 if guest_count > 0 else 0),
-            "total_count": len(active_connections)
-        }
-        
-        print(f"[DEBUG] Broadcasting online users data: {len(online_users) - (1 if guest_count > 0 else 0)} registered users, {guest_count} guests")
-        await broadcast_message("online_users", data)
-    except Exception as e:
-        print(f"[DEBUG] Error in broadcast_online_users: {e}")
-    finally:
-        # Always close the database session
-        db.close()
+# Shoutbox messages are written in batches by one task, which then broadcasts them
+shoutbox_writer = ShoutboxWriter(broadcast_shoutbox_message)
@@ -6,6 +6,8 @@ import argparse
 from sqlalchemy.orm import Session
 from database import SessionLocal, engine
 from models import User, UserProfile
+from author_cards import invalidate_author_card
+from principals import invalidate_principal, revoke_claims
 
 def update_user_tier(user_id: int, tier_level: int):
     """
@@ -58,9 +60,14 @@ def update_user_tier(user_id: int, tier_level: int):
             print(f"Updating profile for user {user.username} (ID: {user_id})")
             print(f"Changing tier from {old_tier} to {tier_name}")
             profile.account_tier = tier_level
+        
+        # Tokens minted before the change carry the old tier
+        revoke_claims(user)
             
         # Commit the changes
         db.commit()
+        invalidate_author_card(user_id)
+        invalidate_principal(user_id)
         print(f"Success: User {user.username} (ID: {user_id}) is now a {tier_name}")
         return True
         
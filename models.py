@@ -1,10 +1,11 @@
 # models.py - This file contains all model definitions for the CottageWare application.
 
-from sqlalchemy import Boolean, Column, Integer, String, Text, ForeignKey, DateTime, Table
+from sqlalchemy import Boolean, Column, Integer, String, Text, ForeignKey, DateTime, Table, Float
 import sqlalchemy
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
+from utils import render_markdown, render_markdown_many, RENDERER_VERSION
 from datetime import datetime
 
 # Association table for user roles
@@ -15,6 +16,14 @@ user_roles = Table(
     Column('role_id', Integer, ForeignKey('roles.id'))
 )
 
+class RenderedHTML:
+    """Mixin for models that store sanitized HTML rendered from their Markdown fields"""
+
+    def render_html(self):
+        """Renders the Markdown fields into their HTML columns (see rendered_values)"""
+        for key, value in self.rendered_values().items():
+            setattr(self, key, value)
+
 class User(Base):
     """User model for authentication and forum participation"""
     __tablename__ = "users"
@@ -29,6 +38,7 @@ class User(Base):
     oauth_id = Column(String(255), nullable=True)
     created_at = Column(DateTime, default=func.now())
     avatar_url = Column(String(255), nullable=True)
+    token_version = Column(Integer, default=0, server_default="0", nullable=False)  # Bumped when token claims go stale
     
     # Relationships
     roles = relationship("Role", secondary=user_roles, back_populates="users")
@@ -47,7 +57,7 @@ class Role(Base):
     # Relationships
     users = relationship("User", secondary=user_roles, back_populates="roles")
 
-class UserProfile(Base):
+class UserProfile(RenderedHTML, Base):
     """Extended user profile information"""
     __tablename__ = "user_profiles"
     
@@ -70,9 +80,23 @@ class UserProfile(Base):
     reputation = Column(Integer, default=0)
     discord = Column(String(100), nullable=True)
     
+    # Sanitized HTML rendered from bio and signature when they are saved
+    bio_html = Column(Text, nullable=True)
+    signature_html = Column(Text, nullable=True)
+    render_version = Column(Integer, nullable=True)  # utils.RENDERER_VERSION used for the HTML
+    
     # Relationships
     user = relationship("User", back_populates="profile")
-    
+
+    def rendered_values(self):
+        """Returns the rendered HTML columns for the current bio and signature"""
+        bio_html, signature_html = render_markdown_many([self.bio, self.signature])
+        return {
+            "bio_html": bio_html,
+            "signature_html": signature_html,
+            "render_version": RENDERER_VERSION
+        }
+
     @property
     def tier_name(self):
         """Returns the name of the account tier"""
@@ -119,9 +143,26 @@ class Forum(Base):
     is_public = Column(Boolean, default=True)
     access_level = Column(Integer, default=0)  # Default to public access
     
+    # Denormalized statistics, kept up to date by forum_stats.py
+    thread_count = Column(Integer, default=0, server_default="0", nullable=False)
+    post_count = Column(Integer, default=0, server_default="0", nullable=False)  # Threads plus replies
+    last_post_at = Column(DateTime, nullable=True)
+    latest_thread_id = Column(Integer, nullable=True)
+    latest_thread_author_id = Column(Integer, nullable=True)
+    
     # Relationships
     category = relationship("Category", back_populates="forums")
     threads = relationship("Thread", back_populates="forum")
+    latest_thread = relationship(
+        "Thread",
+        primaryjoin="foreign(Forum.latest_thread_id) == Thread.id",
+        viewonly=True
+    )
+    latest_thread_author = relationship(
+        "User",
+        primaryjoin="foreign(Forum.latest_thread_author_id) == User.id",
+        viewonly=True
+    )
     
     def can_access(self, user):
         """Check if a user can access this forum based on their account tier"""
@@ -135,24 +176,8 @@ class Forum(Base):
             return False
             
         return user.profile.account_tier >= self.access_level
-            
-    @property
-    def post_count(self):
-        """Get the total number of posts across all threads in this forum"""
-        count = 0
-        for thread in self.threads:
-            # Count the initial post (thread content) plus all replies
-            count += 1 + len(thread.posts)
-        return count
-        
-    @property
-    def latest_thread(self):
-        """Get the most recent thread in this forum"""
-        if not self.threads:
-            return None
-        return sorted(self.threads, key=lambda t: t.created_at, reverse=True)[0]
 
-class Thread(Base):
+class Thread(RenderedHTML, Base):
     """Thread model for forum discussions"""
     __tablename__ = "threads"
     
@@ -167,10 +192,27 @@ class Thread(Base):
     is_locked = Column(Boolean, default=False)
     views = Column(Integer, default=0)
     
+    # Sanitized HTML rendered from content when it is saved
+    content_html = Column(Text, nullable=True)
+    render_version = Column(Integer, nullable=True)  # utils.RENDERER_VERSION used for the HTML
+    
     # Relationships
     forum = relationship("Forum", back_populates="threads")
     author = relationship("User", back_populates="threads")
     posts = relationship("Post", back_populates="thread")
+    
+    # Matches the keyset ordering of the forum thread list
+    __table_args__ = (
+        sqlalchemy.Index('ix_threads_forum_listing', 'forum_id', 'is_sticky', 'updated_at', 'id'),
+    )
+
+    def rendered_values(self):
+        """Returns the rendered HTML columns for the current content"""
+        return {
+            "content_html": render_markdown(self.content),
+            "render_version": RENDERER_VERSION
+        }
+
 
 class ThreadView(Base):
     """Model to track which users have viewed which threads"""
@@ -188,7 +230,7 @@ class ThreadView(Base):
     # Composite unique constraint to ensure each user/thread combo is unique
     __table_args__ = (sqlalchemy.UniqueConstraint('thread_id', 'user_id', name='_thread_user_view_uc'),)
 
-class Post(Base):
+class Post(RenderedHTML, Base):
     """Post model for thread replies"""
     __tablename__ = "posts"
     
@@ -200,9 +242,26 @@ class Post(Base):
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
     is_solution = Column(Boolean, default=False)
     
+    # Sanitized HTML rendered from content when it is saved
+    content_html = Column(Text, nullable=True)
+    render_version = Column(Integer, nullable=True)  # utils.RENDERER_VERSION used for the HTML
+    
     # Relationships
     thread = relationship("Thread", back_populates="posts")
     author = relationship("User", back_populates="posts")
+    
+    # Matches the keyset ordering of thread pages and post permalinks
+    __table_args__ = (
+        sqlalchemy.Index('ix_posts_thread_created', 'thread_id', 'created_at', 'id'),
+    )
+
+    def rendered_values(self):
+        """Returns the rendered HTML columns for the current content"""
+        return {
+            "content_html": render_markdown(self.content),
+            "render_version": RENDERER_VERSION
+        }
+
 
 class Shoutbox(Base):
     """Shoutbox messages model"""
@@ -218,7 +277,7 @@ class Shoutbox(Base):
     # Relationships
     user = relationship("User")
 
-class Product(Base):
+class Product(RenderedHTML, Base):
     """Product model for Sell.app integration and admin management"""
     __tablename__ = "products"
     
@@ -233,3 +292,35 @@ class Product(Base):
     is_featured = Column(Boolean, default=False)
     created_at = Column(DateTime, default=func.now())
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+    
+    # Sanitized HTML rendered from description when it is saved
+    description_html = Column(Text, nullable=True)
+    short_description_html = Column(Text, nullable=True)  # Truncated version for product cards
+    render_version = Column(Integer, nullable=True)  # utils.RENDERER_VERSION used for the HTML
+    
+    SHORT_DESCRIPTION_LENGTH = 250
+
+    def rendered_values(self):
+        """Returns the rendered HTML columns for the current description"""
+        description = self.description or ''
+        if len(description) > self.SHORT_DESCRIPTION_LENGTH:
+            short_description = description[:self.SHORT_DESCRIPTION_LENGTH] + "..."
+        else:
+            short_description = description
+
+        description_html, short_description_html = render_markdown_many([description, short_description])
+        return {
+            "description_html": description_html,
+            "short_description_html": short_description_html,
+            "render_version": RENDERER_VERSION
+        }
+
+class ThrottleHit(Base):
+    """Model for password attempts counted by login_throttle.py with the database backend"""
+    __tablename__ = "throttle_hits"
+    
+    id = Column(Integer, primary_key=True)
+    key = Column(String(255), nullable=False)  # e.g. "login-ip:203.0.113.7" or "login-user:alice"
+    hit_at = Column(Float, nullable=False)  # Unix time of the attempt
+    
+    __table_args__ = (sqlalchemy.Index('ix_throttle_hits_key_hit_at', 'key', 'hit_at'),)
@@ -0,0 +1,97 @@
+# passwords.py - Password hashing and verification in a bounded process pool
+
+"""
+Passwords for CottageWare
+
+bcrypt is deliberately slow: hashing or verifying a password takes 100-300 ms
+of CPU. Doing it in request threads let a burst of logins or registrations
+tie up the threadpool and compete with every other request for the CPU.
+hash_password() and verify_password() now hand the work to a dedicated pool
+of PASSWORD_HASH_WORKERS processes. At most PASSWORD_HASH_CONCURRENCY calls
+are in flight at once; callers wait up to PASSWORD_HASH_QUEUE_TIMEOUT seconds
+for a slot and then get PasswordHashingBusy.
+
+Hashes made with outdated settings (an older scheme or fewer bcrypt rounds
+than BCRYPT_ROUNDS) are reported by verify_password() with a replacement
+hash, so they can be upgraded on the next successful login.
+
+Workers are started with the "spawn" method, which imports the __main__
+module again in every worker, so scripts that import the app and hash
+passwords must keep their code under an `if __name__ == "__main__":` guard.
+"""
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+from passlib.context import CryptContext
+
+# bcrypt cost, hashes with fewer rounds are rehashed on login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+# Worker processes, calls in flight at once and how long a call waits for a slot
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_CONCURRENCY = int(os.getenv("PASSWORD_HASH_CONCURRENCY", str(PASSWORD_HASH_WORKERS * 4)))
+PASSWORD_HASH_QUEUE_TIMEOUT = float(os.getenv("PASSWORD_HASH_QUEUE_TIMEOUT", "10"))
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS
+)
+
+_pool = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(PASSWORD_HASH_CONCURRENCY)
+
+class PasswordHashingBusy(Exception):
+    """Raised when no hashing slot frees up within PASSWORD_HASH_QUEUE_TIMEOUT"""
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+def _verify_and_update(password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    return pwd_context.verify_and_update(password, hashed_password)
+
+def _get_pool() -> ProcessPoolExecutor:
+    """Starts the worker processes on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Workers are spawned rather than forked from a process running threads
+            _pool = ProcessPoolExecutor(
+                max_workers=PASSWORD_HASH_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pool
+
+def _run(func, *args):
+    """Runs func in the pool once a slot is free, blocking the calling thread until it is done"""
+    if not _slots.acquire(timeout=PASSWORD_HASH_QUEUE_TIMEOUT):
+        raise PasswordHashingBusy("Too many password checks in progress")
+    try:
+        return _get_pool().submit(func, *args).result()
+    finally:
+        _slots.release()
+
+def hash_password(password: str) -> str:
+    """Hashes a password with the current settings"""
+    return _run(_hash, password)
+
+def verify_password(password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """
+    Checks a password against a stored hash.
+    Returns (valid, new_hash), where new_hash is set when the password is valid
+    but the stored hash needs an update (see CryptContext.needs_update).
+    """
+    return _run(_verify_and_update, password, hashed_password)
+
+def shutdown_password_pool():
+    """Stops the worker processes, they are started again on the next call"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
@@ -0,0 +1,241 @@
+# presence.py - Online users list for the forum pages, kept in memory and sent as deltas
+
+"""
+Presence for CottageWare
+
+Every WebSocket connect and disconnect used to load every online user from
+the database and push the whole list to every socket, so a reconnect storm
+after a deploy cost a query per event and a full list per event per socket.
+
+Presence keeps the card of each online user (built once, when the socket is
+authenticated) and works out who is online from the ConnectionManager.
+Connects and disconnects only mark the list as changed; at most once every
+PRESENCE_DEBOUNCE_SECONDS the changes since the last update are broadcast as
+one "presence" message with the users who joined and left and the new
+counts. A newly connected client gets the full list as an "online_users"
+message from snapshot() instead.
+
+With several workers, each one publishes the state of its own connections
+(user ids, guest and connection counts) on the "presence" pub/sub topic when
+it changes, and in full every PRESENCE_HEARTBEAT_SECONDS. Every worker adds
+up the latest state of all workers and announces the changes to its own
+sockets. A worker that goes quiet for PRESENCE_WORKER_TIMEOUT_SECONDS is
+taken to be gone. Cards travel with a state only for users that are new to
+it, except in full states, which are also sent when a new worker shows up.
+"""
+
+import asyncio
+import time
+import uuid
+from typing import Dict, Optional
+from connection_manager import ConnectionManager
+from pubsub import PubSub
+
+# Window over which joins and leaves are collected into one broadcast
+PRESENCE_DEBOUNCE_SECONDS = 1.0
+
+# How often each worker publishes its full state, and when a worker that hasn't is forgotten
+PRESENCE_HEARTBEAT_SECONDS = 15
+PRESENCE_WORKER_TIMEOUT_SECONDS = 45
+
+DEFAULT_AVATAR_URL = "/static/images/default-avatar.png"
+
+def user_card(user) -> dict:
+    """The entry of a signed-in user in the online users list, the user's profile must be loaded"""
+    profile = user.profile
+    return {
+        "id": user.id,
+        "username": user.username,
+        "display_name": profile.display_name if profile and profile.display_name else None,
+        "avatar_url": user.avatar_url or DEFAULT_AVATAR_URL,
+        "account_tier": profile.account_tier if profile else 0,
+        "tier_name": profile.tier_name if profile else "Unregistered",
+        "is_registered": True
+    }
+
+class WorkerState:
+    """The last published presence state of another worker"""
+    __slots__ = ("user_ids", "guest_count", "connection_count", "seen_at")
+
+    def __init__(self, user_ids, guest_count: int, connection_count: int):
+        self.user_ids = set(user_ids)
+        self.guest_count = guest_count
+        self.connection_count = connection_count
+        self.seen_at = time.monotonic()
+
+class Presence:
+    """Who is online across all workers, announced to this worker's connections in debounced deltas"""
+
+    def __init__(self, connections: ConnectionManager, pubsub: PubSub, debounce_seconds: float = PRESENCE_DEBOUNCE_SECONDS):
+        self.connections = connections
+        self.pubsub = pubsub
+        self.debounce_seconds = debounce_seconds
+        self.worker_id = uuid.uuid4().hex
+        self._local_cards: Dict[int, dict] = {}  # user_id -> card of a user connected to this worker
+        self._remote_cards: Dict[int, dict] = {}  # user_id -> card of a user connected to another worker
+        self._workers: Dict[str, WorkerState] = {}  # worker_id -> state, for the other workers
+        self._published_users = set()
+        self._published_counts = None  # (guests, connections) last published
+        self._publish_all_cards = True
+        self._published_at = 0.0
+        self._announced_users = set()
+        self._announced_counts = {"guest_count": 0, "registered_count": 0, "total_count": 0}
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        pubsub.subscribe("presence", self._on_worker_state)
+
+    def start(self):
+        """Starts publishing and announcing changes, call on the event loop"""
+        self._changed.set()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops, telling the other workers to forget this one's connections"""
+        if self._task is not None:
+            self._task.cancel()
+        await self.pubsub.publish("presence", {"worker": self.worker_id, "gone": True})
+
+    def joined(self, card: Optional[dict] = None):
+        """Notes a connection added to the manager, with the card of its user if signed in"""
+        if card is not None:
+            self._local_cards[card["id"]] = card
+        self._changed.set()
+
+    def left(self):
+        """Notes a connection removed from the manager"""
+        self._changed.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._changed.wait(), PRESENCE_HEARTBEAT_SECONDS)
+                # Let the changes of the next moment join this one
+                await asyncio.sleep(self.debounce_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._changed.clear()
+            # Busy or not, the other workers hear from this one at least once a heartbeat
+            if time.monotonic() - self._published_at >= PRESENCE_HEARTBEAT_SECONDS:
+                self._publish_all_cards = True
+            try:
+                self._expire_workers()
+                await self._publish_state()
+                self._announce()
+            except Exception as e:
+                print(f"[DEBUG] Error updating presence: {e!r}")
+
+    def _on_worker_state(self, data: dict):
+        """Handles a state published by any worker, this one's own are skipped"""
+        worker_id = data["worker"]
+        if worker_id == self.worker_id:
+            return
+        if data.get("gone"):
+            self._workers.pop(worker_id, None)
+        else:
+            if worker_id not in self._workers:
+                # A new worker has none of our cards yet
+                self._publish_all_cards = True
+            self._workers[worker_id] = WorkerState(data["users"], data["guests"], data["connections"])
+            for card in data["cards"]:
+                self._remote_cards[card["id"]] = card
+        self._changed.set()
+
+    def _expire_workers(self):
+        now = time.monotonic()
+        for worker_id in [worker_id for worker_id, state in self._workers.items()
+                          if now - state.seen_at > PRESENCE_WORKER_TIMEOUT_SECONDS]:
+            print(f"[DEBUG] Forgetting presence of silent worker {worker_id}")
+            del self._workers[worker_id]
+
+        remote_users = set().union(*(state.user_ids for state in self._workers.values()))
+        for user_id in [user_id for user_id in self._remote_cards if user_id not in remote_users]:
+            del self._remote_cards[user_id]
+
+    async def _publish_state(self):
+        """Publishes the state of this worker's connections if it changed, or in full when due"""
+        local_users = set(self.connections.user_ids())
+        for user_id in [user_id for user_id in self._local_cards if user_id not in local_users]:
+            del self._local_cards[user_id]
+
+        counts = (self.connections.guest_count, len(self.connections))
+        if local_users == self._published_users and counts == self._published_counts and not self._publish_all_cards:
+            return
+
+        card_users = local_users if self._publish_all_cards else local_users - self._published_users
+        self._published_users = local_users
+        self._published_counts = counts
+        self._publish_all_cards = False
+        self._published_at = time.monotonic()
+        await self.pubsub.publish("presence", {
+            "worker": self.worker_id,
+            "users": sorted(local_users),
+            "cards": [self._local_cards[user_id] for user_id in card_users if user_id in self._local_cards],
+            "guests": counts[0],
+            "connections": counts[1]
+        })
+
+    def _online(self):
+        """(user ids, guest count, connection count) across all workers, this one counted as it is now"""
+        user_ids = set(self.connections.user_ids())
+        guest_count = self.connections.guest_count
+        connection_count = len(self.connections)
+        for state in self._workers.values():
+            user_ids |= state.user_ids
+            guest_count += state.guest_count
+            connection_count += state.connection_count
+        return user_ids, guest_count, connection_count
+
+    def _card(self, user_id: int) -> Optional[dict]:
+        return self._local_cards.get(user_id) or self._remote_cards.get(user_id)
+
+    def counts(self) -> dict:
+        """The counts of the last presence update, safe to read from any thread"""
+        return self._announced_counts
+
+    def snapshot(self) -> dict:
+        """The full online users list, in the format of the "online_users" message"""
+        user_ids, guest_count, connection_count = self._online()
+        online_users = [card for card in map(self._card, user_ids) if card is not None]
+
+        # If there are guests, add a single entry for them in the users list
+        if guest_count > 0:
+            online_users.append({
+                "id": 0,  # Special ID for guests
+                "username": f"Guests ({guest_count})",
+                "avatar_url": DEFAULT_AVATAR_URL,
+                "account_tier": 0,
+                "tier_name": "Guest",
+                "is_registered": False,
+                "count": guest_count
+            })
+
+        # Registered users first, then guests
+        online_users.sort(key=lambda x: (not x.get("is_registered"), x.get("username", "").lower()))
+        return {
+            "users": online_users,
+            "guest_count": guest_count,
+            "registered_count": len(user_ids),
+            "total_count": connection_count
+        }
+
+    def _announce(self):
+        """Sends the changes since the last update to this worker's connections, if there are any"""
+        user_ids, guest_count, connection_count = self._online()
+        counts = {"guest_count": guest_count, "registered_count": len(user_ids), "total_count": connection_count}
+        # Users whose card hasn't arrived yet are announced once it has
+        listed = {user_id for user_id in user_ids if self._card(user_id) is not None}
+        joined = listed - self._announced_users
+        left = self._announced_users - listed
+        if not joined and not left and counts == self._announced_counts:
+            return
+
+        self._announced_users = listed
+        self._announced_counts = counts
+        self.connections.broadcast({
+            "type": "presence",
+            "data": {
+                "joined": [self._card(user_id) for user_id in joined],
+                "left": sorted(left),
+                **counts
+            }
+        })
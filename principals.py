@@ -0,0 +1,188 @@
+# principals.py - Short-lived cache of the signed-in user behind an access token
+
+"""
+Principals for CottageWare
+
+Every page view used to decode the access token and load the User row it
+names, and admin pages did it a second time in admin_required(). The parts of
+the user that request handlers and templates read (id, username, is_active,
+account tier and display name) are now kept as a Principal in a process-wide
+LRU cache keyed by the token subject, so an authenticated page view no longer
+costs a query.
+
+Code that changes any of these fields, deactivates or deletes a user must
+call invalidate_principal() after committing. Principals also expire after
+PRINCIPAL_TTL_SECONDS so changes made by other processes, such as
+make_admin.py, show up quickly.
+
+Access tokens also carry these fields as signed claims (principal_claims()),
+along with the user's token_version at the time. principal_from_claims()
+trusts them as long as the version still matches, which only needs the
+cached version of the user rather than their row and profile. Such changes
+must therefore also call revoke_claims() before committing; tokens minted
+earlier then fall back to get_principal().
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from sqlalchemy.orm import Session, joinedload
+from database import SessionLocal
+from models import User
+
+# Maximum number of cached principals and how long one stays valid
+PRINCIPAL_CACHE_SIZE = 4096
+PRINCIPAL_TTL_SECONDS = 30
+
+_principals = OrderedDict()  # token subject -> (expires_at, principal)
+_token_versions = OrderedDict()  # user_id -> (expires_at, token_version)
+_principals_lock = threading.Lock()
+_invalidations = 0  # Bumped on every invalidation, see get_principal
+
+class PrincipalProfile:
+    """The profile fields of a Principal, read as principal.profile like on User"""
+    __slots__ = ("account_tier", "display_name")
+
+    def __init__(self, account_tier: int, display_name: Optional[str]):
+        self.account_tier = account_tier
+        self.display_name = display_name
+
+class Principal:
+    """
+    The signed-in user as request handlers and templates see it.
+    Has the same id, username, is_active and profile attributes as User, with
+    profile set to None for users without one, but isn't bound to a Session.
+    """
+    __slots__ = ("id", "username", "is_active", "profile")
+
+    def __init__(self, id: int, username: str, is_active: bool, profile: Optional[PrincipalProfile]):
+        self.id = id
+        self.username = username
+        self.is_active = is_active
+        self.profile = profile
+
+    @classmethod
+    def from_user(cls, user: User) -> "Principal":
+        """Builds the principal of a user with its profile loaded"""
+        profile = None
+        if user.profile:
+            profile = PrincipalProfile(user.profile.account_tier, user.profile.display_name)
+        return cls(user.id, user.username, user.is_active, profile)
+
+def load_principal(db: Session, username: str) -> Optional[Principal]:
+    """Loads the principal of a user from the database, or None if there is no such user"""
+    user = db.query(User).options(joinedload(User.profile)).filter(User.username == username).first()
+    return Principal.from_user(user) if user else None
+
+def get_principal(username: str, db: Optional[Session] = None) -> Optional[Principal]:
+    """
+    Returns the principal for a token subject, or None if there is no such user.
+    Cached principals are reused; on a miss the user is loaded with `db`, or
+    with a short-lived session of its own when none is given.
+    """
+    now = time.monotonic()
+    with _principals_lock:
+        generation = _invalidations
+        entry = _principals.get(username)
+        if entry is not None:
+            if entry[0] > now:
+                _principals.move_to_end(username)
+                return entry[1]
+            del _principals[username]
+
+    if db is None:
+        with SessionLocal() as session:
+            principal = load_principal(session, username)
+    else:
+        principal = load_principal(db, username)
+
+    # Unknown subjects aren't cached, so a user registered under that name is seen right away
+    if principal is None:
+        return None
+
+    with _principals_lock:
+        # A principal loaded while an invalidation happened may be stale, so it is not cached
+        if generation == _invalidations:
+            _principals[username] = (now + PRINCIPAL_TTL_SECONDS, principal)
+            _principals.move_to_end(username)
+            while len(_principals) > PRINCIPAL_CACHE_SIZE:
+                _principals.popitem(last=False)
+
+    return principal
+
+def principal_claims(user: User) -> dict:
+    """The claims an access token carries for a user with its profile loaded"""
+    profile = user.profile
+    return {
+        "uid": user.id,
+        "tier": profile.account_tier if profile else None,
+        "name": profile.display_name if profile else None,
+        "act": bool(user.is_active),
+        "ver": user.token_version or 0
+    }
+
+def get_token_version(user_id: int) -> Optional[int]:
+    """Returns the current token version of a user, or None if there is no such user"""
+    now = time.monotonic()
+    with _principals_lock:
+        generation = _invalidations
+        entry = _token_versions.get(user_id)
+        if entry is not None:
+            if entry[0] > now:
+                _token_versions.move_to_end(user_id)
+                return entry[1]
+            del _token_versions[user_id]
+
+    with SessionLocal() as db:
+        version = db.query(User.token_version).filter(User.id == user_id).scalar()
+
+    if version is None:
+        return None
+
+    with _principals_lock:
+        if generation == _invalidations:
+            _token_versions[user_id] = (now + PRINCIPAL_TTL_SECONDS, version)
+            _token_versions.move_to_end(user_id)
+            while len(_token_versions) > PRINCIPAL_CACHE_SIZE:
+                _token_versions.popitem(last=False)
+
+    return version
+
+def principal_from_claims(payload: dict) -> Optional[Principal]:
+    """
+    Builds the principal from the claims of a decoded token.
+    Returns None if the token has no claims or they are from an older token version.
+    """
+    user_id = payload.get("uid")
+    if user_id is None or "ver" not in payload:
+        return None
+    if get_token_version(user_id) != payload["ver"]:
+        return None
+
+    profile = None
+    if payload.get("tier") is not None:
+        profile = PrincipalProfile(payload["tier"], payload.get("name"))
+    return Principal(user_id, payload["sub"], payload.get("act", True), profile)
+
+def revoke_claims(user: User):
+    """Makes tokens minted before a change to the user stop vouching for it, call before committing"""
+    user.token_version = (user.token_version or 0) + 1
+
+def invalidate_principal(user_id: int):
+    """Drops the cached principal of a user, call after committing a change to it"""
+    global _invalidations
+    with _principals_lock:
+        _invalidations += 1
+        # Keyed by username, which may have just changed, so match on the id
+        for username in [username for username, (_, principal) in _principals.items() if principal.id == user_id]:
+            del _principals[username]
+        _token_versions.pop(user_id, None)
+
+def clear_principals():
+    """Drops every cached principal"""
+    global _invalidations
+    with _principals_lock:
+        _invalidations += 1
+        _principals.clear()
+        _token_versions.clear()
@@ -0,0 +1,310 @@
+# pubsub.py - Publish/subscribe between the app's worker processes for WebSocket broadcasts
+
+"""
+Pub/sub for CottageWare
+
+Each worker process only holds its own WebSocket connections, so a shoutbox
+message or presence change has to reach the other workers before they can
+send it to their clients. Broadcasts are published here under a topic and
+every worker, including the one that published, gets them back through the
+handlers subscribed to that topic and fans them out to its own sockets.
+
+PUBSUB_BACKEND picks how messages travel:
+
+- "memory" (the default): within this process only, for a single worker.
+- "unix": through a hub on the Unix socket PUBSUB_UNIX_PATH, for several
+  workers on one host. The worker holding a lock on PUBSUB_UNIX_PATH.lock
+  runs the hub and every worker connects to it; if that worker goes away
+  the lock is released and another one takes over.
+- "postgres": with LISTEN/NOTIFY on the PUBSUB_CHANNEL channel of the app's
+  Postgres database, for workers on several hosts. Messages over the NOTIFY
+  payload limit are sent in parts within one transaction.
+
+Handlers are plain functions called on the event loop with the published
+data. While a worker can't reach the hub or the database, what it publishes
+is only delivered locally.
+"""
+
+import asyncio
+import json
+import os
+import re
+import tempfile
+import uuid
+from typing import Callable, Dict, List, Optional
+from connection_manager import encode_message
+
+PUBSUB_BACKEND = os.getenv("PUBSUB_BACKEND", "memory")
+PUBSUB_UNIX_PATH = os.getenv("PUBSUB_UNIX_PATH", os.path.join(tempfile.gettempdir(), "cottageware-pubsub.sock"))
+PUBSUB_CHANNEL = os.getenv("PUBSUB_CHANNEL", "cottageware_broadcast")
+
+# Seconds between attempts to reach the hub or the database again
+RECONNECT_DELAY_SECONDS = 1
+
+# Longest line the hub accepts, and how much it buffers for a worker before dropping it
+HUB_LINE_LIMIT = 16 * 1024 * 1024
+HUB_MAX_BUFFER = 64 * 1024 * 1024
+
+# NOTIFY payloads must stay under 8000 bytes, this leaves room for the part header
+NOTIFY_CHUNK_SIZE = 7000
+
+# Messages whose parts are still arriving, beyond which the oldest are dropped
+NOTIFY_PENDING_LIMIT = 100
+
+class PubSub:
+    """In-process pub/sub, the base of the cross-process backends"""
+
+    def __init__(self):
+        self._handlers: Dict[str, List[Callable[[dict], None]]] = {}
+
+    def subscribe(self, topic: str, handler: Callable[[dict], None]):
+        """Calls handler with the data of every message published to the topic"""
+        self._handlers.setdefault(topic, []).append(handler)
+
+    def _dispatch(self, topic: str, data: dict):
+        for handler in self._handlers.get(topic, []):
+            try:
+                handler(data)
+            except Exception as e:
+                print(f"[DEBUG] Error handling {topic} message: {e!r}")
+
+    def _dispatch_envelope(self, raw: str):
+        """Dispatches a message received from another process"""
+        try:
+            envelope = json.loads(raw)
+        except ValueError as e:
+            print(f"[DEBUG] Dropping malformed pub/sub message: {e}")
+            return
+        self._dispatch(envelope["topic"], envelope["data"])
+
+    async def start(self):
+        pass
+
+    async def publish(self, topic: str, data: dict):
+        """Delivers a message to the subscribers of the topic in every worker"""
+        self._dispatch(topic, data)
+
+    async def stop(self):
+        pass
+
+class UnixSocketPubSub(PubSub):
+    """Pub/sub through a hub on a Unix socket, for workers on one host"""
+
+    def __init__(self, path: str = PUBSUB_UNIX_PATH):
+        super().__init__()
+        self.path = path
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._hub: Optional[asyncio.AbstractServer] = None
+        self._hub_clients = set()
+        self._hub_lock = None  # Lock file held while this worker runs the hub
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        """Stays connected to the hub, starting one when there is none"""
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(self.path, limit=HUB_LINE_LIMIT)
+            except (FileNotFoundError, ConnectionRefusedError):
+                await self._start_hub()
+                continue
+            except OSError as e:
+                print(f"[DEBUG] Can't reach the pub/sub hub: {e!r}")
+                await asyncio.sleep(RECONNECT_DELAY_SECONDS)
+                continue
+
+            try:
+                while line := await reader.readline():
+                    self._dispatch_envelope(line.decode())
+            except (OSError, ValueError) as e:
+                print(f"[DEBUG] Lost the pub/sub hub: {e!r}")
+            finally:
+                self._writer.close()
+                self._writer = None
+            await asyncio.sleep(RECONNECT_DELAY_SECONDS)
+
+    async def _start_hub(self):
+        """Runs the hub in this worker, unless another worker holds the hub lock"""
+        if self._hub is not None:
+            await asyncio.sleep(RECONNECT_DELAY_SECONDS)
+            return
+        import fcntl  # Unix only, like the socket itself
+        lock = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # Another worker runs the hub or is starting it
+            lock.close()
+            await asyncio.sleep(RECONNECT_DELAY_SECONDS / 10)
+            return
+
+        try:
+            # With the lock held nobody else serves the socket, so the file is left over from a hub that died
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self._hub = await asyncio.start_unix_server(self._serve_hub_client, self.path, limit=HUB_LINE_LIMIT)
+            self._hub_lock = lock
+            print(f"[DEBUG] Started the pub/sub hub on {self.path}")
+        except OSError as e:
+            lock.close()
+            print(f"[DEBUG] Didn't start the pub/sub hub: {e!r}")
+            await asyncio.sleep(RECONNECT_DELAY_SECONDS)
+
+    async def _serve_hub_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Forwards every line a worker sends to all workers, itself included"""
+        self._hub_clients.add(writer)
+        try:
+            while line := await reader.readline():
+                for client in list(self._hub_clients):
+                    # A worker that stopped reading is dropped, it reconnects and carries on
+                    if client.transport.get_write_buffer_size() > HUB_MAX_BUFFER:
+                        self._hub_clients.discard(client)
+                        client.close()
+                        continue
+                    client.write(line)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self._hub_clients.discard(writer)
+            writer.close()
+
+    async def publish(self, topic: str, data: dict):
+        writer = self._writer
+        if writer is None:
+            self._dispatch(topic, data)
+            return
+        try:
+            writer.write(encode_message({"topic": topic, "data": data}).encode() + b"\n")
+            await writer.drain()
+        except OSError as e:
+            print(f"[DEBUG] Couldn't publish to the pub/sub hub: {e!r}")
+            # Like while disconnected, at least this worker's own connections get it
+            self._dispatch(topic, data)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+        if self._hub is not None:
+            self._hub.close()
+            for client in list(self._hub_clients):
+                client.close()
+            # The next worker to connect starts a new hub
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            self._hub_lock.close()
+
+class PostgresPubSub(PubSub):
+    """Pub/sub with Postgres LISTEN/NOTIFY, for workers on several hosts"""
+
+    def __init__(self, channel: str = PUBSUB_CHANNEL):
+        super().__init__()
+        if not re.fullmatch(r"[a-z_][a-z0-9_]*", channel):
+            raise ValueError(f"PUBSUB_CHANNEL must be a lowercase identifier, got {channel!r}")
+        self.channel = channel
+        self._listener = None
+        self._task: Optional[asyncio.Task] = None
+        self._parts: Dict[str, List[Optional[str]]] = {}  # message id -> parts received so far
+
+    async def start(self):
+        self._task = asyncio.create_task(self._listen())
+
+    def _connect(self):
+        """Opens the listening connection, outside the pool since it is never returned. Blocks."""
+        import psycopg2
+        from database import engine
+        dsn = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+        connection = psycopg2.connect(dsn)
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {self.channel}")
+        return connection
+
+    async def _listen(self):
+        """Keeps a listening connection open and dispatches its notifications"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                self._listener = await asyncio.to_thread(self._connect)
+            except Exception as e:
+                print(f"[DEBUG] Can't listen for pub/sub notifications: {e!r}")
+                await asyncio.sleep(RECONNECT_DELAY_SECONDS)
+                continue
+
+            lost = loop.create_future()
+            loop.add_reader(self._listener.fileno(), self._on_readable, lost)
+            try:
+                await lost
+            finally:
+                loop.remove_reader(self._listener.fileno())
+                self._listener.close()
+                self._listener = None
+            await asyncio.sleep(RECONNECT_DELAY_SECONDS)
+
+    def _on_readable(self, lost: asyncio.Future):
+        try:
+            self._listener.poll()
+        except Exception as e:
+            print(f"[DEBUG] Lost the pub/sub listening connection: {e!r}")
+            if not lost.done():
+                lost.set_result(None)
+            return
+        while self._listener.notifies:
+            self._receive(self._listener.notifies.pop(0).payload)
+
+    def _receive(self, payload: str):
+        """Collects the parts of a message and dispatches it once all have arrived"""
+        message_id, index, count, part = payload.split(" ", 3)
+        index, count = int(index), int(count)
+        if count == 1:
+            self._dispatch_envelope(part)
+            return
+
+        parts = self._parts.setdefault(message_id, [None] * count)
+        parts[index] = part
+        if None not in parts:
+            del self._parts[message_id]
+            self._dispatch_envelope("".join(parts))
+        elif len(self._parts) > NOTIFY_PENDING_LIMIT:
+            del self._parts[next(iter(self._parts))]
+
+    def _notify(self, parts: List[str]):
+        """Sends the parts of one message in a single transaction, so they arrive together. Blocks."""
+        from sqlalchemy import text
+        from database import engine
+        with engine.begin() as connection:
+            for part in parts:
+                connection.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": self.channel, "payload": part})
+
+    async def publish(self, topic: str, data: dict):
+        if self._listener is None:
+            self._dispatch(topic, data)
+            return
+        # ASCII-only JSON, so the parts can be cut anywhere and are as long in bytes as in characters
+        raw = json.dumps({"topic": topic, "data": data}, separators=(",", ":"))
+        message_id = uuid.uuid4().hex[:12]
+        chunks = [raw[start:start + NOTIFY_CHUNK_SIZE] for start in range(0, len(raw), NOTIFY_CHUNK_SIZE)]
+        parts = [f"{message_id} {index} {len(chunks)} {chunk}" for index, chunk in enumerate(chunks)]
+        try:
+            await asyncio.to_thread(self._notify, parts)
+        except Exception as e:
+            print(f"[DEBUG] Couldn't publish pub/sub notification: {e!r}")
+            # Like while not listening, at least this worker's own connections get it
+            self._dispatch(topic, data)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+def create_pubsub() -> PubSub:
+    """The backend chosen by PUBSUB_BACKEND"""
+    if PUBSUB_BACKEND == "unix":
+        return UnixSocketPubSub()
+    if PUBSUB_BACKEND == "postgres":
+        return PostgresPubSub()
+    return PubSub()
@@ -0,0 +1,322 @@
+# queries.py - Named loaders that fetch what each page renders in a fixed number of queries
+
+"""
+Query layer for CottageWare
+
+Templates follow relationships such as thread.author.profile, thread.forum and
+forum.latest_thread, which would otherwise be lazy-loaded with one round trip
+per row. Each loader here fetches everything its page renders up front with
+selectinload/joinedload, and counts with grouped queries, so the number of
+queries per page doesn't grow with the number of rows shown. Routes in main.py
+and admin.py use these loaders instead of building their own queries.
+"""
+
+from datetime import datetime
+from typing import Dict, List, Optional
+from sqlalchemy import func, or_, and_, false
+from sqlalchemy.orm import Session, selectinload, joinedload, contains_eager
+from sqlalchemy.orm.attributes import set_committed_value
+from models import User, Category, Forum, Thread, Post, Shoutbox, Product
+from utils import encode_cursor
+
+# Rows shown beside the forum index and on profile pages
+RECENT_THREADS_LIMIT = 5
+SHOUTBOX_MESSAGES_LIMIT = 10
+PROFILE_ACTIVITY_LIMIT = 10
+
+# Shared pieces
+
+def recent_threads(db: Session, limit: int = RECENT_THREADS_LIMIT):
+    """Newest threads with their authors"""
+    return db.query(Thread).options(
+        joinedload(Thread.author).joinedload(User.profile)
+    ).order_by(Thread.created_at.desc()).limit(limit).all()
+
+def shoutbox_messages(db: Session, shoutbox_type: str, limit: int = SHOUTBOX_MESSAGES_LIMIT):
+    """Newest shoutbox messages of a type with their users, the forum pages show them from shoutbox_history"""
+    return db.query(Shoutbox).join(User, User.id == Shoutbox.user_id) \
+        .options(contains_eager(Shoutbox.user).joinedload(User.profile)) \
+        .filter(Shoutbox.shoutbox_type == shoutbox_type) \
+        .order_by(Shoutbox.created_at.desc()).limit(limit).all()
+
+def thread_reply_counts(db: Session, thread_ids: List[int]) -> Dict[int, int]:
+    """Number of replies of each thread in one grouped query, threads without replies are missing"""
+    if not thread_ids:
+        return {}
+
+    return dict(
+        db.query(Post.thread_id, func.count(Post.id))
+        .filter(Post.thread_id.in_(thread_ids))
+        .group_by(Post.thread_id).all()
+    )
+
+# Home page
+
+def home_page(db: Session):
+    """Latest threads and featured products for the home page"""
+    return {
+        "latest_threads": recent_threads(db),
+        "featured_products": db.query(Product).filter(Product.is_featured == True).all()
+    }
+
+# Forum index
+
+def forum_index_options():
+    """
+    Loader options for the forum index pages.
+    Forum statistics are stored on the forum rows, so only the latest thread
+    and its author need to be loaded alongside each forum.
+    """
+    return (
+        selectinload(Category.forums).selectinload(Forum.latest_thread),
+        selectinload(Category.forums).selectinload(Forum.latest_thread_author).joinedload(User.profile)
+    )
+
+def forum_index(db: Session, current_user: Optional[User], public: bool = True):
+    """
+    Categories and recent threads for /forum (public) or /forum/private.
+    Only forums the user can access are kept, and categories left empty are dropped.
+    """
+    categories = db.query(Category).options(*forum_index_options()) \
+        .filter(Category.is_public == public).order_by(Category.order).all()
+
+    for category in categories:
+        forums = [forum for forum in category.forums if forum.can_access(current_user) and forum.is_public == public]
+        # Replace the loaded collection without marking it changed, so nothing is flushed
+        set_committed_value(category, "forums", forums)
+
+    return {
+        "categories": [category for category in categories if category.forums],
+        "recent_threads": recent_threads(db)
+    }
+
+# Forum page
+
+def forum_with_category(db: Session, forum_id: int):
+    """A forum with its category, or None"""
+    return db.query(Forum).options(joinedload(Forum.category)).filter(Forum.id == forum_id).first()
+
+def forum_threads_page(db: Session, forum_id: int, cursor: Optional[list], limit: int):
+    """
+    One page of threads of a forum with their authors.
+    Threads are ordered by (is_sticky, updated_at, id) and cursor is the decoded
+    position of the last thread on the previous page (None for the first page).
+
+    Returns:
+        tuple: The threads and the cursor of the next page (None on the last page)
+    """
+    threads_query = db.query(Thread).options(
+        joinedload(Thread.author).joinedload(User.profile)
+    ).filter(Thread.forum_id == forum_id)
+
+    # is_sticky is nullable, a NULL thread sorts and pages as non-sticky
+    sticky = func.coalesce(Thread.is_sticky, false())
+
+    if cursor:
+        is_sticky, updated_at, last_thread_id = cursor
+        later_in_section = and_(
+            sticky == bool(is_sticky),
+            or_(
+                Thread.updated_at < updated_at,
+                and_(Thread.updated_at == updated_at, Thread.id < last_thread_id)
+            )
+        )
+        if is_sticky:
+            # Every non-sticky thread comes after the sticky ones
+            threads_query = threads_query.filter(or_(sticky == False, later_in_section))
+        else:
+            threads_query = threads_query.filter(later_in_section)
+
+    # Fetch one extra thread to know if there is another page
+    threads = threads_query.order_by(
+        sticky.desc(), Thread.updated_at.desc(), Thread.id.desc()
+    ).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(threads) > limit:
+        threads = threads[:limit]
+        last_thread = threads[-1]
+        next_cursor = encode_cursor(bool(last_thread.is_sticky), last_thread.updated_at, last_thread.id)
+
+    return threads, next_cursor
+
+def get_thread_reply_stats(db: Session, thread_ids: List[int]):
+    """
+    Get reply count and last reply (time and author) for a page of threads in one query.
+    Returns a dict keyed by thread id; threads without replies are missing from it.
+    """
+    if not thread_ids:
+        return {}
+
+    ranked_posts = db.query(
+        Post.thread_id.label("thread_id"),
+        Post.author_id.label("author_id"),
+        Post.created_at.label("created_at"),
+        func.count(Post.id).over(partition_by=Post.thread_id).label("reply_count"),
+        func.row_number().over(
+            partition_by=Post.thread_id,
+            order_by=(Post.created_at.desc(), Post.id.desc())
+        ).label("rank")
+    ).filter(Post.thread_id.in_(thread_ids)).subquery()
+
+    rows = db.query(ranked_posts.c.thread_id, ranked_posts.c.reply_count, ranked_posts.c.created_at, User) \
+        .outerjoin(User, User.id == ranked_posts.c.author_id) \
+        .options(joinedload(User.profile)) \
+        .filter(ranked_posts.c.rank == 1).all()
+
+    return {
+        thread_id: {"reply_count": reply_count, "last_post_at": created_at, "last_post_author": author}
+        for thread_id, reply_count, created_at, author in rows
+    }
+
+# Thread page
+
+def thread_page(db: Session, thread_id: int):
+    """A thread with its forum and category (used by the breadcrumbs), or None"""
+    return db.query(Thread).options(
+        joinedload(Thread.forum).joinedload(Forum.category)
+    ).filter(Thread.id == thread_id).first()
+
+def post_with_thread(db: Session, post_id: int):
+    """A post with its thread, forum and category, or None"""
+    return db.query(Post).options(
+        joinedload(Post.thread).joinedload(Thread.forum).joinedload(Forum.category)
+    ).filter(Post.id == post_id).first()
+
+def visible_posts_query(db: Session, thread: Thread, current_user: Optional[User]):
+    """
+    Query for the replies of a thread that the current user is allowed to see.
+    If the user doesn't have the forum's access level they only see their own posts.
+    """
+    posts_query = db.query(Post).filter(Post.thread_id == thread.id)
+    forum = thread.forum
+
+    if forum.is_public or (current_user and current_user.profile and current_user.profile.account_tier >= forum.access_level):
+        return posts_query
+
+    # Users can always see their own posts
+    if current_user:
+        return posts_query.filter(Post.author_id == current_user.id)
+
+    return posts_query.filter(false())
+
+def posts_before(created_at: datetime, post_id: int):
+    """Filter for posts that sort before (created_at, post_id) in a thread"""
+    return or_(Post.created_at < created_at, and_(Post.created_at == created_at, Post.id < post_id))
+
+def posts_after(created_at: datetime, post_id: int):
+    """Filter for posts that sort after (created_at, post_id) in a thread"""
+    return or_(Post.created_at > created_at, and_(Post.created_at == created_at, Post.id > post_id))
+
+def thread_posts_page(posts_query, cursor: Optional[list], limit: int):
+    """
+    One page of replies from visible_posts_query, ordered by (created_at, id).
+    Authors are not loaded here, thread pages use author_cards.py for them.
+
+    Returns:
+        tuple: The posts and the cursor of the next page (None on the last page)
+    """
+    page_query = posts_query.filter(posts_after(*cursor)) if cursor else posts_query
+
+    # Fetch one extra post to know if there is another page
+    posts = page_query.order_by(Post.created_at, Post.id).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(posts) > limit:
+        posts = posts[:limit]
+        next_cursor = encode_cursor(posts[-1].created_at, posts[-1].id)
+
+    return posts, next_cursor
+
+def get_post_page_cursor(posts_query, post: Post, posts_per_page: int):
+    """
+    Get the cursor of the thread page holding a post, or None for the first page.
+    The post's position is counted on the (thread_id, created_at, id) index, and the
+    page boundary is at most posts_per_page rows behind it, so no deep OFFSET is needed.
+    """
+    earlier_posts = posts_query.filter(posts_before(post.created_at, post.id))
+    position = earlier_posts.count()
+    offset_in_page = position % posts_per_page
+    if position == offset_in_page:
+        return None
+
+    # The last post of the previous page is the cursor for this one
+    previous_post = earlier_posts.order_by(Post.created_at.desc(), Post.id.desc()) \
+        .offset(offset_in_page).limit(1).first()
+    return encode_cursor(previous_post.created_at, previous_post.id)
+
+def get_last_page_cursor(posts_query, total_posts: int, posts_per_page: int):
+    """Get the cursor of the last page of a thread, or None if it only has one page"""
+    if total_posts <= posts_per_page:
+        return None
+
+    last_page_start = ((total_posts - 1) // posts_per_page) * posts_per_page
+    previous_post = posts_query.order_by(Post.created_at.desc(), Post.id.desc()) \
+        .offset(total_posts - last_page_start).limit(1).first()
+    return encode_cursor(previous_post.created_at, previous_post.id)
+
+# Profile pages
+
+def profile_page(db: Session, user_id: int, username: Optional[str] = None):
+    """
+    A user with their profile and roles, their latest posts and threads, and activity counts.
+    Returns None if there is no such user (or the username doesn't match).
+    """
+    user_query = db.query(User).options(
+        joinedload(User.profile),
+        selectinload(User.roles)
+    ).filter(User.id == user_id)
+    if username is not None:
+        user_query = user_query.filter(User.username == username)
+
+    user = user_query.first()
+    if not user:
+        return None
+
+    posts = db.query(Post).options(joinedload(Post.thread)) \
+        .filter(Post.author_id == user.id) \
+        .order_by(Post.created_at.desc()).limit(PROFILE_ACTIVITY_LIMIT).all()
+    threads = db.query(Thread).options(joinedload(Thread.forum)) \
+        .filter(Thread.author_id == user.id) \
+        .order_by(Thread.created_at.desc()).limit(PROFILE_ACTIVITY_LIMIT).all()
+
+    return {
+        "user": user,
+        "posts": posts,
+        "threads": threads,
+        "post_count": db.query(func.count(Post.id)).filter(Post.author_id == user.id).scalar(),
+        "thread_count": db.query(func.count(Thread.id)).filter(Thread.author_id == user.id).scalar(),
+        "reply_counts": thread_reply_counts(db, [thread.id for thread in threads])
+    }
+
+# Admin pages
+
+def admin_users_page(db: Session, page: int, per_page: int):
+    """One page of users with their profiles, newest first"""
+    return db.query(User).options(joinedload(User.profile)) \
+        .order_by(User.id.desc()).offset((page - 1) * per_page).limit(per_page).all()
+
+def admin_user(db: Session, user_id: int):
+    """A user with their profile and roles for the edit form, or None"""
+    return db.query(User).options(
+        joinedload(User.profile),
+        selectinload(User.roles)
+    ).filter(User.id == user_id).first()
+
+def admin_forums(db: Session):
+    """Every forum with its category"""
+    return db.query(Forum).options(joinedload(Forum.category)) \
+        .order_by(Forum.category_id, Forum.order).all()
+
+def admin_threads_page(db: Session, page: int, per_page: int):
+    """
+    One page of threads with their authors and forums, newest first.
+
+    Returns:
+        tuple: The threads and their reply counts (see thread_reply_counts)
+    """
+    threads = db.query(Thread).options(
+        joinedload(Thread.author),
+        joinedload(Thread.forum)
+    ).order_by(Thread.created_at.desc()).offset((page - 1) * per_page).limit(per_page).all()
+    return threads, thread_reply_counts(db, [thread.id for thread in threads])
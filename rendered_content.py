@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# rendered_content.py - Keeps the stored *_html columns in step with the Markdown renderer
+
+"""
+Rendered content for CottageWare
+
+Threads, posts, profiles and products store sanitized HTML next to their
+Markdown source, rendered by the write paths when content is saved. Each row
+records the utils.RENDERER_VERSION it was rendered with; rows that are missing
+HTML or were rendered by an older version are re-rendered here in batches.
+"""
+
+import argparse
+import asyncio
+from sqlalchemy import or_, update, bindparam
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from database import SessionLocal
+from models import Thread, Post, UserProfile, Product
+from utils import RENDERER_VERSION
+
+# Models with rendered HTML columns
+RENDERED_MODELS = [Thread, Post, UserProfile, Product]
+
+# Rows re-rendered per model and batch, and the pause between background batches
+BATCH_SIZE = 200
+BATCH_PAUSE_SECONDS = 0.1
+
+def stale_rows_query(db: Session, model):
+    """Query for rows whose HTML is missing or was rendered by an older renderer"""
+    return db.query(model).filter(or_(
+        model.render_version == None,
+        model.render_version < RENDERER_VERSION
+    ))
+
+def rerender_batch(db: Session, batch_size: int = BATCH_SIZE):
+    """
+    Re-render one batch of stale rows for every model.
+    Rows are written with a bulk UPDATE that keeps updated_at as it is,
+    so re-rendering doesn't mark content as edited.
+
+    Returns:
+        int: The number of rows re-rendered
+    """
+    rendered = 0
+    for model in RENDERED_MODELS:
+        rows = stale_rows_query(db, model).order_by(model.id).limit(batch_size).all()
+        if not rows:
+            continue
+
+        table = model.__table__
+        values = [
+            {"row_id": row.id, **{f"new_{key}": value for key, value in row.rendered_values().items()}}
+            for row in rows
+        ]
+        columns = {key[len("new_"):]: bindparam(key) for key in values[0] if key != "row_id"}
+        if "updated_at" in table.c:
+            columns["updated_at"] = table.c.updated_at
+
+        # Rows saved (and so rendered) since they were loaded are left alone
+        statement = update(table).where(
+            table.c.id == bindparam("row_id"),
+            or_(table.c.render_version == None, table.c.render_version < RENDERER_VERSION)
+        ).values(**columns)
+        db.connection().execute(statement, values)
+        rendered += len(rows)
+
+    db.commit()
+    return rendered
+
+def rerender_stale_content(batch_size: int = BATCH_SIZE):
+    """Re-render stale rows batch by batch until none are left. Returns the number of rows re-rendered."""
+    total = 0
+    db = SessionLocal()
+    try:
+        while True:
+            rendered = rerender_batch(db, batch_size)
+            if not rendered:
+                return total
+            total += rendered
+            db.expunge_all()
+    finally:
+        db.close()
+
+def rerender_next_batch() -> int:
+    """Re-render one batch with a session of its own, so a cancelled caller doesn't close it mid-batch. Blocks."""
+    db = SessionLocal()
+    try:
+        return rerender_batch(db)
+    finally:
+        db.close()
+
+async def rerender_stale_content_in_background():
+    """
+    Background task started with the app.
+    Renders one batch at a time in the threadpool and pauses between batches,
+    so a renderer upgrade doesn't add markdown work to requests. Cancelled at
+    shutdown, a batch already in the threadpool still finishes.
+    """
+    total = 0
+    while True:
+        try:
+            rendered = await run_in_threadpool(rerender_next_batch)
+        except Exception as e:
+            print(f"Error re-rendering content: {e}")
+            return
+
+        if not rendered:
+            break
+        total += rendered
+        await asyncio.sleep(BATCH_PAUSE_SECONDS)
+
+    if total:
+        print(f"Re-rendered {total} rows with renderer version {RENDERER_VERSION}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-render stored HTML that is missing or out of date")
+    parser.add_argument("-b", "--batch-size", type=int, default=BATCH_SIZE, help="Rows per model and batch")
+
+    args = parser.parse_args()
+
+    try:
+        count = rerender_stale_content(args.batch_size)
+        print(f"Success: Re-rendered {count} rows with renderer version {RENDERER_VERSION}")
+    except Exception as e:
+        print(f"Error: {str(e)}")
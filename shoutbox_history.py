@@ -0,0 +1,99 @@
+# shoutbox_history.py - Recent shoutbox messages of each channel, kept in memory
+
+"""
+Shoutbox history for CottageWare
+
+/forum and /forum/private used to join shoutbox to users and sort by
+created_at on every page load to show the latest messages, and a socket that
+reconnected after a network blip never got what was sent while it was away.
+
+ShoutboxHistory keeps the last SHOUTBOX_HISTORY_SIZE messages of each
+channel in the form they are broadcast in. It is loaded from the database at
+startup and then fed every shoutbox broadcast, including those of the other
+workers, so the pages take their messages from it. A client that reconnects
+passes the id of the newest message it has as since_id and gets the messages
+after it replayed from here, without a query. A gap longer than the history
+is only replayed in part.
+
+Author details are those of when the message was sent, as in the broadcast.
+Pages read the history from the threadpool while broadcasts add to it on the
+event loop, so it is guarded by a lock.
+"""
+
+import bisect
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Dict, Iterable, List
+from sqlalchemy.orm import Session
+import queries
+from shoutbox_writer import shoutbox_message_data
+
+# Messages kept per channel, the longest gap a reconnecting client can catch up on
+SHOUTBOX_HISTORY_SIZE = 200
+
+def format_message_time(created_at: str) -> str:
+    """The time shown beside a message on the forum pages, from its ISO created_at"""
+    return datetime.fromisoformat(created_at).strftime('%m/%d/%Y %H:%M')
+
+class ShoutboxHistory:
+    """The latest broadcast data of each shoutbox channel, ordered by message id"""
+
+    def __init__(self, size: int = SHOUTBOX_HISTORY_SIZE):
+        self.size = size
+        self._channels: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def add(self, data: dict):
+        """Records a broadcast shoutbox message, messages already recorded are skipped"""
+        with self._lock:
+            self._insert(data)
+
+    def _insert(self, data: dict):
+        messages = self._channels.setdefault(data["shoutbox_type"], deque(maxlen=self.size))
+        if not messages or data["id"] > messages[-1]["id"]:
+            messages.append(data)
+            return
+        # Messages from other workers can arrive slightly out of order
+        index = bisect.bisect_left([message["id"] for message in messages], data["id"])
+        if index < len(messages) and messages[index]["id"] == data["id"]:
+            return
+        if len(messages) == self.size:
+            if index == 0:
+                return  # Older than everything kept
+            messages.popleft()
+            index -= 1
+        messages.insert(index, data)
+
+    def load(self, db: Session, channels: Iterable[str]):
+        """Fills the history of each channel from the database, merging with what was recorded meanwhile"""
+        loaded = {
+            channel: [
+                shoutbox_message_data({
+                    "id": message.id,
+                    "user_id": message.user_id,
+                    "message": message.message,
+                    "created_at": message.created_at,
+                    "shoutbox_type": message.shoutbox_type
+                }, message.user)
+                for message in queries.shoutbox_messages(db, channel, limit=self.size)
+            ]
+            for channel in channels
+        }
+        with self._lock:
+            for messages in loaded.values():
+                for data in reversed(messages):
+                    self._insert(data)
+
+    def recent(self, channel: str, limit: int = queries.SHOUTBOX_MESSAGES_LIMIT) -> List[dict]:
+        """The newest messages of a channel, newest first"""
+        with self._lock:
+            messages = self._channels.get(channel, ())
+            return [messages[index] for index in range(len(messages) - 1, max(-1, len(messages) - 1 - limit), -1)]
+
+    def since(self, channel: str, since_id: int) -> List[dict]:
+        """The messages of a channel after since_id, oldest first"""
+        with self._lock:
+            messages = list(self._channels.get(channel, ()))
+        index = bisect.bisect_right([message["id"] for message in messages], since_id)
+        return messages[index:]
@@ -0,0 +1,198 @@
+# shoutbox_writer.py - Group commit of shoutbox messages by a single writer task
+
+"""
+Shoutbox writer for CottageWare
+
+Every shoutbox message used to be its own transaction: the WebSocket handler
+ran add, commit and refresh on the connection's session, then loaded the
+author for the broadcast, and POST /shoutbox did the same. In a busy chat
+that is one fsync per message, each one waiting behind the others.
+
+Messages are now handed to ShoutboxWriter, whose single task collects what
+arrives within SHOUTBOX_BATCH_WINDOW_SECONDS (up to SHOUTBOX_BATCH_SIZE
+messages) and writes it in one transaction: a multi-row INSERT ... RETURNING
+for the ids and timestamps, and one query for the authors of the batch. Only
+then is each message broadcast, in the order it was submitted.
+
+submit() only waits for room in the queue, so a WebSocket can carry on
+reading while its message is written; save() also waits for the message to
+be stored. Messages of a batch that fails to write are dropped and the
+error is logged, or raised by save().
+"""
+
+import asyncio
+import time
+from typing import Awaitable, Callable, List, Optional
+from sqlalchemy import insert
+from sqlalchemy.orm import joinedload
+from starlette.concurrency import run_in_threadpool
+from database import SessionLocal, counted_as
+from models import User, Shoutbox
+
+# How long the writer waits for more messages after the first of a batch, and the most it writes at once
+SHOUTBOX_BATCH_WINDOW_SECONDS = 0.003
+SHOUTBOX_BATCH_SIZE = 200
+
+# Messages waiting to be written before submit() waits for room
+SHOUTBOX_QUEUE_SIZE = 2000
+
+DEFAULT_AVATAR_URL = "/static/images/default-avatar.png"
+
+def shoutbox_message_data(message: dict, user: Optional[User]) -> dict:
+    """The broadcast data of a stored shoutbox message, `user` is its author with the profile loaded"""
+    if user is None:
+        print(f"[DEBUG] User not found for message ID: {message['id']}, user_id: {message['user_id']}")
+        # Use a fallback for guest/system messages
+        return {
+            "id": message["id"],
+            "user_id": message["user_id"],
+            "username": "Guest",
+            "avatar_url": DEFAULT_AVATAR_URL,
+            "message": message["message"],
+            "created_at": message["created_at"].isoformat(),
+            "account_tier": 0,
+            "tier_name": "Guest",
+            "shoutbox_type": message["shoutbox_type"]
+        }
+    profile = user.profile
+    return {
+        "id": message["id"],
+        "user_id": user.id,
+        "username": user.username,
+        "display_name": profile.display_name if profile and profile.display_name else None,
+        "avatar_url": user.avatar_url or DEFAULT_AVATAR_URL,
+        "message": message["message"],
+        "created_at": message["created_at"].isoformat(),
+        "account_tier": profile.account_tier if profile else 0,
+        "tier_name": profile.tier_name if profile else "Unregistered",
+        "shoutbox_type": message["shoutbox_type"]
+    }
+
+def write_shoutbox_messages(messages: List[dict]) -> List[dict]:
+    """
+    Stores messages ({user_id, message, shoutbox_type}) in one transaction and
+    returns their broadcast data in the same order. Blocks.
+    """
+    db = SessionLocal()
+    try:
+        # One multi-row INSERT, with the generated fields returned in the order of the messages
+        statement = insert(Shoutbox).returning(Shoutbox.id, Shoutbox.created_at, sort_by_parameter_order=True)
+        rows = db.execute(statement, messages).all()
+        user_ids = {message["user_id"] for message in messages}
+        users = {user.id: user for user in db.query(User).options(joinedload(User.profile)).filter(User.id.in_(user_ids))}
+        db.commit()
+        return [
+            shoutbox_message_data({**message, "id": row.id, "created_at": row.created_at}, users.get(message["user_id"]))
+            for message, row in zip(messages, rows)
+        ]
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+class WriterMetrics:
+    """Counters of the batches written"""
+
+    def __init__(self):
+        self.batches = 0
+        self.messages = 0
+        self.failed_batches = 0
+        self.largest_batch = 0
+        self.write_seconds = 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            "batches": self.batches,
+            "messages": self.messages,
+            "failed_batches": self.failed_batches,
+            "largest_batch": self.largest_batch,
+            "mean_batch": round(self.messages / self.batches, 2) if self.batches else None,
+            "mean_write_ms": round(self.write_seconds * 1000 / self.batches, 3) if self.batches else None
+        }
+
+class ShoutboxWriter:
+    """Writes submitted shoutbox messages in batches, then hands each one's data to on_saved"""
+
+    def __init__(self, on_saved: Callable[[dict], Awaitable[None]],
+                 batch_window_seconds: float = SHOUTBOX_BATCH_WINDOW_SECONDS, batch_size: int = SHOUTBOX_BATCH_SIZE):
+        self.on_saved = on_saved
+        self.batch_window_seconds = batch_window_seconds
+        self.batch_size = batch_size
+        self.metrics = WriterMetrics()
+        self._queue: Optional[asyncio.Queue] = None  # (message, future) pairs, None to stop
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Starts the writer task, call on the event loop"""
+        self._queue = asyncio.Queue(maxsize=SHOUTBOX_QUEUE_SIZE)
+        # The task gets its own copy of the context, so its writes are counted under this name
+        with counted_as("shoutbox_writer"):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Writes the messages already submitted, then stops"""
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def submit(self, user_id: int, message: str, shoutbox_type: str = "public") -> asyncio.Future:
+        """Queues a message to be written and broadcast, returns a future of its broadcast data"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(({"user_id": user_id, "message": message, "shoutbox_type": shoutbox_type}, future))
+        return future
+
+    async def save(self, user_id: int, message: str, shoutbox_type: str = "public") -> dict:
+        """Writes and broadcasts a message, returns its broadcast data once it is stored"""
+        return await (await self.submit(user_id, message, shoutbox_type))
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            # Let the messages of the next few milliseconds join this one
+            deadline = time.monotonic() + self.batch_window_seconds
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait() if time.monotonic() >= deadline else \
+                        await asyncio.wait_for(self._queue.get(), deadline - time.monotonic())
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._write(batch)
+
+    async def _write(self, batch):
+        started = time.perf_counter()
+        try:
+            saved = await run_in_threadpool(write_shoutbox_messages, [message for message, _ in batch])
+        except Exception as e:
+            self.metrics.failed_batches += 1
+            print(f"[DEBUG] Error writing {len(batch)} shoutbox messages: {e!r}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+                    # Nobody may be waiting for it, don't warn that the error went unretrieved
+                    future.exception()
+            return
+
+        self.metrics.batches += 1
+        self.metrics.messages += len(batch)
+        self.metrics.largest_batch = max(self.metrics.largest_batch, len(batch))
+        self.metrics.write_seconds += time.perf_counter() - started
+        print(f"[DEBUG] Wrote {len(batch)} shoutbox messages in one transaction")
+
+        for (_, future), data in zip(batch, saved):
+            try:
+                await self.on_saved(data)
+            except Exception as e:
+                print(f"[DEBUG] Error broadcasting shoutbox message {data['id']}: {e!r}")
+            if not future.done():
+                future.set_result(data)
@@ -0,0 +1,180 @@
+# thread_views.py - Write-behind counter for thread views
+
+"""
+Thread views for CottageWare
+
+Viewing a thread used to be a write transaction: it bumped threads.views and
+inserted or updated the viewer's thread_views row on every GET. Views are now
+recorded in memory by record_thread_view() and written in batches by
+flush_thread_views(), which runs every VIEW_FLUSH_INTERVAL_SECONDS in the
+background and once more on shutdown.
+
+As before, guests count a view every time while registered users only count
+their first view of a thread; their later views just refresh viewed_at.
+Counters are kept per process, so each worker flushes its own views.
+"""
+
+import asyncio
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import Optional
+from sqlalchemy import func, insert, update, bindparam
+from sqlalchemy.dialects import postgresql, sqlite
+from starlette.concurrency import run_in_threadpool
+from database import SessionLocal
+from models import User, Thread, ThreadView
+
+# How often pending views are written, and how many thread_views rows go in one INSERT
+VIEW_FLUSH_INTERVAL_SECONDS = 5
+VIEW_INSERT_BATCH_SIZE = 500
+
+# INSERT ... ON CONFLICT for the databases that have it, others check for existing rows first
+_upsert_inserts = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert
+}
+
+_views_lock = threading.Lock()
+_guest_views = Counter()  # thread_id -> views
+_user_views = {}  # (thread_id, user_id) -> last viewed_at
+
+def record_thread_view(thread_id: int, user_id: Optional[int] = None):
+    """Record a view of a thread, to be written by the next flush"""
+    with _views_lock:
+        if user_id is None:
+            _guest_views[thread_id] += 1
+        else:
+            _user_views[(thread_id, user_id)] = datetime.now()
+
+def _take_pending_views():
+    """Swap out the pending views so new ones can be recorded while they are written"""
+    global _guest_views, _user_views
+    with _views_lock:
+        guest_views, user_views = _guest_views, _user_views
+        _guest_views, _user_views = Counter(), {}
+    return guest_views, user_views
+
+def _restore_pending_views(guest_views: Counter, user_views: dict):
+    """Put views back after a failed flush so the next one retries them"""
+    with _views_lock:
+        _guest_views.update(guest_views)
+        for key, viewed_at in user_views.items():
+            if key not in _user_views:
+                _user_views[key] = viewed_at
+
+def _insert_new_views(db, views: list) -> set:
+    """
+    Insert the thread_views rows that don't exist yet.
+
+    Returns:
+        set: The (thread_id, user_id) pairs that were inserted
+    """
+    upsert = _upsert_inserts.get(db.get_bind().dialect.name)
+    inserted = set()
+    for start in range(0, len(views), VIEW_INSERT_BATCH_SIZE):
+        batch = views[start:start + VIEW_INSERT_BATCH_SIZE]
+        if upsert is not None:
+            statement = upsert(ThreadView).values(batch) \
+                .on_conflict_do_nothing(index_elements=["thread_id", "user_id"]) \
+                .returning(ThreadView.thread_id, ThreadView.user_id)
+            inserted.update(tuple(row) for row in db.execute(statement))
+            continue
+
+        # Without ON CONFLICT a row another worker inserts meanwhile fails the flush, which is retried later
+        existing = {
+            tuple(row) for row in db.query(ThreadView.thread_id, ThreadView.user_id).filter(
+                ThreadView.thread_id.in_({view["thread_id"] for view in batch}),
+                ThreadView.user_id.in_({view["user_id"] for view in batch})
+            )
+        }
+        missing = [view for view in batch if (view["thread_id"], view["user_id"]) not in existing]
+        if missing:
+            db.execute(insert(ThreadView), missing)
+            inserted.update((view["thread_id"], view["user_id"]) for view in missing)
+    return inserted
+
+def flush_thread_views():
+    """
+    Write pending views to the database in one transaction.
+    New viewers are inserted with INSERT ... ON CONFLICT DO NOTHING (or after a
+    lookup of existing rows elsewhere), and the rows inserted are the first views
+    that count. Returning viewers get viewed_at
+    refreshed, and each thread then gets a single views = views + n update.
+
+    Returns:
+        int: The number of views added to threads
+    """
+    guest_views, user_views = _take_pending_views()
+    if not guest_views and not user_views:
+        return 0
+
+    db = SessionLocal()
+    try:
+        new_views = Counter(guest_views)
+
+        if user_views:
+            # Skip views of threads and users deleted since they were recorded
+            thread_ids = {thread_id for thread_id, _ in user_views}
+            user_ids = {user_id for _, user_id in user_views}
+            existing_threads = {row[0] for row in db.query(Thread.id).filter(Thread.id.in_(thread_ids))}
+            existing_users = {row[0] for row in db.query(User.id).filter(User.id.in_(user_ids))}
+            views = [
+                {"thread_id": thread_id, "user_id": user_id, "viewed_at": viewed_at}
+                for (thread_id, user_id), viewed_at in user_views.items()
+                if thread_id in existing_threads and user_id in existing_users
+            ]
+
+            inserted = _insert_new_views(db, views)
+            for thread_id, _ in inserted:
+                new_views[thread_id] += 1
+
+            returning_views = [
+                {"view_thread_id": view["thread_id"], "view_user_id": view["user_id"], "new_viewed_at": view["viewed_at"]}
+                for view in views if (view["thread_id"], view["user_id"]) not in inserted
+            ]
+            if returning_views:
+                db.connection().execute(
+                    update(ThreadView.__table__).where(
+                        ThreadView.__table__.c.thread_id == bindparam("view_thread_id"),
+                        ThreadView.__table__.c.user_id == bindparam("view_user_id")
+                    ).values(viewed_at=bindparam("new_viewed_at")),
+                    returning_views
+                )
+
+        if new_views:
+            # Keep updated_at as it is, views don't bump a thread in its forum
+            threads = Thread.__table__
+            db.connection().execute(
+                update(threads).where(threads.c.id == bindparam("thread_id")).values(
+                    views=func.coalesce(threads.c.views, 0) + bindparam("view_count"),
+                    updated_at=threads.c.updated_at
+                ),
+                [{"thread_id": thread_id, "view_count": count} for thread_id, count in new_views.items()]
+            )
+
+        db.commit()
+        return sum(new_views.values())
+    except Exception:
+        db.rollback()
+        _restore_pending_views(guest_views, user_views)
+        raise
+    finally:
+        db.close()
+
+async def flush_thread_views_periodically():
+    """
+    Background task started with the app, flushes pending views in the threadpool.
+    When cancelled during a flush it waits for the flush to finish first, so the
+    final flush at shutdown never runs alongside it.
+    """
+    while True:
+        await asyncio.sleep(VIEW_FLUSH_INTERVAL_SECONDS)
+        flush = asyncio.ensure_future(run_in_threadpool(flush_thread_views))
+        try:
+            await asyncio.shield(flush)
+        except asyncio.CancelledError:
+            await asyncio.wait([flush])
+            raise
+        except Exception as e:
+            print(f"Error flushing thread views: {e}")
@@ -0,0 +1,115 @@
+# turnstile.py - Cloudflare Turnstile verification for the login and registration forms
+
+"""
+Turnstile for CottageWare
+
+verify_turnstile() checks a form's Turnstile token with Cloudflare's
+siteverify endpoint. Requests go through one shared httpx.AsyncClient, so
+connections are kept alive between logins, and each verification gives up
+after TURNSTILE_TIMEOUT_SECONDS.
+
+When Cloudflare can't be reached or answers with an error, the result follows
+TURNSTILE_FAILURE_POLICY: "closed" (the default) rejects the form, "open"
+lets it through. Tokens that passed are remembered with the client's IP for
+TURNSTILE_REPLAY_TTL_SECONDS, so a double-submitted form isn't rejected as a
+duplicate by Cloudflare. The window is kept short and tied to the IP since
+Cloudflare makes tokens single-use, and a remembered token must not stand in
+for solving the challenge again.
+
+TURNSTILE_VERIFY_URL can point verification at a local stand-in server.
+Without TURNSTILE_SECRET_KEY verification is skipped, as in development.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TURNSTILE_SITE_KEY = os.getenv("TURNSTILE_SITE_KEY", "")
+TURNSTILE_SECRET_KEY = os.getenv("TURNSTILE_SECRET_KEY", "")
+TURNSTILE_VERIFY_URL = os.getenv("TURNSTILE_VERIFY_URL", "https://challenges.cloudflare.com/turnstile/v0/siteverify")
+TURNSTILE_TIMEOUT_SECONDS = float(os.getenv("TURNSTILE_TIMEOUT_SECONDS", "3"))
+TURNSTILE_FAILURE_POLICY = os.getenv("TURNSTILE_FAILURE_POLICY", "closed").lower()
+
+# Verified tokens remembered for double-submits of the same form from the same client
+TURNSTILE_REPLAY_TTL_SECONDS = 10
+TURNSTILE_REPLAY_CACHE_SIZE = 4096
+
+_client = None
+_verified = OrderedDict()  # sha256 of IP and token -> expires_at
+_verified_lock = threading.Lock()
+
+def get_client() -> httpx.AsyncClient:
+    """The shared client, created on first use"""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=TURNSTILE_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)
+        )
+    return _client
+
+async def close_client():
+    """Closes the shared client, a new one is created on the next verification"""
+    global _client
+    if _client is not None:
+        client, _client = _client, None
+        await client.aclose()
+
+def _token_key(token: str, remote_ip: Optional[str]) -> str:
+    return hashlib.sha256(f"{remote_ip or ''}\n{token}".encode()).hexdigest()
+
+def _was_verified(key: str) -> bool:
+    now = time.monotonic()
+    with _verified_lock:
+        expires_at = _verified.get(key)
+        if expires_at is None:
+            return False
+        if expires_at <= now:
+            del _verified[key]
+            return False
+        return True
+
+def _remember_verified(key: str):
+    with _verified_lock:
+        _verified[key] = time.monotonic() + TURNSTILE_REPLAY_TTL_SECONDS
+        _verified.move_to_end(key)
+        while len(_verified) > TURNSTILE_REPLAY_CACHE_SIZE:
+            _verified.popitem(last=False)
+
+async def verify_turnstile(turnstile_response: Optional[str], remote_ip: Optional[str] = None) -> bool:
+    """Verify Cloudflare Turnstile response"""
+    if not TURNSTILE_SECRET_KEY:
+        # If no secret key is configured, skip verification in development
+        return True
+    if not turnstile_response:
+        return False
+
+    key = _token_key(turnstile_response, remote_ip)
+    if _was_verified(key):
+        return True
+
+    data = {
+        "secret": TURNSTILE_SECRET_KEY,
+        "response": turnstile_response
+    }
+    if remote_ip:
+        data["remoteip"] = remote_ip
+
+    try:
+        resp = await get_client().post(TURNSTILE_VERIFY_URL, data=data)
+        resp.raise_for_status()
+        success = resp.json().get("success", False)
+    except (httpx.HTTPError, ValueError) as e:
+        print(f"Turnstile verification error: {e!r}")
+        return TURNSTILE_FAILURE_POLICY == "open"
+
+    if success:
+        _remember_verified(key)
+    return success
@@ -3,9 +3,14 @@ Utility functions for CottageWare
 """
 
 import re
+import json
+import base64
+import threading
 import markdown
 import bleach
-from typing import Optional, List, Tuple, Dict, Any, Union
+from markupsafe import Markup, escape
+from typing import Optional, List, Tuple, Dict, Any, Union, Sequence
+from datetime import datetime
 from markdown.extensions.nl2br import Nl2BrExtension
 from markdown.extensions.extra import ExtraExtension
 from markdown.extensions.sane_lists import SaneListExtension
@@ -109,62 +114,139 @@ def filter_offensive_content(content: Optional[str]) -> tuple[bool, Optional[str
     
     return True, content, None
 
+# Version of the render_markdown output stored in the *_html columns.
+# Bump this whenever render_markdown changes so stored HTML is re-rendered in the background.
+RENDERER_VERSION = 1
+
+# Custom extension for strikethrough
+class StrikethroughExtension(markdown.Extension):
+    def extendMarkdown(self, md):
+        # Create a pattern for ~~text~~
+        pattern = r'(~~)(.+?)(~~)'
+        # Create a markdown pattern
+        md.inlinePatterns.register(markdown.inlinepatterns.SimpleTagPattern(pattern, 'del'), 'strikethrough', 175)
+
+# Allowed tags and attributes for sanitized Markdown output
+MARKDOWN_ALLOWED_TAGS = [
+    'p', 'br', 'a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
+    'em', 'i', 'li', 'ol', 'strong', 'ul', 'h1', 'h2', 'h3', 'h4',
+    'h5', 'h6', 'hr', 'img', 'pre', 'span', 'table', 'tbody', 'td',
+    'th', 'thead', 'tr', 'del', 's', 'strike', 'div'
+]
+
+MARKDOWN_ALLOWED_ATTRIBUTES = {
+    'a': ['href', 'title', 'rel'],
+    'abbr': ['title'],
+    'acronym': ['title'],
+    'img': ['src', 'alt', 'title', 'width', 'height'],
+    'pre': ['class'],
+    'code': ['class'],
+    'div': ['class'],
+    '*': ['class']
+}
+
+class MarkdownRenderer:
+    """
+    Markdown pipeline and HTML sanitizer, built once and reused for every document.
+    Neither markdown.Markdown nor bleach.Cleaner is thread-safe, so each thread
+    gets its own renderer through get_markdown_renderer().
+    """
+    
+    def __init__(self):
+        # 'extra' includes tables, fenced_code, footnotes, and more
+        # 'nl2br' converts newlines to <br> tags
+        # 'sane_lists' makes lists behave more predictably
+        self.md = markdown.Markdown(
+            extensions=[
+                ExtraExtension(),
+                Nl2BrExtension(),
+                SaneListExtension(),
+                CodeHiliteExtension(),
+                TocExtension(),
+                StrikethroughExtension()  # Custom extension for strikethrough
+            ]
+        )
+        self.cleaner = bleach.Cleaner(
+            tags=MARKDOWN_ALLOWED_TAGS,
+            attributes=MARKDOWN_ALLOWED_ATTRIBUTES,
+            strip=True
+        )
+    
+    def render(self, text: Optional[str]) -> str:
+        """Renders one document, resetting per-document state (footnotes, toc, ...) first"""
+        if not text or text.strip() == '':
+            return ''
+        
+        self.md.reset()
+        return self.cleaner.clean(self.md.convert(text))
+
+_renderer_local = threading.local()
+
+def get_markdown_renderer() -> MarkdownRenderer:
+    """Returns the Markdown renderer of the current thread, building it on first use"""
+    renderer = getattr(_renderer_local, 'renderer', None)
+    if renderer is None:
+        renderer = _renderer_local.renderer = MarkdownRenderer()
+    return renderer
+
 def render_markdown(text: Optional[str]) -> str:
     """
     Renders Markdown text to HTML with sanitization.
     """
-    if not text or text.strip() == '':
-        return ''
-    
-    # Custom extension for strikethrough
-    class StrikethroughExtension(markdown.Extension):
-        def extendMarkdown(self, md):
-            # Create a pattern for ~~text~~
-            pattern = r'(~~)(.+?)(~~)'
-            # Create a markdown pattern
-            md.inlinePatterns.register(markdown.inlinepatterns.SimpleTagPattern(pattern, 'del'), 'strikethrough', 175)
-    
-    # Convert markdown to HTML with additional extensions
-    # 'extra' includes tables, fenced_code, footnotes, and more
-    # 'nl2br' converts newlines to <br> tags
-    # 'sane_lists' makes lists behave more predictably
-    html = markdown.markdown(
-        text, 
-        extensions=[
-            ExtraExtension(),
-            Nl2BrExtension(),
-            SaneListExtension(),
-            CodeHiliteExtension(),
-            TocExtension(),
-            StrikethroughExtension()  # Custom extension for strikethrough
-        ]
-    )
-    
-    # Define allowed tags and attributes
-    allowed_tags = [
-        'p', 'br', 'a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-        'em', 'i', 'li', 'ol', 'strong', 'ul', 'h1', 'h2', 'h3', 'h4',
-        'h5', 'h6', 'hr', 'img', 'pre', 'span', 'table', 'tbody', 'td',
-        'th', 'thead', 'tr', 'del', 's', 'strike', 'div'
+    return get_markdown_renderer().render(text)
+
+def render_markdown_many(texts: List[Optional[str]]) -> List[str]:
+    """
+    Renders several Markdown fragments with one renderer lookup.
+    Returns the sanitized HTML in the same order as texts.
+    """
+    renderer = get_markdown_renderer()
+    return [renderer.render(text) for text in texts]
+
+def rendered_html(html: Optional[str], source: Optional[str] = None) -> Markup:
+    """
+    Template filter for stored HTML columns.
+    Falls back to the escaped source text while a row is waiting to be rendered.
+    """
+    if html is not None:
+        return Markup(html)
+    return escape(source or '')
+
+def encode_cursor(*values: Any) -> str:
+    """
+    Encodes the sort key of the last row on a page into an opaque, URL-safe cursor.
+    Datetimes are stored as ISO strings and restored by decode_cursor.
+    """
+    payload = [
+        {"dt": value.isoformat()} if isinstance(value, datetime) else value
+        for value in values
     ]
-    
-    allowed_attrs = {
-        'a': ['href', 'title', 'rel'],
-        'abbr': ['title'],
-        'acronym': ['title'],
-        'img': ['src', 'alt', 'title', 'width', 'height'],
-        'pre': ['class'],
-        'code': ['class'],
-        'div': ['class'],
-        '*': ['class']
-    }
-    
-    # Sanitize HTML
-    clean_html = bleach.clean(
-        html,
-        tags=allowed_tags,
-        attributes=allowed_attrs,
-        strip=True
-    )
-    
-    return clean_html
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: Optional[str], length: int, types: Optional[Sequence[Any]] = None) -> Optional[List[Any]]:
+    """
+    Decodes a cursor created by encode_cursor.
+    types, if given, holds the type (or tuple of types) each value must have; bools don't pass for int.
+    Returns None if the cursor is missing, malformed, has the wrong number of values or a value of the wrong type.
+    """
+    if not cursor:
+        return None
+    
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        if not isinstance(payload, list) or len(payload) != length:
+            return None
+        values = [
+            datetime.fromisoformat(value["dt"]) if isinstance(value, dict) and "dt" in value else value
+            for value in payload
+        ]
+    except (ValueError, TypeError, KeyError):
+        return None
+    
+    if types is not None:
+        for value, expected in zip(values, types):
+            expected = expected if isinstance(expected, tuple) else (expected,)
+            if not isinstance(value, expected) or (isinstance(value, bool) and bool not in expected):
+                return None
+    return values